@@ -0,0 +1,74 @@
+# activity.py
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Dict, Optional
+
+from db_pool import db
+
+FLUSH_INTERVAL = 5.0
+
+
+class ActivityJournal:
+    """
+    Журнал активности матчей (write-behind).
+
+    touch() на каждое пересланное сообщение лишь запоминает время в словаре
+    (повторные касания одного матча схлопываются), а flush() раз в
+    FLUSH_INTERVAL секунд пишет всё одной транзакцией в matches.last_activity.
+    После рестарта дедлайн считается от last_activity, а не заново.
+    Потерять можно не больше FLUSH_INTERVAL секунд активности.
+    """
+
+    def __init__(self) -> None:
+        self._pending: Dict[int, int] = {}   # match_id -> unix ts последней активности
+        self.touches = 0
+        self.writes = 0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def touch(self, match_id: int, ts: Optional[float] = None) -> None:
+        self.touches += 1
+        self._pending[match_id] = int(ts if ts is not None else time.time())
+
+    def forget(self, match_id: int) -> None:
+        """Матч завершён — писать его активность уже незачем."""
+        self._pending.pop(match_id, None)
+
+    async def flush(self) -> int:
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        try:
+            async with db() as conn:
+                await conn.executemany(
+                    "UPDATE matches SET last_activity=? WHERE id=? AND active=1",
+                    [(ts, mid) for mid, ts in pending.items()]
+                )
+                await conn.commit()
+        except Exception as e:
+            for mid, ts in pending.items():
+                self._pending.setdefault(mid, ts)
+            print("[activity] flush failed:", repr(e))
+            return 0
+        self.writes += len(pending)
+        return len(pending)
+
+    async def run_flusher(self, interval: float = FLUSH_INTERVAL) -> None:
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                await self.flush()
+        except asyncio.CancelledError:
+            await self.flush()
+            raise
+
+
+ACTIVITY = ActivityJournal()
+
+__all__ = [
+    "ActivityJournal",
+    "ACTIVITY",
+]
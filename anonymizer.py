@@ -0,0 +1,58 @@
+# anonymizer.py
+# === Anonymizer: маскируем @user, t.me, tg://user?id=..., почту и телефоны
+from __future__ import annotations
+
+import re
+from typing import Optional
+
+# шаблоны прежние; порядок применения тоже прежний: ссылки -> @user -> почта -> телефон
+TGID = r'tg://user\?id=\d+'                 # tg://user?id=...
+TME = r'(?:https?://)?t\.me/[^\s]+'         # t.me/...
+USER = r'(?<!\w)@[\w_]{3,}'                 # @username
+MAIL = r'[\w\.-]+@[\w\.-]+\.\w+'            # email
+PHON = r'(?<!\d)(?:\+?\d[\d\-\s()]{8,}\d)'  # телефон
+
+REPLACEMENTS = {
+    "tgid": "[hidden]",
+    "tme": "[link hidden]",
+    "user": "@hidden",
+    "mail": "[email hidden]",
+    "phon": "[phone hidden]",
+}
+
+# tg:// и t.me/ в одной альтернации дают тот же результат, что два прохода подряд.
+# @user/почту/телефон так не склеить: при склеенных токенах («8 800 555 35 35@mail.ru»)
+# самое левое совпадение съедает чужой кусок и «@mail.ru» остаётся видимым.
+LINK_RE = re.compile(f"(?P<tgid>{TGID})|(?P<tme>{TME})", re.I)
+USER_RE = re.compile(USER, re.I)
+MAIL_RE = re.compile(MAIL, re.I)
+PHON_RE = re.compile(PHON, re.I)
+
+# быстрая проверка: в обычной реплике нет ни «@», ни ссылок, ни длинных цифр — не трогаем её вовсе
+_HINT_RE = re.compile(r'@|t\.me/|tg://|\d[\d\-\s()]{8,}\d', re.I)
+_LINK_HINT_RE = re.compile(r't\.me/|tg://', re.I)
+
+
+def _repl(m: "re.Match[str]") -> str:
+    return REPLACEMENTS[m.lastgroup]
+
+
+def sanitize_text(s: str) -> str:
+    if _HINT_RE.search(s) is None:
+        return s
+    if _LINK_HINT_RE.search(s) is not None:
+        s = LINK_RE.sub(_repl, s)
+    if '@' in s:
+        s = USER_RE.sub(REPLACEMENTS["user"], s)
+        s = MAIL_RE.sub(REPLACEMENTS["mail"], s)
+    return PHON_RE.sub(REPLACEMENTS["phon"], s)
+
+
+def clean_cap(caption: Optional[str]) -> Optional[str]:
+    return sanitize_text(caption) if caption else None
+
+
+__all__ = [
+    "sanitize_text",
+    "clean_cap",
+]
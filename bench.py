@@ -0,0 +1,442 @@
+# bench.py
+"""
+Микро-бенчмарки горячих путей бота. Запуск: `python bench.py <имя> [--n N]`.
+Работают на временной БД и не трогают боевую.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import aiosqlite
+
+from db_pool import Pool
+
+BENCHES = {}
+
+
+def bench(name: str):
+    def deco(fn):
+        BENCHES[name] = fn
+        return fn
+    return deco
+
+
+def _report(title: str, n: int, seconds: float) -> None:
+    rate = n / seconds if seconds > 0 else float("inf")
+    print(f"{title:<40} {n:>8} ops  {seconds:8.3f} s  {rate:12.0f} ops/s")
+
+
+def _report_latency(title: str, samples: list) -> None:
+    s = sorted(samples)
+    p50 = s[len(s) // 2] * 1000
+    p99 = s[min(len(s) - 1, int(len(s) * 0.99))] * 1000
+    print(f"{title:<40} {len(s):>8} ops  p50 {p50:8.3f} ms  p99 {p99:8.3f} ms")
+
+
+def _tmp_db() -> str:
+    d = tempfile.mkdtemp(prefix="bench_")
+    return os.path.join(d, "bench.db")
+
+
+async def _seed_users(path: str, count: int) -> None:
+    async with aiosqlite.connect(path) as conn:
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS users(tg_id INTEGER PRIMARY KEY, role TEXT DEFAULT 'user', points INTEGER DEFAULT 0)"
+        )
+        await conn.executemany("INSERT OR IGNORE INTO users(tg_id) VALUES(?)", [(i,) for i in range(count)])
+        await conn.commit()
+
+
+# ------------------ пул соединений vs connect на каждый вызов ------------------
+@bench("pool")
+async def bench_pool(n: int) -> None:
+    path = _tmp_db()
+    await _seed_users(path, 1000)
+
+    # «как было»: aiosqlite.connect() на каждый хелпер
+    t0 = time.perf_counter()
+    for i in range(n):
+        async with aiosqlite.connect(path) as conn:
+            cur = await conn.execute("SELECT role FROM users WHERE tg_id=?", (i % 1000,))
+            await cur.fetchone()
+    _report("connect-per-call (read)", n, time.perf_counter() - t0)
+
+    pool = Pool(path)
+    await pool.open()
+    try:
+        t0 = time.perf_counter()
+        for i in range(n):
+            async with pool.reader() as conn:
+                cur = await conn.execute("SELECT role FROM users WHERE tg_id=?", (i % 1000,))
+                await cur.fetchone()
+        _report("pooled reader (read)", n, time.perf_counter() - t0)
+
+        # параллельные апдейты: читатели не ждут друг друга
+        async def one(i: int):
+            async with pool.reader() as conn:
+                cur = await conn.execute("SELECT role FROM users WHERE tg_id=?", (i % 1000,))
+                await cur.fetchone()
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(n)))
+        _report("pooled reader (read, concurrent)", n, time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        for i in range(n):
+            async with pool.writer() as conn:
+                await conn.execute("UPDATE users SET points=points+1 WHERE tg_id=?", (i % 1000,))
+                await conn.commit()
+        _report("pooled writer (update+commit)", n, time.perf_counter() - t0)
+    finally:
+        await pool.close()
+
+    t0 = time.perf_counter()
+    for i in range(n):
+        async with aiosqlite.connect(path) as conn:
+            await conn.execute("UPDATE users SET points=points+1 WHERE tg_id=?", (i % 1000,))
+            await conn.commit()
+    _report("connect-per-call (update+commit)", n, time.perf_counter() - t0)
+
+
+# ------------------ очередь поиска: SQL-скан vs корзины в памяти ------------------
+# прежний запрос find_partner — для сравнения
+_FIND_SQL = """
+    SELECT q.tg_id
+    FROM queue q
+    JOIN users u ON u.tg_id = q.tg_id
+    LEFT JOIN recent_partners rp
+           ON rp.u_id=? AND rp.partner_id=q.tg_id AND rp.block_left>0
+    WHERE q.tg_id<>?
+      AND ((?='Не важно') OR u.gender=CASE ? WHEN 'Парни' THEN 'Парень' WHEN 'Девушки' THEN 'Девушка' END)
+      AND (u.seeking='Не важно' OR u.seeking=CASE ? WHEN 'Парень' THEN 'Парни' WHEN 'Девушка' THEN 'Девушки' END)
+      AND rp.partner_id IS NULL
+    ORDER BY q.ts ASC
+    LIMIT 1
+"""
+
+
+@bench("matchmaker")
+async def bench_matchmaker(n: int, queued: int = 10_000) -> None:
+    import random
+    from matchmaker import Matchmaker
+
+    rnd = random.Random(42)
+    genders = ("Парень", "Девушка")
+    seeks = ("Парни", "Девушки", "Не важно")
+    people = [(i, rnd.choice(genders), rnd.choice(seeks)) for i in range(1, queued + 1)]
+
+    path = _tmp_db()
+    async with aiosqlite.connect(path) as conn:
+        await conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE users(tg_id INTEGER PRIMARY KEY, gender TEXT, seeking TEXT);
+            CREATE TABLE queue(tg_id INTEGER PRIMARY KEY, gender TEXT, seeking TEXT, ts INTEGER);
+            CREATE TABLE recent_partners(u_id INTEGER NOT NULL, partner_id INTEGER NOT NULL,
+                                         block_left INTEGER NOT NULL DEFAULT 0, PRIMARY KEY(u_id, partner_id));
+        """)
+        await conn.executemany("INSERT INTO users VALUES(?,?,?)", people)
+        await conn.executemany("INSERT INTO queue VALUES(?,?,?,?)", [(i, g, s, i) for i, g, s in people])
+        await conn.commit()
+
+    probes = [rnd.choice(people) for _ in range(n)]
+
+    pool = Pool(path)
+    await pool.open()
+    try:
+        t0 = time.perf_counter()
+        for uid, g, s in probes:
+            async with pool.reader() as conn:
+                cur = await conn.execute(_FIND_SQL, (uid, uid, s, s, g))
+                await cur.fetchone()
+        _report(f"SQL find_partner ({queued} queued)", n, time.perf_counter() - t0)
+    finally:
+        await pool.close()
+
+    mm = Matchmaker()
+    for i, g, s in people:
+        mm.add(i, g, s, ts=i)
+    t0 = time.perf_counter()
+    for uid, g, s in probes:
+        mm.find(uid, g, s)
+    _report(f"Matchmaker.find ({queued} queued)", n, time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    matched = 0
+    for uid, g, s in people:
+        if uid in mm and mm.claim(uid, g, s) is not None:
+            matched += 1
+    _report(f"Matchmaker.claim drain ({matched} pairs)", queued, time.perf_counter() - t0)
+
+
+# ------------------ /profile: десяток хелперов vs один запрос ------------------
+@bench("profile")
+async def bench_profile(n: int, users: int = 2000) -> None:
+    import random
+    import db_pool
+
+    db_pool.POOL.path = _tmp_db()  # до импорта бота: все его хелперы пойдут во временную БД
+    import bot as app
+
+    rnd = random.Random(7)
+    await app.init_db()
+    async with db_pool.db() as conn:
+        await conn.executemany(
+            "INSERT INTO users(tg_id, gender, seeking, points) VALUES(?,?,?,?)",
+            [(i, "Парень", "Девушки", rnd.randint(0, 500)) for i in range(1, users + 1)]
+        )
+        await conn.executemany(
+            "INSERT INTO shop_items(name, price, type, payload) VALUES(?,?,?,?)",
+            [(f"Статус {i}", 10 * i, "status", f"Статус {i}") for i in range(1, 21)]
+        )
+        await conn.executemany(
+            "INSERT INTO ratings(match_id, from_user, to_user, stars) VALUES(?,?,?,?)",
+            [(k, rnd.randint(1, users), rnd.randint(1, users), rnd.randint(1, 5)) for k in range(users * 10)]
+        )
+        await conn.executemany(
+            "INSERT INTO purchases(user_id, item_id) VALUES(?,?)",
+            [(rnd.randint(1, users), rnd.randint(1, 20)) for _ in range(users * 3)]
+        )
+        await conn.executemany(
+            "INSERT OR IGNORE INTO referrals(inviter, invited) VALUES(?,?)",
+            [(rnd.randint(1, users), users + k) for k in range(users)]
+        )
+        await conn.commit()
+    for uid in range(1, users + 1):
+        await app.ensure_free_statuses(uid)
+    probes = [rnd.randint(1, users) for _ in range(n)]
+
+    async def before(uid: int) -> None:
+        # прежний cmd_profile (кэш профилей сбрасываем — раньше его не было)
+        app.USERS.clear()
+        await app.ensure_user(uid)
+        await app.get_user_or_create(uid)
+        await app.ensure_free_statuses(uid)
+        await app.get_points(uid)
+        await app.get_status(uid)
+        await app.get_avg_rating(uid)
+        await app.count_referrals(uid)
+        await app.purchases_summary(uid)
+        await app.get_status_inventory(uid)
+        await app.get_status(uid)
+
+    async def after(uid: int) -> None:
+        await app.ensure_user(uid)
+        await app.profile_view(uid)
+
+    async def reads_only(uid: int) -> None:
+        await app.profile_view(uid)
+
+    try:
+        for title, fn in (("/profile: helpers (before)", before), ("/profile: profile_view (after)", after),
+                          ("/profile: profile_view only", reads_only)):
+            samples = []
+            for uid in probes:
+                t0 = time.perf_counter()
+                await fn(uid)
+                samples.append(time.perf_counter() - t0)
+            _report_latency(title, samples)
+    finally:
+        await db_pool.close_pool()
+
+
+# ------------------ анонимайзер: пять проходов vs предпроверка ------------------
+_LEGACY_ANON = None
+
+
+def _legacy_sanitize(s: str) -> str:
+    """Прежний sanitize_text из bot.py: пять re.sub подряд на каждое сообщение."""
+    global _LEGACY_ANON
+    if _LEGACY_ANON is None:
+        import re
+        _LEGACY_ANON = (
+            (re.compile(r'tg://user\?id=\d+', re.I), '[hidden]'),
+            (re.compile(r'(?:https?://)?t\.me/[^\s]+', re.I), '[link hidden]'),
+            (re.compile(r'(?<!\w)@[\w_]{3,}', re.I), '@hidden'),
+            (re.compile(r'[\w\.-]+@[\w\.-]+\.\w+', re.I), '[email hidden]'),
+            (re.compile(r'(?<!\d)(?:\+?\d[\d\-\s()]{8,}\d)'), '[phone hidden]'),
+        )
+    for rx, repl in _LEGACY_ANON:
+        s = rx.sub(repl, s)
+    return s
+
+
+def _chat_corpus(size: int, seed: int = 11) -> list:
+    """Похоже на реальный поток: в основном обычные реплики, изредка контакты."""
+    import random
+    rnd = random.Random(seed)
+    plain = [
+        "привет", "как дела?", "норм, а у тебя", "с какого ты факультета?", "ахах да",
+        "я тоже на втором курсе", "что слушаешь последнее время?", "ну такое)",
+        "сегодня пары до шести, умираю", "го в кино в субботу", "ок", "😂😂😂",
+        "в 2024 году поступила", "мне 19", "ну расскажи о себе что-нибудь интересное",
+        "люблю сериалы и долгие прогулки по вечерам, особенно осенью",
+    ]
+    contacts = [
+        "пиши в тг @vasya_pupkin", "вот мой канал t.me/some_channel", "https://t.me/joinchat/AbCdEf",
+        "почта vasya.pupkin@mail.ru", "звони +7 (999) 123-45-67", "мой номер 89991234567",
+        "tg://user?id=123456789", "инст @masha.photo",
+    ]
+    out = []
+    for _ in range(size):
+        if rnd.random() < 0.05:
+            out.append(rnd.choice(plain) + " " + rnd.choice(contacts))
+        else:
+            out.append(" ".join(rnd.choice(plain) for _ in range(rnd.randint(1, 3))))
+    return out
+
+
+@bench("anonymizer")
+async def bench_anonymizer(n: int, rounds: int = 20) -> None:
+    from anonymizer import sanitize_text
+
+    corpus = _chat_corpus(n)
+    mb = sum(len(s.encode("utf-8")) for s in corpus) * rounds / 1e6
+    for s in corpus:
+        assert sanitize_text(s) == _legacy_sanitize(s), s
+    for title, fn in (("sanitize_text: 5 passes (before)", _legacy_sanitize),
+                      ("sanitize_text: precheck (after)", sanitize_text)):
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            for s in corpus:
+                fn(s)
+        dt = time.perf_counter() - t0
+        print(f"{title:<40} {len(corpus) * rounds:>8} msgs {dt:8.3f} s  {mb / dt:10.1f} MB/s")
+
+
+# ------------------ клавиатуры: сборка на каждый ответ vs готовый объект ------------------
+@bench("keyboards")
+async def bench_keyboards(n: int) -> None:
+    import db_pool
+
+    db_pool.POOL.path = _tmp_db()
+    import bot as app
+
+    items = [(i, f"Статус {i}", 10 * i, "status", f"Статус {i}") for i in range(1, 21)]
+    inventory = [f"Статус {i}" for i in range(1, 8)]
+    # (название, сборка без кэша, её аргументы, публичная функция, её аргументы)
+    cases = (
+        ("main_menu", app.main_menu.__wrapped__, (), app.main_menu, ()),
+        ("admin_main_kb", app.admin_main_kb.__wrapped__, (), app.admin_main_kb, ()),
+        ("rate_or_complain_kb(mid)", app.rate_or_complain_kb.__wrapped__, (42,), app.rate_or_complain_kb, (42,)),
+        ("shop_kb(20 items)", app._shop_kb.__wrapped__, (tuple(items),), app.shop_kb, (items,)),
+        ("statuses_kb(7)", app._statuses_kb.__wrapped__, (tuple(inventory), "Статус 3"),
+         app.statuses_kb, (inventory, "Статус 3")),
+    )
+    for name, build, build_args, cached, args in cases:
+        for title, fn, a in ((f"{name}: build", build, build_args), (f"{name}: cached", cached, args)):
+            t0 = time.perf_counter()
+            for _ in range(n):
+                fn(*a)
+            _report(title, n, time.perf_counter() - t0)
+    await db_pool.close_pool()
+
+
+# ------------------ старт схемы: миграции на холодной и тёплой базе ------------------
+@bench("migrations")
+async def bench_migrations(n: int) -> None:
+    import db_pool
+
+    db_pool.POOL.path = _tmp_db()
+    import bot as app
+
+    stmts = [0]
+
+    def count(sql: str, seconds: float, ok: bool) -> None:
+        stmts[0] += 1
+
+    db_pool.add_query_hook(count)
+    try:
+        for title in ("init_db: cold (new database)", "init_db: warm"):
+            await db_pool.close_pool()
+            await db_pool.POOL.open()
+            stmts[0] = 0
+            t0 = time.perf_counter()
+            await app.init_db()
+            _report(f"{title}, {stmts[0]} stmts", 1, time.perf_counter() - t0)
+        warm = []
+        for _ in range(n):
+            t0 = time.perf_counter()
+            await app.init_db()
+            warm.append(time.perf_counter() - t0)
+        _report_latency("init_db: warm, repeated", warm)
+        stmts[0] = 0
+        t0 = time.perf_counter()
+        for i in range(n):
+            await app.count_referrals(i)
+        _report(f"count_referrals: {stmts[0] / n:.1f} stmts/call", n, time.perf_counter() - t0)
+    finally:
+        db_pool.remove_query_hook(count)
+        await db_pool.close_pool()
+
+
+# ------------------ FSM: MemoryStorage vs SQLite с кэшем и склейкой записей ------------------
+@bench("fsm")
+async def bench_fsm(n: int) -> None:
+    import db_pool
+    from aiogram.fsm.storage.base import StorageKey
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from fsmstore import SqliteStorage
+
+    db_pool.POOL.path = _tmp_db()
+    users = 500
+    keys = [StorageKey(bot_id=1, chat_id=uid, user_id=uid) for uid in range(users)]
+    stmts = [0]
+
+    def count(sql: str, seconds: float, ok: bool) -> None:
+        stmts[0] += 1
+
+    memory, sqlite = MemoryStorage(), SqliteStorage()
+    await sqlite.start()
+    db_pool.add_query_hook(count)
+    try:
+        for name, storage in (("MemoryStorage", memory), ("SqliteStorage", sqlite)):
+            stmts[0] = 0
+            t0 = time.perf_counter()
+            for i in range(n):
+                await storage.set_state(keys[i % users], "RevealForm:photos")
+            _report(f"{name}: set_state", n, time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            for i in range(n):
+                await storage.get_state(keys[i % users])
+            _report(f"{name}: get_state", n, time.perf_counter() - t0)
+            # анкета: серия update_data одного пользователя (rf_photos и т. п.)
+            t0 = time.perf_counter()
+            for i in range(n):
+                await storage.update_data(keys[i % users], {"new_photos": [f"photo{j}" for j in range(i % 3 + 1)]})
+            _report(f"{name}: update_data", n, time.perf_counter() - t0)
+            if storage is sqlite:
+                t0 = time.perf_counter()
+                rows = await sqlite.flush()
+                _report(f"{name}: flush ({rows} rows for {2 * n} changes)", 1, time.perf_counter() - t0)
+            print(f"{name}: SQL statements during the run: {stmts[0]}")
+
+        # холодный старт: данные в БД, в памяти пусто (как после рестарта)
+        cold = SqliteStorage()
+        t0 = time.perf_counter()
+        for k in keys:
+            await cold.get_state(k)
+        _report("SqliteStorage: get_state after restart", users, time.perf_counter() - t0)
+        assert await cold.get_data(keys[0]) == await sqlite.get_data(keys[0])
+    finally:
+        db_pool.remove_query_hook(count)
+        await db_pool.close_pool()
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Бенчмарки бота")
+    ap.add_argument("name", choices=sorted(BENCHES) + ["all"])
+    ap.add_argument("--n", type=int, default=2000, help="число итераций")
+    args = ap.parse_args()
+    names = sorted(BENCHES) if args.name == "all" else [args.name]
+    for name in names:
+        print(f"=== {name} ===")
+        asyncio.run(BENCHES[name](args.n))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,13 @@
 import asyncio
 import os
 import time
+from functools import lru_cache
 from math import ceil
 from typing import Optional, Dict, Tuple
 from aiogram.exceptions import TelegramBadRequest
 from dotenv import load_dotenv
 import secrets, string
 
-import aiosqlite
 from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
@@ -27,34 +27,18 @@ from aiogram.types import (
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 from dotenv import load_dotenv
 # === Anonymizer: маскируем @user, t.me, tg://user?id=..., почту и телефоны
-import re
-
-USER_RE = re.compile(r'(?<!\w)@[\w_]{3,}', re.I)                 # @username
-TME_RE  = re.compile(r'(?:https?://)?t\.me/[^\s]+', re.I)        # t.me/...
-TGID_RE = re.compile(r'tg://user\?id=\d+', re.I)                 # tg://user?id=...
-MAIL_RE = re.compile(r'[\w\.-]+@[\w\.-]+\.\w+', re.I)            # email
-PHON_RE = re.compile(r'(?<!\d)(?:\+?\d[\d\-\s()]{8,}\d)')        # телефон
-
-def sanitize_text(s: str) -> str:
-    s = TGID_RE.sub('[hidden]', s)
-    s = TME_RE.sub('[link hidden]', s)
-    s = USER_RE.sub('@hidden', s)
-    s = MAIL_RE.sub('[email hidden]', s)
-    s = PHON_RE.sub('[phone hidden]', s)
-    return s
+from anonymizer import sanitize_text, clean_cap
 
 async def send_text_anonym(peer: int, text: str):
     # отключаем HTML-разметку, превью и запрещаем пересылку/сохранение
-    await bot.send_message(
+    text = sanitize_text(text)
+    relay_send(peer, lambda: bot.send_message(
         peer,
-        sanitize_text(text),
+        text,
         parse_mode=None,
         disable_web_page_preview=True,
         protect_content=True
-    )
-
-def clean_cap(caption: Optional[str]) -> Optional[str]:
-    return sanitize_text(caption) if caption else None
+    ))
 
 # ============================================================
 #                         CONFIG
@@ -75,11 +59,36 @@ CHANNEL_LINK = "https://t.me/nektomephi"  # ссылка-приглашение
 RESOLVED_CHANNEL_ID: Optional[int] = None # будет заполнен в main()
 
 bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
-
-APPDATA_DIR = os.path.join(os.path.expanduser("~"), "AppData", "Local", "mephi_dating")
-os.makedirs(APPDATA_DIR, exist_ok=True)
-DB_PATH = os.path.join(APPDATA_DIR, "bot.db")
+from fsmstore import FSM_STORAGE
+dp = Dispatcher(storage=FSM_STORAGE)  # состояния анкет/мастеров в SQLite, переживают рестарт (fsmstore.py)
+
+# путь к БД и пул соединений (один писатель + читатели) — см. db_pool.py
+from db_pool import APPDATA_DIR, DB_PATH, db, db_read, close_pool, add_query_hook
+from migrations import Migration, add_column, migrate
+from matchmaker import MATCHMAKER
+from timers import TIMERS
+from outbox import OUTBOX, LANE_RELAY, LANE_SYSTEM
+from broadcast import BROADCASTS, progress_kb, mark_unblocked
+from subscriptions import SUBS
+from usercache import USERS, KNOWN_USERS
+from activity import ACTIVITY
+from updatectx import ContextMiddleware, CTX_STATS, UpdateContext, ctx_for
+from roles import ROLES
+from webhook import BOT_MODE, run_webhook
+from metrics import METRICS, HandlerMetrics, ApiMetrics, observe_sql, start_metrics_server
+from shop import CATALOG, PURCHASES, DUPLICATE, NO_ITEM, NO_FUNDS
+
+ROLES.set_static(ADMIN_IDS)  # админы из .env — всегда админы; остальное подгрузит ROLES.load()
+add_query_hook(observe_sql)  # время каждого SQL-оператора -> bot_sql_seconds
+bot.session.middleware(ApiMetrics())  # время/ошибки Bot API по методам -> bot_api_seconds
+
+def relay_send(peer: int, factory) -> asyncio.Future:
+    # пересылка собеседнику: самая приоритетная полоса, хэндлер не ждёт ответа Telegram
+    return OUTBOX.submit(peer, factory, LANE_RELAY)
+
+def send_queued(chat_id: int, text: str, lane: int = LANE_SYSTEM, **kw) -> asyncio.Future:
+    # системное сообщение через общую очередь (лимиты Telegram, повтор на 429)
+    return OUTBOX.submit(chat_id, lambda: bot.send_message(chat_id, text, **kw), lane)
 
 BLOCK_TXT = "Сейчас идёт анонимный чат. Доступны только команды: !stop, !next, !reveal."
 
@@ -163,6 +172,13 @@ CREATE TABLE IF NOT EXISTS ratings(
 
 CREATE INDEX IF NOT EXISTS idx_ratings_to ON ratings(to_user);
 
+-- агрегат оценок, ведётся в той же транзакции, что и INSERT в ratings
+CREATE TABLE IF NOT EXISTS rating_stats(
+  user_id INTEGER PRIMARY KEY,
+  sum INTEGER NOT NULL DEFAULT 0,
+  count INTEGER NOT NULL DEFAULT 0
+);
+
 CREATE TABLE IF NOT EXISTS complaints(
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   match_id INTEGER NOT NULL,
@@ -225,66 +241,84 @@ CREATE TABLE IF NOT EXISTS referrals(
   ts INTEGER DEFAULT (strftime('%s','now'))
 );
 
+-- непрозрачные реф-коды
+CREATE TABLE IF NOT EXISTS ref_codes(
+  code TEXT PRIMARY KEY,
+  inviter INTEGER NOT NULL
+);
+
 CREATE TABLE IF NOT EXISTS settings(
   key TEXT PRIMARY KEY,
   value TEXT
 );
 
-CREATE INDEX IF NOT EXISTS idx_matches_active ON matches(active);
+-- рассылки (задание + курсор по tg_id, чтобы продолжить после рестарта)
+CREATE TABLE IF NOT EXISTS broadcasts(
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  admin_id INTEGER,
+  text TEXT NOT NULL,
+  status TEXT DEFAULT 'running',   -- running/done/cancelled
+  cursor INTEGER DEFAULT 0,        -- последний обработанный tg_id (получатели идут по возрастанию)
+  total INTEGER DEFAULT 0,
+  sent INTEGER DEFAULT 0,
+  failed INTEGER DEFAULT 0,
+  blocked INTEGER DEFAULT 0,
+  progress_chat INTEGER,           -- где показывать прогресс
+  progress_msg INTEGER,
+  created_at INTEGER DEFAULT (strftime('%s','now')),
+  finished_at INTEGER
+);
 """
 
+# колонки, добавленные к таблицам позже (базы до миграций могли уже получить их старыми ALTER'ами)
 ALTERS = [
-    ("users", "role",         "ALTER TABLE users ADD COLUMN role TEXT DEFAULT 'user'"),
-    ("users", "points",       "ALTER TABLE users ADD COLUMN points INTEGER DEFAULT 0"),
-    ("users", "status_title", "ALTER TABLE users ADD COLUMN status_title TEXT"),
-    ("users", "last_daily",   "ALTER TABLE users ADD COLUMN last_daily INTEGER DEFAULT 0")
+    add_column("users", "role", "TEXT DEFAULT 'user'"),
+    add_column("users", "points", "INTEGER DEFAULT 0"),
+    add_column("users", "status_title", "TEXT"),
+    add_column("users", "last_daily", "INTEGER DEFAULT 0"),
+    add_column("users", "bot_blocked", "INTEGER DEFAULT 0"),
+    add_column("matches", "last_activity", "INTEGER"),
+    # referrals из старых версий: без inviter/ts (DEFAULT-выражение в ADD COLUMN SQLite не разрешает)
+    add_column("referrals", "inviter", "INTEGER"),
+    add_column("referrals", "ts", "INTEGER"),
 ]
 
-def db():
-    return aiosqlite.connect(DB_PATH)
-
-async def init_db():
-    async with db() as conn:
-        await conn.executescript(CREATE_SQL)
-
-        # мягкие ALTER'ы
-        for table, col, sql in ALTERS:
-            cur = await conn.execute(f"PRAGMA table_info({table})")
-            cols = [r[1] for r in await cur.fetchall()]
-            if col not in cols:
-                try:
-                    await conn.execute(sql)
-                except Exception:
-                    pass
+# индексы горячих запросов. Планы проверяет `python plancheck.py` — после правок SQL/индексов запускать его.
+INDEXES = [
+    # matches: последний матч участника (a_id=? OR b_id=? ORDER BY id DESC) и активный чат участника
+    "CREATE INDEX IF NOT EXISTS idx_matches_a ON matches(a_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_matches_b ON matches(b_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_matches_active_a ON matches(a_id) WHERE active=1",
+    "CREATE INDEX IF NOT EXISTS idx_matches_active_b ON matches(b_id) WHERE active=1",
+    # все активные (старт, сверка ACTIVE); вместо idx_matches_active(active), который
+    # планировщик брал и для запросов по участнику — а это перебор всех активных чатов
+    "CREATE INDEX IF NOT EXISTS idx_matches_live ON matches(id) WHERE active=1",
+    "DROP INDEX IF EXISTS idx_matches_active",
+    # открытые обращения: список диалогов (GROUP BY from_user, MAX(ts)) и сообщения пользователя
+    "CREATE INDEX IF NOT EXISTS idx_support_open ON support_msgs(from_user, ts) WHERE status='open'",
+    "CREATE INDEX IF NOT EXISTS idx_ref_codes_inviter ON ref_codes(inviter)",
+    # очередь поиска при старте: ORDER BY ts целиком из индекса
+    "CREATE INDEX IF NOT EXISTS idx_queue_ts ON queue(ts, gender, seeking)",
+]
 
-        # миграция referrals (добавить недостающие колонки)
-        cur = await conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='referrals'")
-        has_ref = await cur.fetchone()
-        if has_ref:
-            cur = await conn.execute("PRAGMA table_info(referrals)")
-            cols = {r[1] for r in await cur.fetchall()}
-            if "inviter" not in cols:
-                await conn.execute("ALTER TABLE referrals ADD COLUMN inviter INTEGER")
-            if "ts" not in cols:
-                await conn.execute("ALTER TABLE referrals ADD COLUMN ts INTEGER DEFAULT (strftime('%s','now'))")
-            else:
-                await conn.execute("""
-                        CREATE TABLE IF NOT EXISTS referrals(
-                          inviter INTEGER,
-                          invited INTEGER PRIMARY KEY,
-                          ts INTEGER DEFAULT (strftime('%s','now'))
-                        )
-                    """)
-
-            # --- NEW: таблица непрозрачных реф-кодов ---
-            await conn.execute("""
-                    CREATE TABLE IF NOT EXISTS ref_codes(
-                      code TEXT PRIMARY KEY,
-                      inviter INTEGER NOT NULL
-                    )
-                """)
+# схема "bot" (migrations.py): применённые миграции не меняем, изменения — новым номером
+MIGRATIONS = [
+    Migration(1, "baseline", [
+        CREATE_SQL,
+        *ALTERS,
+        "CREATE INDEX IF NOT EXISTS idx_purchases_user_ts ON purchases(user_id, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_referrals_inviter ON referrals(inviter)",
+    ]),
+    Migration(2, "hot-path indexes", INDEXES),
+    Migration(3, "purchase idempotency keys", [
+        add_column("purchases", "idem_key", "TEXT"),
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_purchases_idem ON purchases(idem_key) WHERE idem_key IS NOT NULL",
+    ]),
+]
 
-            await conn.commit()
+async def init_db():
+    """Схема до последней версии; на тёплом старте — один SELECT версии."""
+    return await migrate("bot", MIGRATIONS)
 
 
 # ============================================================
@@ -351,7 +385,7 @@ DEFAULT_SETTINGS = {
 
 async def load_settings_cache():
     SETTINGS.clear()
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("SELECT key, value FROM settings")
         for k, v in await cur.fetchall():
             SETTINGS[k] = str(v)
@@ -429,35 +463,58 @@ _nowm = time.monotonic  # монотоничные секунды
 
 DEADLINE: Dict[int, float] = {}   # match_id -> monotonic deadline
 LAST_SHOWN: Dict[int, int] = {}   # match_id -> последний показанный остаток
-ACTIVE: Dict[int, Tuple[int, int]] = {}   # user_id -> (peer_id, match_id)
+ACTIVE: Dict[int, Tuple[int, int]] = {}   # user_id -> (peer_id, match_id); источник истины (см. load_active_sessions)
 LAST_SEEN: Dict[int, float] = {}          # user_id -> last_seen_unix
-WATCH: Dict[int, asyncio.Task] = {}       # match_id -> watcher task
 WARNED: Dict[int, bool] = {}              # match_id -> warned for countdown
 SUPPORT_RELAY: Dict[int, int] = {}        # msg_id_у_бота -> user_id
-COUNTDOWN_TASKS: Dict[int, asyncio.Task] = {}                     # match_id -> task
 COUNTDOWN_MSGS: Dict[int, Tuple[Optional[int], Optional[int]]] = {}  # match_id -> (msg_id_a, msg_id_b)
 
+# ------------------ dp: middleware и метрики ------------------
+# контекст апдейта: чат/очередь/профиль/подписка пользователя резолвятся один раз (updatectx.py)
+dp.message.outer_middleware(ContextMiddleware(ACTIVE, MATCHMAKER))
+dp.callback_query.outer_middleware(ContextMiddleware(ACTIVE, MATCHMAKER))
+# время/ошибки по хэндлерам (relay_chat, find, cmd_profile, cb_rate, ...) -> bot_handler_seconds
+dp.message.middleware(HandlerMetrics())
+dp.callback_query.middleware(HandlerMetrics())
+
+METRICS.gauge_fn("bot_queue_length", "Пользователей в очереди поиска", lambda: len(MATCHMAKER))
+METRICS.gauge_fn("bot_active_matches", "Активных чатов", lambda: len(ACTIVE) // 2)
+METRICS.gauge_fn("bot_timer_tasks", "Запущенных таймеров чатов", lambda: len(TIMERS))
+METRICS.gauge_fn("bot_support_relay_size", "Записей в SUPPORT_RELAY", lambda: len(SUPPORT_RELAY))
+METRICS.gauge_fn("bot_outbox_pending", "Сообщений в очереди отправки", lambda: OUTBOX.pending())
+
+# итоги для admin_stats: считаются один раз при старте (load_totals), дальше — по вставкам
+USERS_TOTAL = METRICS.gauge("bot_users_total", "Пользователей в БД")
+MATCHES_TOTAL = METRICS.gauge("bot_matches_total", "Чатов за всё время")
+SUPPORT_OPEN = METRICS.gauge("bot_support_open", "Открытых обращений в поддержку")
+REFERRALS_TOTAL = METRICS.gauge("bot_referrals_total", "Рефералов за всё время")
+
+async def load_totals():
+    async with db_read() as conn:
+        row = await (await conn.execute(
+            "SELECT (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM matches),"
+            " (SELECT COUNT(*) FROM support_msgs WHERE status='open'), (SELECT COUNT(*) FROM referrals)"
+        )).fetchone()
+    for g, v in zip((USERS_TOTAL, MATCHES_TOTAL, SUPPORT_OPEN, REFERRALS_TOTAL), row):
+        g.set(v)
+    return tuple(row)
+
 def _now() -> float:
     return time.time()
 
 # ------------------ Generic chat gate ------------------
 
 async def is_chat_active(user_id: int) -> bool:
-    if user_id in ACTIVE:
-        return True
-    async with db() as conn:
-        cur = await conn.execute(
-            "SELECT 1 FROM matches WHERE active=1 AND (a_id=? OR b_id=?) LIMIT 1",
-            (user_id, user_id),
-        )
-        return (await cur.fetchone()) is not None
+    # ACTIVE поднимается из БД при старте и меняется вместе с matches.active — в БД не ходим
+    return user_id in ACTIVE
 
 async def deny_actions_during_chat(m: Message) -> bool:
     """
     Вернёт True, если пользователь в активном чате: в этом случае
     отправляет блокирующее сообщение и скрывает клавиатуру.
     """
-    if await is_chat_active(m.from_user.id):
+    ctx = ctx_for(m.from_user.id)
+    if ctx.in_chat if ctx else await is_chat_active(m.from_user.id):
         await _materialize_session_if_needed(m.from_user.id)  # оживим RAM при необходимости
         await m.answer(BLOCK_TXT, reply_markup=ReplyKeyboardRemove())
         return True
@@ -466,7 +523,12 @@ async def deny_actions_during_chat(m: Message) -> bool:
 # ============================================================
 #                       KEYBOARDS (UI)
 # ============================================================
+# Разметка не меняется между вызовами, поэтому статичные клавиатуры
+# собираются один раз (lru_cache + прогрев ниже) и дальше отдаётся тот же
+# объект. Параметризованные кэшируются по аргументам с ограничением размера.
+KB_CACHE_SIZE = 1024
 
+@lru_cache(maxsize=None)
 def main_menu() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="🧭 Режимы"))
@@ -476,6 +538,7 @@ def main_menu() -> ReplyKeyboardMarkup:
     kb.add(KeyboardButton(text="🚩 Пожаловаться"))
     return kb.as_markup(resize_keyboard=True)
 
+@lru_cache(maxsize=None)
 def modes_kb() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="📇 Просмотр анкет"))
@@ -483,6 +546,7 @@ def modes_kb() -> ReplyKeyboardMarkup:
     kb.add(KeyboardButton(text="⬅️ В главное меню"))
     return kb.as_markup(resize_keyboard=True)
 
+@lru_cache(maxsize=None)
 def subscription_kb() -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     kb.button(text="➡️ Подписаться", url=CHANNEL_LINK)
@@ -490,17 +554,20 @@ def subscription_kb() -> InlineKeyboardMarkup:
     kb.adjust(1)
     return kb.as_markup()
 
+@lru_cache(maxsize=None)
 def anon_chat_menu_kb() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="🔎 Найти собеседника"))
     kb.add(KeyboardButton(text="⬅️ В главное меню"))
     return kb.as_markup(resize_keyboard=True)
 
+@lru_cache(maxsize=None)
 def cancel_kb() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="❌ Отмена"))
     return kb.as_markup(resize_keyboard=True)
 
+@lru_cache(maxsize=KB_CACHE_SIZE)
 def rate_or_complain_kb(mid: int) -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
     for i in range(1, 6):
@@ -510,6 +577,10 @@ def rate_or_complain_kb(mid: int) -> InlineKeyboardMarkup:
     return b.as_markup()
 
 def shop_kb(items) -> InlineKeyboardMarkup:
+    return _shop_kb(tuple(tuple(it) for it in items))
+
+@lru_cache(maxsize=KB_CACHE_SIZE)
+def _shop_kb(items: tuple) -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
     for (id_, name, price, type_, payload) in items:
         b.button(text=f"{name} — {price}💰", callback_data=f"shop_buy:{id_}")
@@ -518,12 +589,17 @@ def shop_kb(items) -> InlineKeyboardMarkup:
     b.adjust(1)
     return b.as_markup()
 
+def admin_items_text(items) -> str:
+    return "📦 Товары:\n" + ("\n".join([f"{i[0]}. {i[1]} — {i[2]}💰 [{i[3]}] {i[4] or ''}" for i in items]) or "пусто")
+
+@lru_cache(maxsize=None)
 def gender_self_kb() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="Я девушка"))
     kb.add(KeyboardButton(text="Я парень"))
     return kb.as_markup(resize_keyboard=True)
 
+@lru_cache(maxsize=None)
 def seeking_kb() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="Девушки"))
@@ -531,6 +607,7 @@ def seeking_kb() -> ReplyKeyboardMarkup:
     kb.add(KeyboardButton(text="Не важно"))
     return kb.as_markup(resize_keyboard=True)
 
+@lru_cache(maxsize=None)
 def faculties_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
     for i, f in enumerate(FACULTIES):
@@ -538,12 +615,14 @@ def faculties_kb() -> InlineKeyboardMarkup:
     b.adjust(2)
     return b.as_markup()
 
+@lru_cache(maxsize=None)
 def reveal_entry_menu() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="⬅️ В главное меню"))
     kb.add(KeyboardButton(text="✏️ Заполнить / Перезаполнить"))
     return kb.as_markup(resize_keyboard=True)
 
+@lru_cache(maxsize=KB_CACHE_SIZE)
 def about_kb(refill: bool = False, has_prev: bool = False) -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="Пропустить"))
@@ -552,6 +631,7 @@ def about_kb(refill: bool = False, has_prev: bool = False) -> ReplyKeyboardMarku
     kb.add(KeyboardButton(text="❌ Отмена"))
     return kb.as_markup(resize_keyboard=True)
 
+@lru_cache(maxsize=KB_CACHE_SIZE)
 def photos_empty_kb(refill: bool = False, has_prev: bool = False) -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     if refill and has_prev:
@@ -559,6 +639,7 @@ def photos_empty_kb(refill: bool = False, has_prev: bool = False) -> ReplyKeyboa
     kb.add(KeyboardButton(text="❌ Отмена"))
     return kb.as_markup(resize_keyboard=True)
 
+@lru_cache(maxsize=None)
 def photos_progress_kb() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="Готово"))
@@ -567,6 +648,10 @@ def photos_progress_kb() -> ReplyKeyboardMarkup:
     return kb.as_markup(resize_keyboard=True)
 
 def statuses_kb(inventory: list[str], current: Optional[str]) -> InlineKeyboardMarkup:
+    return _statuses_kb(tuple(inventory), current)
+
+@lru_cache(maxsize=KB_CACHE_SIZE)
+def _statuses_kb(inventory: tuple, current: Optional[str]) -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
     for t in inventory:
         mark = " ✅" if current and t == current else ""
@@ -576,6 +661,7 @@ def statuses_kb(inventory: list[str], current: Optional[str]) -> InlineKeyboardM
     b.adjust(1)
     return b.as_markup()
 
+@lru_cache(maxsize=None)
 def admin_main_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
     b.button(text="🛍 Магазин", callback_data="admin:shop")
@@ -589,6 +675,7 @@ def admin_main_kb() -> InlineKeyboardMarkup:
     b.adjust(2, 2, 2, 1)
     return b.as_markup()
 
+@lru_cache(maxsize=None)
 def admin_shop_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
     b.button(text="➕ Добавить товар", callback_data="admin:shop:add")
@@ -610,6 +697,7 @@ def admin_settings_kb() -> InlineKeyboardMarkup:
     b.adjust(1)
     return b.as_markup()
 
+@lru_cache(maxsize=None)
 def admin_admins_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
     b.button(text="➕ Добавить админа", callback_data="admin:admins:add")
@@ -618,6 +706,11 @@ def admin_admins_kb() -> InlineKeyboardMarkup:
     b.adjust(1)
     return b.as_markup()
 
+# прогрев: модели aiogram строятся лениво, первый пользователь не должен за это платить
+for _kb in (main_menu, modes_kb, subscription_kb, anon_chat_menu_kb, cancel_kb, gender_self_kb, seeking_kb,
+            faculties_kb, reveal_entry_menu, photos_progress_kb, admin_main_kb, admin_shop_kb, admin_admins_kb):
+    _kb()
+
 def chat_hint() -> str:
     return ("Команды в чате:\n"
             "<code>!next</code> — следующий собеседник\n"
@@ -643,32 +736,41 @@ async def can_take_daily_today(tg_id: int) -> bool:
     Разрешаем 1 раз в календарные сутки по UTC.
     Сравниваем date('now') и date(last_daily, 'unixepoch').
     """
-    async with db() as conn:
-        cur = await conn.execute("SELECT COALESCE(last_daily, 0) FROM users WHERE tg_id=?", (tg_id,))
-        row = await cur.fetchone()
-        last = int(row[0] if row else 0)
-        if last == 0:
-            return True
-        cur = await conn.execute("SELECT date('now') <> date(?, 'unixepoch')", (last,))
-        # вернётся 1 если даты отличаются (значит ещё не брали сегодня)
-        return bool((await cur.fetchone())[0])
+    rec = await _user_record(tg_id)
+    last = int((rec.last_daily if rec else 0) or 0)
+    if last == 0:
+        return True
+    # даты по UTC отличаются — значит ещё не брали сегодня
+    return time.strftime("%Y-%m-%d", time.gmtime()) != time.strftime("%Y-%m-%d", time.gmtime(last))
 
 async def mark_daily_taken(tg_id: int):
     await set_user_fields(tg_id, last_daily=int(time.time()))
 
 async def get_avg_rating(user_id: int) -> tuple[Optional[float], int]:
+    # rating_stats приезжает вместе с профилем в USERS — по ratings не агрегируем
+    rec = await _user_record(user_id)
+    if rec is None or not rec.rating_count:
+        return None, 0
+    return rec.rating_sum / rec.rating_count, int(rec.rating_count)
+
+async def backfill_rating_stats() -> int:
+    """Пересобрать rating_stats из ratings (для старых данных). Возвращает число пользователей."""
     async with db() as conn:
-        cur = await conn.execute("SELECT AVG(stars), COUNT(*) FROM ratings WHERE to_user=?", (user_id,))
-        row = await cur.fetchone()
-        avg = float(row[0]) if row and row[0] is not None else None
-        cnt = int(row[1] or 0)
-        return avg, cnt
+        await conn.execute("DELETE FROM rating_stats")
+        cur = await conn.execute(
+            "INSERT INTO rating_stats(user_id, sum, count) "
+            "SELECT to_user, SUM(stars), COUNT(*) FROM ratings GROUP BY to_user"
+        )
+        await conn.commit()
+        n = cur.rowcount
+    USERS.clear()
+    return n
 
 async def last_match_info(user_id: int) -> Optional[tuple[int, int, int]]:
     """
     Возвращает (match_id, peer_id, active) для последнего матча пользователя.
     """
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("""
             SELECT id,a_id,b_id,active FROM matches
             WHERE a_id=? OR b_id=?
@@ -682,17 +784,14 @@ async def last_match_info(user_id: int) -> Optional[tuple[int, int, int]]:
         return mid, peer, active
 
 async def send_post_chat_feedback(user_id: int, peer_id: int, mid: int):
-    try:
-        await bot.send_message(
-            user_id,
-            "Как тебе собеседник? Поставь оценку (1–5) или подай жалобу:",
-            reply_markup=rate_or_complain_kb(mid)
-        )
-    except Exception:
-        pass
+    send_queued(
+        user_id,
+        "Как тебе собеседник? Поставь оценку (1–5) или подай жалобу:",
+        reply_markup=rate_or_complain_kb(mid)
+    )
 
 async def get_status_inventory(user_id: int) -> list[str]:
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute(
             "SELECT title FROM user_statuses WHERE user_id=? ORDER BY title ASC",
             (user_id,)
@@ -712,13 +811,34 @@ async def ensure_free_statuses(user_id: int):
         await conn.commit()
 
 async def ensure_user(tg_id: int):
+    # знакомый пользователь — проверка по set в памяти (usercache.KNOWN_USERS), без SQLite
+    if await KNOWN_USERS.contains(tg_id):
+        return
+    await _create_user(tg_id)
+
+async def _create_user(tg_id: int) -> bool:
+    """Строка users, роль из ADMIN_IDS и бесплатные статусы — одной транзакцией. True, если строка новая."""
     async with db() as conn:
-        await conn.execute("INSERT OR IGNORE INTO users(tg_id) VALUES(?)", (tg_id,))
-        if tg_id in ADMIN_IDS:
-            await conn.execute("UPDATE users SET role='admin' WHERE tg_id=?", (tg_id,))
-        await conn.commit()
-    # NEW: гарантируем бесплатные статусы в инвентаре
-    await ensure_free_statuses(tg_id)
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            cur = await conn.execute("INSERT OR IGNORE INTO users(tg_id) VALUES(?)", (tg_id,))
+            created = cur.rowcount == 1
+            if tg_id in ADMIN_IDS:
+                await conn.execute("UPDATE users SET role='admin' WHERE tg_id=?", (tg_id,))
+            await conn.executemany(
+                "INSERT OR IGNORE INTO user_statuses(user_id, title) VALUES(?,?)",
+                [(tg_id, s) for s in DEFAULT_FREE_STATUSES]
+            )
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+    KNOWN_USERS.add(tg_id)
+    if created:
+        USERS_TOTAL.inc()
+    if tg_id in ADMIN_IDS:
+        USERS.update(tg_id, role="admin")
+    return created
 
 async def set_user_fields(tg_id: int, **kwargs):
     if not kwargs:
@@ -728,15 +848,19 @@ async def set_user_fields(tg_id: int, **kwargs):
     async with db() as conn:
         await conn.execute(f"UPDATE users SET {cols} WHERE tg_id=?", vals)
         await conn.commit()
+    USERS.update(tg_id, **kwargs)
+
+async def _user_record(tg_id: int):
+    ctx = ctx_for(tg_id)
+    if ctx is None:
+        return await USERS.get(tg_id)
+    # запомненная запись годится, пока это та же запись, что в USERS (её правят write-through хелперы)
+    return await ctx.memo("user", lambda: USERS.get(tg_id), lambda rec: USERS.peek(tg_id) is rec)
 
 async def get_user(tg_id: int):
-    async with db() as conn:
-        cur = await conn.execute("""
-            SELECT tg_id,gender,seeking,reveal_ready,first_name,last_name,
-                   faculty,age,about,username,photo1,photo2,photo3
-            FROM users WHERE tg_id=?
-        """, (tg_id,))
-        return await cur.fetchone()
+    # (tg_id,gender,seeking,reveal_ready,first_name,last_name,faculty,age,about,username,photo1,photo2,photo3)
+    rec = await _user_record(tg_id)
+    return rec.profile_row() if rec else None
 
 async def get_user_or_create(tg_id: int):
     u = await get_user(tg_id)
@@ -745,29 +869,25 @@ async def get_user_or_create(tg_id: int):
         u = await get_user(tg_id)
     return u
 
+def is_admin(tg_id: int) -> bool:
+    # роли в памяти (roles.py): users.role='admin' ∪ ADMIN_IDS, в БД не ходим
+    return ROLES.is_admin(tg_id)
+
 async def get_role(tg_id: int) -> str:
-    async with db() as conn:
-        cur = await conn.execute("SELECT role FROM users WHERE tg_id=?", (tg_id,))
-        row = await cur.fetchone()
-        return row[0] if row else "user"
+    return "admin" if is_admin(tg_id) else "user"
 
 async def add_points(tg_id: int, delta: int):
     async with db() as conn:
         await conn.execute("UPDATE users SET points = COALESCE(points,0) + ? WHERE tg_id=?", (delta, tg_id))
         await conn.commit()
+    USERS.add_points(tg_id, delta)
 
 async def get_points(tg_id: int) -> int:
-    async with db() as conn:
-        cur = await conn.execute("SELECT COALESCE(points,0) FROM users WHERE tg_id=?", (tg_id,))
-        row = await cur.fetchone()
-        return int(row[0] if row else 0)
+    rec = await _user_record(tg_id)
+    return int((rec.points if rec else 0) or 0)
 
 async def list_items():
-    async with db() as conn:
-        cur = await conn.execute(
-            "SELECT id,name,price,type,payload FROM shop_items WHERE is_active=1 ORDER BY price ASC, id ASC"
-        )
-        return await cur.fetchall()
+    return await CATALOG.items()  # снимок в памяти (shop.py), сбрасывается add_item/del_item
 
 async def add_item(name: str, price: int, type_: str, payload: str):
     async with db() as conn:
@@ -776,14 +896,16 @@ async def add_item(name: str, price: int, type_: str, payload: str):
             (name, price, type_, payload)
         )
         await conn.commit()
+    CATALOG.invalidate()
 
 async def del_item(item_id: int):
     async with db() as conn:
         await conn.execute("DELETE FROM shop_items WHERE id=?", (item_id,))
         await conn.commit()
+    CATALOG.invalidate()
 
 async def get_item(item_id: int):
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("SELECT id,name,price,type,payload FROM shop_items WHERE id=?", (item_id,))
         return await cur.fetchone()
 
@@ -791,12 +913,11 @@ async def set_status(tg_id: int, title: Optional[str]):
     async with db() as conn:
         await conn.execute("UPDATE users SET status_title=? WHERE tg_id=?", (title, tg_id))
         await conn.commit()
+    USERS.update(tg_id, status_title=title)
 
 async def get_status(tg_id: int) -> Optional[str]:
-    async with db() as conn:
-        cur = await conn.execute("SELECT status_title FROM users WHERE tg_id=?", (tg_id,))
-        row = await cur.fetchone()
-        return row[0] if row and row[0] else None
+    rec = await _user_record(tg_id)
+    return rec.status_title if rec and rec.status_title else None
 
 async def has_required_prefs(tg_id: int) -> bool:
     u = await get_user(tg_id)
@@ -815,24 +936,18 @@ async def register_referral(inviter: int, invited: int) -> bool:
             return False
         await conn.execute("INSERT INTO referrals(inviter, invited) VALUES(?,?)", (inviter, invited))
         await conn.commit()
+    REFERRALS_TOTAL.inc()
     return True
 
 async def count_referrals(inviter: int) -> int:
-    async with db() as conn:
-        await conn.execute(
-            "CREATE TABLE IF NOT EXISTS referrals(inviter INTEGER, invited INTEGER PRIMARY KEY, ts INTEGER DEFAULT (strftime('%s','now')))"
-        )
-        cur = await conn.execute("PRAGMA table_info(referrals)")
-        cols = {r[1] for r in await cur.fetchall()}
-        if "inviter" not in cols:
-            await conn.execute("ALTER TABLE referrals ADD COLUMN inviter INTEGER")
+    async with db_read() as conn:
         cur = await conn.execute("SELECT COUNT(*) FROM referrals WHERE inviter=?", (inviter,))
         row = await cur.fetchone()
         return int(row[0] if row else 0)
 
 async def purchases_summary(user_id: int) -> tuple[int, list[str]]:
     """Возвращает (сумма_по_покупкам, названия_последних_5_покупок)"""
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("""
             SELECT COALESCE(SUM(si.price),0)
             FROM purchases p JOIN shop_items si ON si.id=p.item_id
@@ -849,6 +964,40 @@ async def purchases_summary(user_id: int) -> tuple[int, list[str]]:
         names = [r[0] for r in await cur.fetchall()]
     return total, names
 
+# экран /profile одним запросом (вместо десятка хелперов выше)
+_SEP = "\x1f"
+PROFILE_SQL = """
+    SELECT u.gender, u.seeking, u.reveal_ready, u.username,
+           COALESCE(u.points,0), u.status_title,
+           (SELECT 1.0 * sum / count FROM rating_stats WHERE user_id=u.tg_id AND count>0),
+           (SELECT count FROM rating_stats WHERE user_id=u.tg_id),
+           (SELECT COUNT(*)   FROM referrals WHERE inviter=u.tg_id),
+           (SELECT COALESCE(SUM(si.price),0)
+              FROM purchases p JOIN shop_items si ON si.id=p.item_id
+             WHERE p.user_id=u.tg_id),
+           (SELECT group_concat(name, char(31)) FROM (
+              SELECT si.name FROM purchases p JOIN shop_items si ON si.id=p.item_id
+               WHERE p.user_id=u.tg_id ORDER BY p.ts DESC LIMIT 5)),
+           (SELECT group_concat(title, char(31)) FROM (
+              SELECT title FROM user_statuses WHERE user_id=u.tg_id ORDER BY title ASC))
+    FROM users u WHERE u.tg_id=?
+"""
+
+async def profile_view(user_id: int) -> Optional[dict]:
+    async with db_read() as conn:
+        cur = await conn.execute(PROFILE_SQL, (user_id,))
+        row = await cur.fetchone()
+    if not row:
+        return None
+    return {
+        "gender": row[0], "seeking": row[1], "reveal_ready": row[2], "username": row[3],
+        "points": int(row[4]), "status": row[5] or None,
+        "avg": float(row[6]) if row[6] is not None else None, "rating_cnt": int(row[7] or 0),
+        "ref_cnt": int(row[8] or 0), "spent_total": int(row[9] or 0),
+        "last5": row[10].split(_SEP) if row[10] else [],
+        "inventory": row[11].split(_SEP) if row[11] else [],
+    }
+
 # --- REF-CODES (непрозрачные коды для рефералок) ---
 ALPH = string.ascii_letters + string.digits
 
@@ -865,7 +1014,7 @@ async def get_or_create_ref_code(inviter: int) -> str:
         return code
 
 async def inviter_by_code(code: str) -> Optional[int]:
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("SELECT inviter FROM ref_codes WHERE code=?", (code,))
         row = await cur.fetchone()
         return int(row[0]) if row else None
@@ -874,19 +1023,25 @@ async def inviter_by_code(code: str) -> Optional[int]:
 #                 SUBSCRIPTION (CHANNEL) GATE
 # ============================================================
 
-async def is_subscribed(user_id: int) -> bool:
+async def _check_subscription(user_id: int) -> bool:
+    # реальный запрос к Bot API; ошибки обрабатывает SUBS
     target = RESOLVED_CHANNEL_ID or CHANNEL_USERNAME
-    try:
-        cm = await bot.get_chat_member(target, user_id)
-        status = str(getattr(cm, "status", "")).lower()
-        if status in ("member", "administrator", "creator"):
-            return True
-        if hasattr(cm, "is_member") and bool(getattr(cm, "is_member")):
-            return True
-        return False
-    except Exception as e:
-        print("is_subscribed error:", repr(e))
-        return False
+    cm = await bot.get_chat_member(target, user_id)
+    status = str(getattr(cm, "status", "")).lower()
+    if status in ("member", "administrator", "creator"):
+        return True
+    if hasattr(cm, "is_member") and bool(getattr(cm, "is_member")):
+        return True
+    return False
+
+SUBS.bind(_check_subscription)
+
+async def is_subscribed(user_id: int) -> bool:
+    # через кэш с TTL (см. subscriptions.py) — не дёргаем get_chat_member на каждое нажатие
+    ctx = ctx_for(user_id)
+    if ctx is None:
+        return await SUBS.get(user_id)
+    return await ctx.memo("subscribed", lambda: SUBS.get(user_id))
 
 async def gate_subscription(message: Message) -> bool:
     if await is_subscribed(message.from_user.id):
@@ -905,36 +1060,95 @@ async def gate_subscription(message: Message) -> bool:
 # ============================================================
 
 async def active_peer(tg_id: int) -> Optional[int]:
-    if tg_id in ACTIVE:
-        return ACTIVE[tg_id][0]
-    async with db() as conn:
-        cur = await conn.execute(
-            "SELECT a_id,b_id FROM matches WHERE active=1 AND (a_id=? OR b_id=?) ORDER BY id DESC LIMIT 1",
-            (tg_id, tg_id)
-        )
-        row = await cur.fetchone()
-        if not row:
-            return None
-        a, b = row
-        return b if a == tg_id else a
+    item = ACTIVE.get(tg_id)
+    return item[0] if item else None
 
 async def end_current_chat(tg_id: int):
     async with db() as conn:
         await conn.execute("UPDATE matches SET active=0 WHERE active=1 AND (a_id=? OR b_id=?)", (tg_id, tg_id))
         await conn.commit()
+    item = ACTIVE.get(tg_id)
+    if item:
+        _cleanup_match(item[1], tg_id, item[0])  # RAM следует за БД сразу после commit
+
+async def load_active_sessions() -> int:
+    """Поднять ACTIVE из matches WHERE active=1 (при старте). Если у пользователя
+    несколько активных матчей, живым остаётся последний, остальные гасим.
+    Дедлайн считаем от сохранённой активности (ACTIVITY), а не с нуля."""
+    ACTIVE.clear()
+    async with db_read() as conn:
+        cur = await conn.execute(
+            "SELECT id, a_id, b_id, COALESCE(last_activity, started_at, 0) FROM matches WHERE active=1 ORDER BY id DESC"
+        )
+        rows = await cur.fetchall()
+    stale = []
+    now_wall, now_m = _now(), _nowm()
+    for mid, a, b, last in rows:
+        mid, a, b = int(mid), int(a), int(b)
+        if a in ACTIVE or b in ACTIVE:
+            stale.append((mid,))
+            continue
+        ACTIVE[a] = (b, mid)
+        ACTIVE[b] = (a, mid)
+        idle = max(0.0, now_wall - float(last or now_wall))
+        DEADLINE[mid] = now_m + g_inactivity() - idle  # уже истёк — таймер сработает сразу
+        _arm_match_timer(mid, a, b)
+    if stale:
+        async with db() as conn:
+            await conn.executemany("UPDATE matches SET active=0 WHERE id=?", stale)
+            await conn.commit()
+    return len(ACTIVE) // 2
+
+async def check_active_consistency() -> list[str]:
+    """Сверка ACTIVE с matches WHERE active=1; пустой список — всё сходится."""
+    async with db_read() as conn:
+        cur = await conn.execute("SELECT id, a_id, b_id FROM matches WHERE active=1")
+        rows = await cur.fetchall()
+    problems = []
+    expected: Dict[int, Tuple[int, int]] = {}
+    for mid, a, b in rows:
+        mid, a, b = int(mid), int(a), int(b)
+        for u, p in ((a, b), (b, a)):
+            if u in expected:
+                problems.append(f"user {u}: несколько активных матчей ({expected[u][1]}, {mid})")
+            expected[u] = (p, mid)
+    for u, item in expected.items():
+        if ACTIVE.get(u) != item:
+            problems.append(f"user {u}: в БД {item}, в памяти {ACTIVE.get(u)}")
+    for u, item in ACTIVE.items():
+        if u not in expected:
+            problems.append(f"user {u}: в памяти {item}, в БД активного матча нет")
+        elif ACTIVE.get(item[0], (None, None))[0] != u:
+            problems.append(f"user {u}: собеседник {item[0]} не ссылается обратно")
+    return problems
+
+# последняя сверка ACTIVE с БД — её показывает admin_stats (сам по matches не ходит)
+CONSISTENCY_INTERVAL = 600
+LAST_DRIFT: list[str] = []
+LAST_DRIFT_TS: Optional[float] = None
+
+async def refresh_active_consistency() -> list[str]:
+    global LAST_DRIFT, LAST_DRIFT_TS
+    LAST_DRIFT = await check_active_consistency()
+    LAST_DRIFT_TS = time.time()
+    if LAST_DRIFT:
+        print("[consistency] ACTIVE drift:", len(LAST_DRIFT), LAST_DRIFT[:5])
+    return LAST_DRIFT
+
+async def run_consistency_checker(interval: float = CONSISTENCY_INTERVAL) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await refresh_active_consistency()
+        except Exception as e:
+            print("[consistency] check failed:", repr(e))
 
 async def enqueue(tg_id: int, gender: str, seeking: str):
-    async with db() as conn:
-        await conn.execute(
-            "INSERT OR REPLACE INTO queue(tg_id, gender, seeking, ts) VALUES(?,?,?,strftime('%s','now'))",
-            (tg_id, gender, seeking)
-        )
-        await conn.commit()
+    # очередь живёт в памяти; таблица queue дописывается фоном (MATCHMAKER.flush)
+    MATCHMAKER.add(tg_id, gender, seeking)
 
 async def dequeue(tg_id: int):
-    async with db() as conn:
-        await conn.execute("DELETE FROM queue WHERE tg_id=?", (tg_id,))
-        await conn.commit()
+    MATCHMAKER.remove(tg_id)
 
 async def record_separation(a: int, b: int):
     async with db() as conn:
@@ -961,7 +1175,7 @@ async def decay_blocks(u_id: int):
         await conn.commit()
 
 async def is_recent_blocked(u_id: int, candidate_id: int) -> bool:
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute(
             "SELECT 1 FROM recent_partners WHERE u_id=? AND partner_id=? AND block_left>0",
             (u_id, candidate_id)
@@ -969,9 +1183,7 @@ async def is_recent_blocked(u_id: int, candidate_id: int) -> bool:
         return (await cur.fetchone()) is not None
 
 async def in_queue(tg_id: int) -> bool:
-    async with db() as conn:
-        cur = await conn.execute("SELECT 1 FROM queue WHERE tg_id=?", (tg_id,))
-        return (await cur.fetchone()) is not None
+    return tg_id in MATCHMAKER
 
 def format_profile_text(u: tuple) -> str:
     """
@@ -1003,39 +1215,34 @@ def format_profile_text(u: tuple) -> str:
     return header + body + tail
 
 async def find_partner(for_id: int) -> Optional[int]:
-    async with db() as conn:
-        cur = await conn.execute("SELECT gender,seeking FROM users WHERE tg_id=?", (for_id,))
-        me = await cur.fetchone()
-        if not me:
-            return None
-        my_gender, my_seek = me
-
-        cur = await conn.execute("""
-            SELECT q.tg_id
-            FROM queue q
-            JOIN users u ON u.tg_id = q.tg_id
-            LEFT JOIN recent_partners rp
-                   ON rp.u_id=? AND rp.partner_id=q.tg_id AND rp.block_left>0
-            WHERE q.tg_id<>?
-              AND ((?='Не важно') OR u.gender=CASE ? WHEN 'Парни' THEN 'Парень' WHEN 'Девушки' THEN 'Девушка' END)
-              AND (u.seeking='Не важно' OR u.seeking=CASE ? WHEN 'Парень' THEN 'Парни' WHEN 'Девушка' THEN 'Девушки' END)
-              AND rp.partner_id IS NULL
-            ORDER BY q.ts ASC
-            LIMIT 1
-        """, (for_id, for_id, my_seek, my_seek, my_gender))
-        row = await cur.fetchone()
-        if not row:
+    """
+    Ищет самого давнего совместимого собеседника в очереди (MATCHMAKER)
+    и сразу снимает обоих с поиска, чтобы его не перехватил параллельный /find.
+    """
+    key = MATCHMAKER.entry(for_id)
+    if key is None:
+        me = await _user_record(for_id)
+        if not me or not me.gender or not me.seeking:
             return None
-        return int(row[0])
+        key = (me.gender, me.seeking)
+    async with db_read() as conn:
+        cur = await conn.execute(
+            "SELECT partner_id FROM recent_partners WHERE u_id=? AND block_left>0", (for_id,)
+        )
+        blocked = {int(r[0]) for r in await cur.fetchall()}
+    my_gender, my_seek = key
+    return MATCHMAKER.claim(for_id, my_gender, my_seek, blocked)
 
 async def start_match(a: int, b: int):
     await decay_blocks(a)
     await decay_blocks(b)
+    MATCHMAKER.remove(a)
+    MATCHMAKER.remove(b)
     async with db() as conn:
-        await conn.execute("DELETE FROM queue WHERE tg_id IN (?,?)", (a, b))
         cur = await conn.execute("INSERT INTO matches(a_id,b_id) VALUES(?,?)", (a, b))
         mid = cur.lastrowid
         await conn.commit()
+    MATCHES_TOTAL.inc()
 
     ACTIVE[a] = (b, mid)
     ACTIVE[b] = (a, mid)
@@ -1043,7 +1250,7 @@ async def start_match(a: int, b: int):
     LAST_SEEN[b] = _now()
     DEADLINE[mid] = _nowm() + g_inactivity()
     LAST_SHOWN.pop(mid, None)
-    WATCH[mid] = asyncio.create_task(_watch_inactivity(mid, a, b))
+    _arm_match_timer(mid, a, b)
 
     sa = await get_status(a)
     sb = await get_status(b)
@@ -1069,8 +1276,8 @@ async def start_match(a: int, b: int):
             "<code>!reveal</code> — взаимное раскрытие (если анкеты есть у обоих)\n"
         )
 
-    await bot.send_message(a, greet_line(sb, fmt(pa, pcnt), fmt(ma, mcnt)), reply_markup=ReplyKeyboardRemove())
-    await bot.send_message(b, greet_line(sa, fmt(pb, bcnt), fmt(mb, bmcnt)), reply_markup=ReplyKeyboardRemove())
+    send_queued(a, greet_line(sb, fmt(pa, pcnt), fmt(ma, mcnt)), reply_markup=ReplyKeyboardRemove())
+    send_queued(b, greet_line(sa, fmt(pb, bcnt), fmt(mb, bmcnt)), reply_markup=ReplyKeyboardRemove())
 
 async def try_match_now(tg_id: int):
     mate = await find_partner(tg_id)
@@ -1078,168 +1285,112 @@ async def try_match_now(tg_id: int):
         await start_match(tg_id, mate)
 
 async def _materialize_session_if_needed(user_id: int) -> Optional[Tuple[int, int]]:
-    if user_id in ACTIVE:
-        peer_id, mid = ACTIVE[user_id]
-        if mid not in WATCH or WATCH[mid].done():
-            a = user_id
-            b = peer_id
-            WATCH[mid] = asyncio.create_task(_watch_inactivity(mid, a, b))
-        return ACTIVE[user_id]
-
-    async with db() as conn:
-        cur = await conn.execute(
-            "SELECT id, a_id, b_id FROM matches WHERE active=1 AND (a_id=? OR b_id=?) ORDER BY id DESC LIMIT 1",
-            (user_id, user_id),
-        )
-        row = await cur.fetchone()
-
-    if not row:
+    # сессии целиком в RAM (load_active_sessions); тут лишь страхуемся, что таймер заведён
+    item = ACTIVE.get(user_id)
+    if item is None:
         return None
-
-    mid, a, b = int(row[0]), int(row[1]), int(row[2])
-    peer = b if a == user_id else a
-
-    ACTIVE[a] = (b, mid)
-    ACTIVE[b] = (a, mid)
-    now_wall = _now()
-    LAST_SEEN[a] = now_wall
-    LAST_SEEN[b] = now_wall
-    DEADLINE[mid] = _nowm() + g_inactivity()
-    LAST_SHOWN.pop(mid, None)
-    if mid not in WATCH or WATCH[mid].done():
-        WATCH[mid] = asyncio.create_task(_watch_inactivity(mid, a, b))
-
-    return (peer, mid)
+    peer_id, mid = item
+    if mid not in TIMERS:
+        DEADLINE.setdefault(mid, _nowm() + g_inactivity())
+        _arm_match_timer(mid, user_id, peer_id)
+    return item
 
 # ============================================================
 #                   INACTIVITY WATCHER & COUNTDOWN
 # ============================================================
 
-async def _watch_inactivity(mid: int, a: int, b: int):
-    try:
-        while True:
-            await asyncio.sleep(1)
-            if a not in ACTIVE or b not in ACTIVE:
-                return
-            if ACTIVE.get(a, (None, None))[1] != mid or ACTIVE.get(b, (None, None))[1] != mid:
-                return
+WARN_BEFORE = 60  # за сколько секунд до авто-завершения предупреждаем
+
+def _arm_match_timer(mid: int, a: int, b: int):
+    """
+    Поставить/сдвинуть таймер матча в общем планировщике TIMERS.
+    До предупреждения будим только в момент DEADLINE-60, во время
+    обратного отсчёта — раз в секунду (чтобы обновлять сообщение).
+    Продление дедлайна — O(1): запись в куче переложится сама.
+    """
+    deadline = DEADLINE.get(mid)
+    if deadline is None:
+        deadline = DEADLINE[mid] = _nowm() + g_inactivity()
+    if WARNED.get(mid):
+        when = min(deadline, _nowm() + 1)
+    else:
+        when = deadline - WARN_BEFORE
+    TIMERS.schedule(mid, when, _on_match_timer, mid, a, b)
 
-            now = _nowm()
-            deadline = DEADLINE.get(mid, now + g_inactivity())
-            remaining = ceil(deadline - now)
+async def _on_match_timer(mid: int, a: int, b: int):
+    # если матч уже не активен — ничего не делаем
+    if ACTIVE.get(a, (None, None))[1] != mid or ACTIVE.get(b, (None, None))[1] != mid:
+        return
 
-            if 0 < remaining <= 60 and not WARNED.get(mid):
-                WARNED[mid] = True
-                warn_text = (
-                    f"⌛️ Тишина… Чат автоматически завершится через {remaining} сек.\n"
-                    f"Напиши любое сообщение, чтобы продолжить разговор."
-                )
-                try:
-                    ma = await bot.send_message(a, warn_text)
-                    mb = await bot.send_message(b, warn_text)
-                    COUNTDOWN_MSGS[mid] = (ma.message_id, mb.message_id)
-                except Exception:
-                    COUNTDOWN_MSGS[mid] = (None, None)
-                COUNTDOWN_TASKS[mid] = asyncio.create_task(_countdown(mid, a, b))
+    now = _nowm()
+    deadline = DEADLINE.get(mid, now + g_inactivity())
+    remaining = ceil(deadline - now)
 
-            if remaining <= 0:
-                await _stop_countdown(mid, a, b, delete_msgs=True)
-                await end_current_chat(a)
-                await end_current_chat(b)
-                _cleanup_match(mid, a, b)
-                DEADLINE.pop(mid, None)
-                LAST_SHOWN.pop(mid, None)
-                try:
-                    await bot.send_message(a, "Чат завершён из-за неактивности.", reply_markup=(await menu_for(a)))
-                    await send_post_chat_feedback(a, b, mid)
-                    await send_post_chat_feedback(b, a, mid)
-                except Exception:
-                    pass
-                try:
-                    await bot.send_message(b, "Чат завершён из-за неактивности.", reply_markup=(await menu_for(b)))
-                    await send_post_chat_feedback(a, b, mid)
-                    await send_post_chat_feedback(b, a, mid)
-                except Exception:
-                    pass
-                return
-    except asyncio.CancelledError:
+    if remaining <= 0:
+        await _stop_countdown(mid, a, b, delete_msgs=True)
+        await end_current_chat(a)
+        await end_current_chat(b)
+        _cleanup_match(mid, a, b)
+        send_queued(a, "Чат завершён из-за неактивности.", reply_markup=(await menu_for(a)))
+        send_queued(b, "Чат завершён из-за неактивности.", reply_markup=(await menu_for(b)))
+        await send_post_chat_feedback(a, b, mid)
+        await send_post_chat_feedback(b, a, mid)
         return
 
+    if remaining > WARN_BEFORE:
+        # дедлайн успели продлить — снимаем отсчёт и ждём следующей точки предупреждения
+        if WARNED.get(mid):
+            await _stop_countdown(mid, a, b, delete_msgs=True)
+    elif not WARNED.get(mid):
+        WARNED[mid] = True
+        LAST_SHOWN[mid] = remaining
+        warn_text = (
+            f"⌛️ Тишина… Чат автоматически завершится через {remaining} сек.\n"
+            f"Напиши любое сообщение, чтобы продолжить разговор."
+        )
+        # оба предупреждения уходят параллельно; id нужны для последующих правок
+        ra, rb = await asyncio.gather(send_queued(a, warn_text), send_queued(b, warn_text), return_exceptions=True)
+        COUNTDOWN_MSGS[mid] = (
+            None if isinstance(ra, BaseException) else ra.message_id,
+            None if isinstance(rb, BaseException) else rb.message_id,
+        )
+    elif LAST_SHOWN.get(mid) != remaining:
+        LAST_SHOWN[mid] = remaining
+        ids = COUNTDOWN_MSGS.get(mid)
+        if ids:
+            a_msg, b_msg = ids
+            text = f"⌛️ Тишина… Осталось {remaining} сек.\nНапиши, чтобы продолжить."
+            # правки отсчёта не ждём: если очередь занята, следующий тик просто обгонит их
+            if a_msg:
+                OUTBOX.submit(a, lambda: bot.edit_message_text(chat_id=a, message_id=a_msg, text=text))
+            if b_msg:
+                OUTBOX.submit(b, lambda: bot.edit_message_text(chat_id=b, message_id=b_msg, text=text))
+
+    # за время отправки матч мог завершиться
+    if ACTIVE.get(a, (None, None))[1] == mid:
+        _arm_match_timer(mid, a, b)
+
 def _cleanup_match(mid: int, a: int, b: int):
     ACTIVE.pop(a, None)
     ACTIVE.pop(b, None)
     LAST_SEEN.pop(a, None)
     LAST_SEEN.pop(b, None)
-    t = WATCH.pop(mid, None)
+    TIMERS.cancel(mid)
+    ACTIVITY.forget(mid)
     DEADLINE.pop(mid, None)
     LAST_SHOWN.pop(mid, None)
-    if t and not t.done():
-        t.cancel()
     WARNED.pop(mid, None)
-
-    t2 = COUNTDOWN_TASKS.pop(mid, None)
-    if t2 and not t2.done():
-        t2.cancel()
     COUNTDOWN_MSGS.pop(mid, None)
 
-async def _countdown(mid: int, a: int, b: int):
-    try:
-        while True:
-            await asyncio.sleep(1)
-            if a not in ACTIVE or b not in ACTIVE:
-                return
-            if ACTIVE.get(a, (None, None))[1] != mid or ACTIVE.get(b, (None, None))[1] != mid:
-                return
-
-            now = _nowm()
-            deadline = DEADLINE.get(mid, now + g_inactivity())
-            remaining = ceil(deadline - now)
-
-            if remaining > 60:
-                await _stop_countdown(mid, a, b, delete_msgs=True)
-                return
-            if remaining <= 0:
-                return
-            if LAST_SHOWN.get(mid) == remaining:
-                continue
-            LAST_SHOWN[mid] = remaining
-
-            ids = COUNTDOWN_MSGS.get(mid)
-            if ids:
-                a_msg, b_msg = ids
-                text = f"⌛️ Тишина… Осталось {remaining} сек.\nНапиши, чтобы продолжить."
-                try:
-                    if a_msg:
-                        await bot.edit_message_text(chat_id=a, message_id=a_msg, text=text)
-                except Exception:
-                    pass
-                try:
-                    if b_msg:
-                        await bot.edit_message_text(chat_id=b, message_id=b_msg, text=text)
-                except Exception:
-                    pass
-    except asyncio.CancelledError:
-        return
-
 async def _stop_countdown(mid: int, a: int, b: int, delete_msgs: bool = True):
-    t = COUNTDOWN_TASKS.pop(mid, None)
-    if t and not t.done():
-        t.cancel()
-
     ids = COUNTDOWN_MSGS.pop(mid, None)
+    WARNED.pop(mid, None)
     if delete_msgs and ids:
         a_msg, b_msg = ids
-        try:
-            if a_msg:
-                await bot.delete_message(chat_id=a, message_id=a_msg)
-        except Exception:
-            pass
-        try:
-            if b_msg:
-                await bot.delete_message(chat_id=b, message_id=b_msg)
-        except Exception:
-            pass
-    WARNED.pop(mid, None)
+        if a_msg:
+            OUTBOX.submit(a, lambda: bot.delete_message(chat_id=a, message_id=a_msg))
+        if b_msg:
+            OUTBOX.submit(b, lambda: bot.delete_message(chat_id=b, message_id=b_msg))
 
 # ============================================================
 #                    MISC HELPERS (FORM ETC.)
@@ -1270,7 +1421,7 @@ async def cb_rate(c: CallbackQuery):
         return await c.answer("Некорректная оценка.", show_alert=True)
 
     # проверяем, что пользователь был участником этого матча и узнаём peer
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("SELECT a_id,b_id FROM matches WHERE id=?", (mid,))
         row = await cur.fetchone()
     if not row:
@@ -1282,14 +1433,23 @@ async def cb_rate(c: CallbackQuery):
 
     to_user = b_id if c.from_user.id == a_id else a_id
 
-    # пишем/фиксируем оценку (один раз за матч)
+    # пишем/фиксируем оценку (один раз за матч) и тут же обновляем агрегат
     try:
         async with db() as conn:
-            await conn.execute(
+            cur = await conn.execute(
                 "INSERT OR IGNORE INTO ratings(match_id,from_user,to_user,stars) VALUES(?,?,?,?)",
                 (mid, c.from_user.id, to_user, stars)
             )
+            inserted = cur.rowcount == 1
+            if inserted:
+                await conn.execute(
+                    "INSERT INTO rating_stats(user_id, sum, count) VALUES(?,?,1) "
+                    "ON CONFLICT(user_id) DO UPDATE SET sum=sum+excluded.sum, count=count+1",
+                    (to_user, stars)
+                )
             await conn.commit()
+        if inserted:
+            USERS.add_rating(to_user, stars)
     except Exception:
         pass
 
@@ -1303,7 +1463,7 @@ async def cb_rate(c: CallbackQuery):
 async def cb_complain(c: CallbackQuery, state: FSMContext):
     mid = int(c.data.split(":")[1])
 
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("SELECT a_id,b_id FROM matches WHERE id=?", (mid,))
         row = await cur.fetchone()
     if not row:
@@ -1321,7 +1481,9 @@ async def cb_complain(c: CallbackQuery, state: FSMContext):
         pass
 
 @dp.callback_query(F.data == "sub_check")
-async def sub_check(c: CallbackQuery):
+async def sub_check(c: CallbackQuery, ctx: UpdateContext):
+    SUBS.invalidate(c.from_user.id)  # пользователь говорит, что подписался — проверяем заново
+    ctx.forget("subscribed")
     if await is_subscribed(c.from_user.id):
         try:
             await c.message.edit_text("✅ Спасибо за подписку!")
@@ -1339,33 +1501,35 @@ async def sub_check(c: CallbackQuery):
 
 @dp.callback_query(F.data.startswith("shop_buy:"))
 async def shop_buy(c: CallbackQuery):
-    if await get_role(c.from_user.id) == "admin":
+    if is_admin(c.from_user.id):
         await c.answer("Админ не может покупать товары.", show_alert=True)
         return
     item_id = int(c.data.split(":")[1])
-    item = await get_item(item_id)
-    if not item:
+    # ключ — сообщение магазина + товар: повторные тапы по той же кнопке не спишут дважды
+    # (после покупки кнопки убираются, новая покупка — из нового сообщения магазина)
+    key = f"{c.from_user.id}:{c.message.message_id}:{item_id}" if c.message else f"cb:{c.id}"
+    res = await PURCHASES.buy(c.from_user.id, item_id, key)
+    if res.status == DUPLICATE:
+        await c.answer("Эта покупка уже оформлена.")
+        return
+    if res.status == NO_ITEM:
         await c.answer("Товар уже недоступен.", show_alert=True)
         return
-    _id, name, price, type_, payload = item
-    pts = await get_points(c.from_user.id)
-    if pts < price:
-        await c.answer(f"Не хватает очков. Нужно {price}, у тебя {pts}.", show_alert=True)
+    _id, name, price, type_, payload = res.item
+    if res.status == NO_FUNDS:
+        USERS.update(c.from_user.id, points=res.balance)
+        await c.answer(f"Не хватает очков. Нужно {price}, у тебя {res.balance}.", show_alert=True)
         return
 
-    await add_points(c.from_user.id, -price)
+    USERS.update(c.from_user.id, points=res.balance)
+    if res.title:
+        USERS.update(c.from_user.id, status_title=res.title)
     applied_msg = ""
     if type_ == "status":
-        # Кладём в инвентарь и сразу экипируем
-        await add_status_to_inventory(c.from_user.id, payload)
-        await set_status(c.from_user.id, payload)
-        applied_msg = f"Теперь твой статус: «{payload}». (Добавлен в инвентарь)"
+        applied_msg = f"Теперь твой статус: «{res.title}». (Добавлен в инвентарь)"
     elif type_ == "privilege":
         applied_msg = f"Привилегия активирована: {payload}"
-    async with db() as conn:
-        await conn.execute("INSERT INTO purchases(user_id,item_id) VALUES(?,?)", (c.from_user.id, _id))
-        await conn.commit()
-    new_pts = await get_points(c.from_user.id)
+    new_pts = res.balance
     try:
         await c.message.edit_text(
             f"✅ Покупка «{name}» за {price}💰 успешна!\n{applied_msg}\nБаланс: {new_pts}.", reply_markup=None
@@ -1380,8 +1544,8 @@ async def shop_buy(c: CallbackQuery):
 
 @dp.message(F.text.in_({"🧭 Режимы", "👤 Анкета", "🆘 Поддержка", "📇 Просмотр анкет",
                         "🕵️ Анонимный чат", "💰 Баланс", "⭐️ Оценить собеседника", "🚩 Пожаловаться"}))
-async def block_menu_buttons_in_chat(m: Message):
-    if await is_chat_active(m.from_user.id):
+async def block_menu_buttons_in_chat(m: Message, ctx: UpdateContext):
+    if ctx.in_chat:
         # Ничего не делаем, чтобы relay_chat обработал сообщение как обычный текст
         raise SkipHandler
     # если чата нет — этот хэндлер пропускаем, чтобы сработали целевые обработчики
@@ -1400,16 +1564,13 @@ async def complaint_text(m: Message, state: FSMContext):
         )
         await conn.commit()
 
-    # шлём админам
+    # шлём админам (через очередь — хэндлер не ждёт доставки)
     for admin_id in (ADMIN_IDS or []):
-        try:
-            await bot.send_message(
-                admin_id,
-                f"🚩 Жалоба от <code>{m.from_user.id}</code> на <code>{about_id}</code>\n"
-                f"Матч: <code>{mid}</code>\n\n{text}"
-            )
-        except Exception:
-            pass
+        send_queued(
+            admin_id,
+            f"🚩 Жалоба от <code>{m.from_user.id}</code> на <code>{about_id}</code>\n"
+            f"Матч: <code>{mid}</code>\n\n{text}"
+        )
 
     await state.clear()
     await m.answer("Жалоба отправлена админам. Спасибо!", reply_markup=(await menu_for(m.from_user.id)))
@@ -1424,7 +1585,7 @@ async def rate_from_menu(m: Message):
     mid, peer, _active = info
 
     # проверим, не оценивал ли уже этот матч
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("SELECT 1 FROM ratings WHERE match_id=? AND from_user=?", (mid, m.from_user.id))
         done = await cur.fetchone()
     if done:
@@ -1445,8 +1606,8 @@ async def complain_from_menu(m: Message, state: FSMContext):
     await m.answer("Опиши жалобу одним сообщением. Чем подробнее — тем лучше.", reply_markup=cancel_kb())
 
 @dp.message(F.text.regexp(r"^/"))
-async def block_slash_cmds_in_chat(m: Message):
-    if await is_chat_active(m.from_user.id):
+async def block_slash_cmds_in_chat(m: Message, ctx: UpdateContext):
+    if ctx.in_chat:
         await _materialize_session_if_needed(m.from_user.id)
         await m.answer(BLOCK_TXT, reply_markup=ReplyKeyboardRemove())
         return
@@ -1465,6 +1626,7 @@ async def cmd_start(m: Message, state: FSMContext):
         return
 
     await ensure_user(m.from_user.id)
+    await mark_unblocked(m.from_user.id)  # снова получает рассылки, если раньше блокировал бота
 
     # deep-link /start ref_<id>
     try:
@@ -1528,21 +1690,24 @@ async def cmd_profile(m: Message):
         return
 
     await ensure_user(m.from_user.id)
-    u = await get_user_or_create(m.from_user.id)
-    await ensure_free_statuses(m.from_user.id)  # гарантируем бесплатные статусы
-    pts = await get_points(m.from_user.id)
-    status = await get_status(m.from_user.id) or "—"
-    avg, cnt = await get_avg_rating(m.from_user.id)
+    p = await profile_view(m.from_user.id)
+    # бесплатные статусы докладываем, только если их действительно нет в инвентаре
+    inv = p["inventory"]
+    if any(s not in inv for s in DEFAULT_FREE_STATUSES):
+        await ensure_free_statuses(m.from_user.id)
+        inv = sorted(set(inv) | set(DEFAULT_FREE_STATUSES))
+    pts = p["points"]
+    status = p["status"] or "—"
+    avg, cnt = p["avg"], p["rating_cnt"]
     rate_line = f"• Рейтинг: {avg:.1f} ({cnt})" if avg is not None else "• Рейтинг: — (0)"
-    ref_cnt = await count_referrals(m.from_user.id)
-    spent_total, last5 = await purchases_summary(m.from_user.id)
+    ref_cnt = p["ref_cnt"]
+    spent_total, last5 = p["spent_total"], p["last5"]
 
-    gender = u[1] or "—"
-    seeking = u[2] or "—"
-    ready = "Да" if (u[3] == 1) else "Нет"
-    uname = u[9] or "—"
+    gender = p["gender"] or "—"
+    seeking = p["seeking"] or "—"
+    ready = "Да" if (p["reveal_ready"] == 1) else "Нет"
+    uname = p["username"] or "—"
 
-    inv = await get_status_inventory(m.from_user.id)
     inv_txt = "нет" if not inv else ", ".join(inv)
 
     lines = [
@@ -1567,19 +1732,19 @@ async def cmd_profile(m: Message):
         lines.append("\n<b>Последние покупки:</b>")
         lines += [f"• {n}" for n in last5]
 
-    kb = statuses_kb(inv, await get_status(m.from_user.id)) if inv else None
+    kb = statuses_kb(inv, p["status"]) if inv else None
     await m.answer("\n".join(lines), reply_markup=kb or (await menu_for(m.from_user.id)))
 
 @dp.message(Command("market"))
 async def cmd_market(m: Message):
     if await deny_actions_during_chat(m):
         return
-    if await get_role(m.from_user.id) == "admin":
+    if is_admin(m.from_user.id):
         return await m.answer("Ты админ и не можешь покупать. Используй /admin.", reply_markup=(await menu_for(m.from_user.id)))
     items = await list_items()
     if not items:
         return await m.answer("🛍 Магазин пока пуст.", reply_markup=(await menu_for(m.from_user.id)))
-    await m.answer("🛍 Магазин статусов и привилегий. Выбери товар:", reply_markup=shop_kb(items))
+    await m.answer("🛍 Магазин статусов и привилегий. Выбери товар:", reply_markup=await CATALOG.view("market", shop_kb))
 
 @dp.message(Command("ref"))
 async def cmd_ref(m: Message):
@@ -1631,10 +1796,8 @@ async def can_take_daily_cooldown(tg_id: int) -> tuple[bool, int]:
     Возвращает (can_take, remaining_seconds).
     can_take == True, если с последнего забора прошло >= 24 часов.
     """
-    async with db() as conn:
-        cur = await conn.execute("SELECT COALESCE(last_daily, 0) FROM users WHERE tg_id=?", (tg_id,))
-        row = await cur.fetchone()
-        last = int(row[0] if row else 0)
+    rec = await _user_record(tg_id)
+    last = int((rec.last_daily if rec else 0) or 0)
 
     if last == 0:
         return True, 0
@@ -1652,15 +1815,22 @@ async def admin_panel(m: Message, state: FSMContext):
     if await deny_actions_during_chat(m):
         return
     await ensure_user(m.from_user.id)
-    if await get_role(m.from_user.id) != "admin" and m.from_user.id not in ADMIN_IDS:
+    if not is_admin(m.from_user.id):
         await m.answer("Доступ запрещён.")
         return
     await state.clear()
     await m.answer("🛠 Панель администратора", reply_markup=admin_main_kb())
 
+@dp.message(Command("rating_backfill"))
+async def admin_rating_backfill(m: Message):
+    if not is_admin(m.from_user.id):
+        return await m.answer("Доступ запрещён.")
+    n = await backfill_rating_stats()
+    await m.answer(f"⭐️ rating_stats пересобран: {n} пользователей.")
+
 @dp.callback_query(F.data == "admin:home")
 async def admin_home(c: CallbackQuery, state: FSMContext):
-    if await get_role(c.from_user.id) != "admin" and c.from_user.id not in ADMIN_IDS:
+    if not is_admin(c.from_user.id):
         return await c.answer("Нет доступа.", show_alert=True)
     await state.clear()
     await safe_edit_message(c.message, text="🛠 Панель администратора", reply_markup=admin_main_kb())
@@ -1686,28 +1856,27 @@ async def cb_use_status(c: CallbackQuery):
 
 @dp.callback_query(F.data == "admin:shop")
 async def admin_shop(c: CallbackQuery, state: FSMContext):
-    if await get_role(c.from_user.id) != "admin" and c.from_user.id not in ADMIN_IDS:
+    if not is_admin(c.from_user.id):
         return await c.answer("Нет доступа.", show_alert=True)
     await safe_edit_message(c.message, text="🛍 Магазин", reply_markup=admin_shop_kb())
 
 @dp.callback_query(F.data == "admin:shop:list")
 async def admin_shop_list(c: CallbackQuery):
-    if await get_role(c.from_user.id) != "admin" and c.from_user.id not in ADMIN_IDS:
+    if not is_admin(c.from_user.id):
         return
-    items = await list_items()
-    txt = "📦 Товары:\n" + ("\n".join([f"{i[0]}. {i[1]} — {i[2]}💰 [{i[3]}] {i[4] or ''}" for i in items]) or "пусто")
+    txt = await CATALOG.view("admin_list", admin_items_text)
     await safe_edit_message(c.message, text=txt, reply_markup=admin_shop_kb())
 
 @dp.callback_query(F.data == "admin:shop:add")
 async def admin_shop_add(c: CallbackQuery, state: FSMContext):
-    if await get_role(c.from_user.id) != "admin" and c.from_user.id not in ADMIN_IDS:
+    if not is_admin(c.from_user.id):
         return
     await state.set_state(AdminAddItem.wait_name)
     await c.message.edit_text("🧩 Шаг 1/4: Введи название товара\n\nНапример: <code>Самый Скромный</code>")
 
 @dp.callback_query(F.data == "admin:grant")
 async def admin_grant_start(c: CallbackQuery, state: FSMContext):
-    if await get_role(c.from_user.id) != "admin" and c.from_user.id not in ADMIN_IDS:
+    if not is_admin(c.from_user.id):
         return await c.answer("Нет доступа.", show_alert=True)
     await state.set_state(AdminGrantPoints.wait_user_id)
     await c.message.edit_text("💳 Кому начислить очки? Введи <code>tg_id</code> пользователя.")
@@ -1715,7 +1884,7 @@ async def admin_grant_start(c: CallbackQuery, state: FSMContext):
 
 @dp.message(AdminGrantPoints.wait_user_id)
 async def admin_grant_user(m: Message, state: FSMContext):
-    if await get_role(m.from_user.id) != "admin" and m.from_user.id not in ADMIN_IDS:
+    if not is_admin(m.from_user.id):
         await state.clear()
         return await m.answer("Нет доступа.")
     try:
@@ -1730,7 +1899,7 @@ async def admin_grant_user(m: Message, state: FSMContext):
 
 @dp.message(AdminGrantPoints.wait_amount)
 async def admin_grant_amount(m: Message, state: FSMContext):
-    if await get_role(m.from_user.id) != "admin" and m.from_user.id not in ADMIN_IDS:
+    if not is_admin(m.from_user.id):
         await state.clear()
         return await m.answer("Нет доступа.")
     try:
@@ -1750,14 +1919,14 @@ async def admin_grant_amount(m: Message, state: FSMContext):
     await m.answer(f"✅ Готово. Пользователь <code>{uid}</code>: изменение {amount} очков. Текущий баланс: {new_pts}.",
                    reply_markup=admin_main_kb())
 
+@lru_cache(maxsize=None)
 def admin_reply_menu() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="🛠 Админ"))
     return kb.as_markup(resize_keyboard=True)
 
 async def menu_for(user_id: int) -> ReplyKeyboardMarkup:
-    role = await get_role(user_id)
-    if role == "admin" or user_id in ADMIN_IDS:
+    if is_admin(user_id):
         return admin_reply_menu()
     return main_menu()
 
@@ -1800,7 +1969,7 @@ async def admin_shop_add_payload(m: Message, state: FSMContext):
 
 @dp.callback_query(F.data == "admin:shop:del")
 async def admin_shop_del(c: CallbackQuery, state: FSMContext):
-    if await get_role(c.from_user.id) != "admin" and c.from_user.id not in ADMIN_IDS:
+    if not is_admin(c.from_user.id):
         return
     await state.set_state(AdminShopDel.wait_id)
     await c.message.edit_text("Отправь ID товара, который удалить (см. «📦 Список»).")
@@ -1816,14 +1985,14 @@ async def admin_shop_del_id(m: Message, state: FSMContext):
 
 @dp.callback_query(F.data == "admin:settings")
 async def admin_settings(c: CallbackQuery, state: FSMContext):
-    if await get_role(c.from_user.id) != "admin" and c.from_user.id not in ADMIN_IDS:
+    if not is_admin(c.from_user.id):
         return
     await safe_edit_message(c.message, text="⚙️ Настройки", reply_markup=admin_settings_kb())
 
 @dp.message(AdminGrantPoints.wait_user_id, F.text.in_({"❌ Отмена", "🛠 Админ", "/admin"}))
 @dp.message(AdminGrantPoints.wait_amount,  F.text.in_({"❌ Отмена", "🛠 Админ", "/admin"}))
 async def admin_grant_cancel(m: Message, state: FSMContext):
-    if await get_role(m.from_user.id) != "admin" and m.from_user.id not in ADMIN_IDS:
+    if not is_admin(m.from_user.id):
         await state.clear()
         return await m.answer("Нет доступа.")
     await state.clear()
@@ -1863,16 +2032,15 @@ async def admin_settings_set(m: Message, state: FSMContext):
         now = _nowm()
         for mid in list(DEADLINE.keys()):
             DEADLINE[mid] = now + g_inactivity()
+            TIMERS.move(mid, now)  # пусть таймер сам пересчитает точку срабатывания
     await m.answer("✅ Сохранено.", reply_markup=admin_settings_kb())
 
 async def list_admin_ids() -> list[int]:
-    async with db() as conn:
-        cur = await conn.execute("SELECT tg_id FROM users WHERE role='admin' ORDER BY tg_id ASC")
-        return [int(x[0]) for x in await cur.fetchall()]
+    return ROLES.admins()
 
 @dp.callback_query(F.data == "admin:admins")
 async def admin_admins(c: CallbackQuery, state: FSMContext):
-    if await get_role(c.from_user.id) != "admin" and c.from_user.id not in ADMIN_IDS:
+    if not is_admin(c.from_user.id):
         return
     ids = await list_admin_ids()
     txt = "👥 Админы:\n" + ("\n".join([f"• <code>{i}</code>" for i in ids]) or "пока пусто")
@@ -1903,23 +2071,26 @@ async def admin_admins_apply(m: Message, state: FSMContext):
     if uid == m.from_user.id:
         return await m.answer("Нельзя менять свои права этим способом.")
     await ensure_user(uid)
+    role = "admin" if mode == "add" else "user"
     async with db() as conn:
-        if mode == "add":
-            await conn.execute("UPDATE users SET role='admin' WHERE tg_id=?", (uid,))
-            await conn.commit()
-            await m.answer(f"✅ Пользователь {uid} теперь админ.", reply_markup=admin_admins_kb())
-        else:
-            await conn.execute("UPDATE users SET role='user' WHERE tg_id=?", (uid,))
-            await conn.commit()
-            await m.answer(f"✅ Пользователь {uid} разжалован.", reply_markup=admin_admins_kb())
+        await conn.execute("UPDATE users SET role=? WHERE tg_id=?", (role, uid))
+        await conn.commit()
+    # ответ — уже после выхода из db(): писатель один, Telegram его не держит
+    USERS.update(uid, role=role)
+    if mode == "add":
+        ROLES.grant(uid)
+        await m.answer(f"✅ Пользователь {uid} теперь админ.", reply_markup=admin_admins_kb())
+    else:
+        ROLES.revoke(uid)
+        await m.answer(f"✅ Пользователь {uid} разжалован.", reply_markup=admin_admins_kb())
     await state.clear()
 
 @dp.callback_query(F.data == "admin:support")
 async def admin_support_menu(c: CallbackQuery, state: FSMContext):
-    if await get_role(c.from_user.id) != "admin" and c.from_user.id not in ADMIN_IDS:
+    if not is_admin(c.from_user.id):
         return
     await c.message.edit_text("Диалоги саппорта (открытые):")
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("""
             SELECT from_user, MAX(ts) AS last_ts
             FROM support_msgs
@@ -1964,30 +2135,36 @@ async def admin_broadcast_start(c: CallbackQuery, state: FSMContext):
 async def admin_broadcast_run(m: Message, state: FSMContext):
     text = m.text or ""
     await state.clear()
-    # собираем id пользователей
-    uids = []
-    async with db() as conn:
-        cur = await conn.execute("SELECT tg_id FROM users")
-        uids = [int(x[0]) for x in await cur.fetchall()]
-    ok = 0
-    for uid in uids:
-        try:
-            await bot.send_message(uid, text)
-            ok += 1
-        except Exception:
-            pass
-        await asyncio.sleep(0.05)  # мягкий троттлинг
-    await m.answer(f"📣 Разослано: {ok}/{len(uids)}", reply_markup=admin_main_kb())
+    if not text.strip():
+        return await m.answer("Пустой текст — рассылка отменена.", reply_markup=admin_main_kb())
+    # задание пишется в БД и идёт в фоне; прогресс — правками этого сообщения
+    bid = await BROADCASTS.create(text, m.from_user.id)
+    job = await BROADCASTS.get(bid)
+    msg = await m.answer(BROADCASTS.progress_text(job), reply_markup=progress_kb(bid))
+    await BROADCASTS.set_progress_message(bid, msg.chat.id, msg.message_id)
+    BROADCASTS.launch(bid)
+
+@dp.callback_query(F.data.startswith("bc_cancel:"))
+async def admin_broadcast_cancel(c: CallbackQuery):
+    if not is_admin(c.from_user.id):
+        return await c.answer("Нет прав.", show_alert=True)
+    bid = int(c.data.split(":", 1)[1])
+    ok = await BROADCASTS.cancel(bid)
+    await c.answer("Рассылка остановлена." if ok else "Рассылка уже завершена.")
 
 @dp.callback_query(F.data == "admin:stats")
 async def admin_stats(c: CallbackQuery):
-    async with db() as conn:
-        ucnt = (await (await conn.execute("SELECT COUNT(*) FROM users")).fetchone())[0]
-        qcnt = (await (await conn.execute("SELECT COUNT(*) FROM queue")).fetchone())[0]
-        mact = (await (await conn.execute("SELECT COUNT(*) FROM matches WHERE active=1")).fetchone())[0]
-        mtotal = (await (await conn.execute("SELECT COUNT(*) FROM matches")).fetchone())[0]
-        sup_open = (await (await conn.execute("SELECT COUNT(*) FROM support_msgs WHERE status='open'")).fetchone())[0]
-        ref_cnt = (await (await conn.execute("SELECT COUNT(*) FROM referrals")).fetchone())[0]
+    # всё из счётчиков metrics.py — без COUNT(*) по таблицам
+    ucnt = int(USERS_TOTAL.value())
+    qcnt = len(MATCHMAKER)
+    mact = len(ACTIVE) // 2
+    mtotal = int(MATCHES_TOTAL.value())
+    sup_open = int(SUPPORT_OPEN.value())
+    ref_cnt = int(REFERRALS_TOTAL.value())
+    ob = OUTBOX.stats()
+    sb = SUBS.stats()
+    cx = CTX_STATS.stats()
+    drift = LAST_DRIFT  # результат последней фоновой сверки (run_consistency_checker)
     txt = (
         "<b>📊 Статистика</b>\n\n"
         f"👤 Пользователей: <b>{ucnt}</b>\n"
@@ -1998,21 +2175,27 @@ async def admin_stats(c: CallbackQuery):
         f"🎯 Рефералов всего: <b>{ref_cnt}</b>\n"
         f"\n⚙️ Неактивность: {g_inactivity()} c | Блок-раундов: {g_block_rounds()}\n"
         f"🎁 Daily: {g_daily_bonus()} | 🎯 Referral: {g_ref_bonus()}\n"
-        f"🆘 Support: {'ON' if g_support_enabled() else 'OFF'}"
+        f"🆘 Support: {'ON' if g_support_enabled() else 'OFF'}\n"
+        f"\n📤 Очередь отправки: {ob['pending']} "
+        f"(relay {ob['relay']['depth']}, system {ob['system']['depth']}, broadcast {ob['broadcast']['depth']})\n"
+        f"⏱ Ожидание relay: ср. {ob['relay']['wait_avg']:.2f} c, макс. {ob['relay']['wait_max']:.2f} c | 429: {ob['retries']}\n"
+        f"🔔 Кэш подписки: попаданий {sb['hit_rate']:.0%}, запросов к API {sb['api_calls']}, сэкономлено {sb['saved']}\n"
+        f"👤 Кэш профилей: {USERS.stats()['size']} записей, попаданий {USERS.stats()['hit_rate']:.0%}\n"
+        f"🧩 На апдейт: обращений {cx['calls_avg']:.1f} → поисков {cx['lookups_avg']:.1f} (макс. {cx['lookups_max']})"
+        + (f"\n⚠️ Расхождений активных чатов с БД: {len(drift)} "
+           f"(сверка в {time.strftime('%H:%M', time.localtime(LAST_DRIFT_TS))})" if drift else "")
     )
     await safe_edit_message(c.message, text=txt, reply_markup=admin_main_kb())
 
 @dp.callback_query(F.data == "adm_list")
 async def adm_list(c: CallbackQuery):
-    if await get_role(c.from_user.id) != "admin" and c.from_user.id not in ADMIN_IDS:
+    if not is_admin(c.from_user.id):
         return await c.answer("Нет доступа.")
-    items = await list_items()
-    txt = "📦 Товары:\n" + ("\n".join([f"{i[0]}. {i[1]} — {i[2]}💰 [{i[3]}] {i[4] or ''}" for i in items]) or "пусто")
-    await c.message.edit_text(txt)
+    await c.message.edit_text(await CATALOG.view("admin_list", admin_items_text))
 
 @dp.callback_query(F.data == "adm_add")
 async def adm_add(c: CallbackQuery):
-    if await get_role(c.from_user.id) != "admin" and c.from_user.id not in ADMIN_IDS:
+    if not is_admin(c.from_user.id):
         return await c.answer("Нет доступа.")
     await c.message.edit_text(
         "Формат:\n<code>/add_item Название | Цена | status|privilege | payload</code>\n"
@@ -2023,7 +2206,7 @@ async def adm_add(c: CallbackQuery):
 async def admin_grant_cmd(m: Message):
     if await deny_actions_during_chat(m):
         return
-    if await get_role(m.from_user.id) != "admin" and m.from_user.id not in ADMIN_IDS:
+    if not is_admin(m.from_user.id):
         return await m.answer("Нет доступа.")
     # Формат: /grant <tg_id> <amount> [reason...]
     parts = (m.text or "").strip().split(maxsplit=3)
@@ -2052,7 +2235,7 @@ async def admin_grant_cmd(m: Message):
 async def adm_add_cmd(m: Message):
     if await deny_actions_during_chat(m):
         return
-    if await get_role(m.from_user.id) != "admin" and m.from_user.id not in ADMIN_IDS:
+    if not is_admin(m.from_user.id):
         return await m.answer("Нет доступа.")
     try:
         _, rest = m.text.split(" ", 1)
@@ -2066,7 +2249,7 @@ async def adm_add_cmd(m: Message):
 
 @dp.callback_query(F.data == "adm_del")
 async def adm_del(c: CallbackQuery):
-    if await get_role(c.from_user.id) != "admin" and c.from_user.id not in ADMIN_IDS:
+    if not is_admin(c.from_user.id):
         return await c.answer("Нет доступа.")
     await c.message.edit_text("Отправь команду: <code>/del_item ID</code>")
 
@@ -2074,7 +2257,7 @@ async def adm_del(c: CallbackQuery):
 async def adm_del_cmd(m: Message):
     if await deny_actions_during_chat(m):
         return
-    if await get_role(m.from_user.id) != "admin" and m.from_user.id not in ADMIN_IDS:
+    if not is_admin(m.from_user.id):
         return await m.answer("Нет доступа.")
     try:
         _cmd, sid = m.text.strip().split(maxsplit=1)
@@ -2089,7 +2272,7 @@ async def adm_del_cmd(m: Message):
 
 @dp.message(F.text == "🧭 Режимы")
 async def modes_entry(m: Message, state: FSMContext):
-    if await get_role(m.from_user.id) == "admin" or m.from_user.id in ADMIN_IDS:
+    if is_admin(m.from_user.id):
         await m.answer("Этот раздел недоступен админу. Открой панель: /admin", reply_markup=admin_reply_menu())
         return
     if await deny_actions_during_chat(m):
@@ -2112,7 +2295,7 @@ async def mode_cards(m: Message):
 
 @dp.message(F.text == "🕵️ Анонимный чат")
 async def mode_anon_chat(m: Message):
-    if await get_role(m.from_user.id) == "admin" or m.from_user.id in ADMIN_IDS:
+    if is_admin(m.from_user.id):
         await m.answer("Этот раздел недоступен админу. Открой панель: /admin", reply_markup=admin_reply_menu())
         return
     if await deny_actions_during_chat(m):
@@ -2182,7 +2365,7 @@ async def global_cancel(m: Message, state: FSMContext):
 # ================== Профиль/анкета (вход) ==================
 @dp.message(F.text == "👤 Анкета")
 async def show_or_edit_reveal(m: Message, state: FSMContext):
-    if await get_role(m.from_user.id) == "admin" or m.from_user.id in ADMIN_IDS:
+    if is_admin(m.from_user.id):
         return await m.answer("Раздел «Анкета» недоступен для администраторов. Открой /admin.",
                               reply_markup=admin_main_kb())
     if await deny_actions_during_chat(m):
@@ -2552,7 +2735,7 @@ async def find(m: Message, state: FSMContext):
     if not await gate_subscription(m):
         return
     await ensure_user(m.from_user.id)
-    if await get_role(m.from_user.id) == "admin":
+    if is_admin(m.from_user.id):
         await m.answer("Админ-аккаунт не участвует в поиске. Используй /admin для панели.", reply_markup=(await menu_for(m.from_user.id)))
         return
 
@@ -2582,7 +2765,7 @@ async def find(m: Message, state: FSMContext):
 
 @dp.message(F.text == "🆘 Поддержка")
 async def support_entry(m: Message, state: FSMContext):
-    if await get_role(m.from_user.id) == "admin" or m.from_user.id in ADMIN_IDS:
+    if is_admin(m.from_user.id):
         await m.answer("Для админов есть «🧰 Поддержка» внутри /admin.", reply_markup=admin_reply_menu())
         return
     if await deny_actions_during_chat(m):
@@ -2604,24 +2787,27 @@ async def support_collect(m: Message, state: FSMContext):
         )
         _row_id = cur.lastrowid
         await conn.commit()
+    SUPPORT_OPEN.inc()
 
-    for admin_id in (ADMIN_IDS or []):
-        sent = await bot.send_message(
-            admin_id,
-            f"🆘 Запрос от {m.from_user.id} (@{m.from_user.username or '—'}):\n\n{m.text}"
-        )
-        SUPPORT_RELAY[sent.message_id] = m.from_user.id
+    futs = [
+        send_queued(admin_id, f"🆘 Запрос от {m.from_user.id} (@{m.from_user.username or '—'}):\n\n{m.text}")
+        for admin_id in (ADMIN_IDS or [])
+    ]
+    for sent in await asyncio.gather(*futs, return_exceptions=True):
+        if not isinstance(sent, BaseException):
+            SUPPORT_RELAY[sent.message_id] = m.from_user.id
 
     await m.answer("✉️ Сообщение отправлено админам. Ответ придёт сюда.")
 
 @dp.message(Command("done"))
 async def support_done(m: Message):
     async with db() as conn:
-        await conn.execute(
+        cur = await conn.execute(
             "UPDATE support_msgs SET status='closed' WHERE from_user=? AND status='open'",
             (m.from_user.id,)
         )
         await conn.commit()
+    SUPPORT_OPEN.dec(amount=cur.rowcount)
     await m.answer("✅ Обращение закрыто. Если что — пиши снова: «🆘 Поддержка».")
 
 @dp.message(F.reply_to_message, F.from_user.id.func(lambda uid: uid in ADMIN_IDS))
@@ -2634,11 +2820,11 @@ async def admin_reply_router(m: Message):
 
 @dp.callback_query(F.data == "adm_support")
 async def adm_support(c: CallbackQuery):
-    if await get_role(c.from_user.id) != "admin" and c.from_user.id not in ADMIN_IDS:
+    if not is_admin(c.from_user.id):
         return await c.answer("Нет доступа.", show_alert=True)
 
     await c.message.edit_text("Диалоги саппорта (последние):")
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("""
             SELECT from_user, MAX(ts) AS last_ts
             FROM support_msgs
@@ -2658,7 +2844,7 @@ async def adm_support(c: CallbackQuery):
         )
         SUPPORT_RELAY[head.message_id] = uid
 
-        async with db() as conn:
+        async with db_read() as conn:
             cur = await conn.execute("""
                 SELECT text, ts, id FROM support_msgs
                 WHERE from_user=? AND status='open'
@@ -2677,12 +2863,13 @@ async def adm_support(c: CallbackQuery):
 
 @dp.callback_query(F.data.startswith("sup_close:"))
 async def sup_close(c: CallbackQuery):
-    if c.from_user.id not in ADMIN_IDS and await get_role(c.from_user.id) != "admin":
+    if not is_admin(c.from_user.id):
         return await c.answer("Нет доступа.", show_alert=True)
     uid = int(c.data.split(":")[1])
     async with db() as conn:
-        await conn.execute("UPDATE support_msgs SET status='closed' WHERE from_user=?", (uid,))
+        cur = await conn.execute("UPDATE support_msgs SET status='closed' WHERE from_user=? AND status='open'", (uid,))
         await conn.commit()
+    SUPPORT_OPEN.dec(amount=cur.rowcount)
 
     await c.answer("Закрыто.")
     try:
@@ -2697,11 +2884,11 @@ async def sup_close(c: CallbackQuery):
 
 @dp.callback_query(F.data.startswith("sup_open:"))
 async def sup_open(c: CallbackQuery):
-    if await get_role(c.from_user.id) != "admin" and c.from_user.id not in ADMIN_IDS:
+    if not is_admin(c.from_user.id):
         return await c.answer("Нет доступа.")
     uid = int(c.data.split(":")[1])
 
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("""
             SELECT id, text, ts FROM support_msgs
             WHERE from_user=? AND status='open'
@@ -2726,9 +2913,9 @@ async def sup_open(c: CallbackQuery):
 # ============================================================
 
 @dp.message()
-async def relay_chat(m: Message, state: FSMContext):
-    # Обрабатываем только если у пользователя действительно есть активный чат (в RAM или в БД)
-    if not await is_chat_active(m.from_user.id):
+async def relay_chat(m: Message, state: FSMContext, ctx: UpdateContext):
+    # Обрабатываем только если у пользователя действительно есть активный чат (снимок на входе апдейта)
+    if not ctx.in_chat:
         # Не наш случай — пусть идут дальше по цепочке обработчиков
         raise SkipHandler
 
@@ -2747,13 +2934,10 @@ async def relay_chat(m: Message, state: FSMContext):
     now = _now()
     LAST_SEEN[m.from_user.id] = now
     LAST_SEEN[peer] = now
+    ACTIVITY.touch(mid, now)  # в БД уйдёт пачкой (activity.py)
 
     await _stop_countdown(mid, m.from_user.id, peer, delete_msgs=True)
-    WARNED.pop(mid, None)
-    t = COUNTDOWN_TASKS.pop(mid, None)
-    if t and not t.done():
-        t.cancel()
-    COUNTDOWN_MSGS.pop(mid, None)
+    _arm_match_timer(mid, m.from_user.id, peer)  # сдвиг дедлайна в планировщике — O(1)
 
     # Команды внутри чата
     if m.text:
@@ -2766,7 +2950,7 @@ async def relay_chat(m: Message, state: FSMContext):
             await send_post_chat_feedback(a, b, mid)
             await send_post_chat_feedback(b, a, mid)
             await m.answer("Чат завершён. Нажми «🔎 Найти собеседника», чтобы начать новый.", reply_markup=(await menu_for(m.from_user.id)))
-            await bot.send_message(b, "Собеседник завершил чат.", reply_markup=(await menu_for(b)))
+            send_queued(b, "Собеседник завершил чат.", reply_markup=(await menu_for(b)))
             return
 
         if ttxt == "!next":
@@ -2778,7 +2962,7 @@ async def relay_chat(m: Message, state: FSMContext):
                 await send_post_chat_feedback(a, b, mid)
                 await send_post_chat_feedback(b, a, mid)
                 await m.answer("Чтобы продолжить поиск, укажи свой пол и кого ищешь.", reply_markup=gender_self_kb())
-                await bot.send_message(b, "Собеседник завершил чат.", reply_markup=(await menu_for(b)))
+                send_queued(b, "Собеседник завершил чат.", reply_markup=(await menu_for(b)))
                 return
             await record_separation(a, b)
             await end_current_chat(a)
@@ -2786,7 +2970,7 @@ async def relay_chat(m: Message, state: FSMContext):
             me = await get_user(a)
             await enqueue(a, me[1], me[2])
             await m.answer("Ищу следующего собеседника…", reply_markup=cancel_kb())
-            await bot.send_message(b, "Собеседник ушёл к следующему. Ты можешь нажать «🔎 Найти собеседника».", reply_markup=(await menu_for(b)))
+            send_queued(b, "Собеседник ушёл к следующему. Ты можешь нажать «🔎 Найти собеседника».", reply_markup=(await menu_for(b)))
             await try_match_now(a)
             return
 
@@ -2800,49 +2984,49 @@ async def relay_chat(m: Message, state: FSMContext):
         await send_text_anonym(peer, m.text)
 
     elif m.photo:
-        await bot.send_photo(
+        relay_send(peer, lambda: bot.send_photo(
             peer, m.photo[-1].file_id,
             caption=clean_cap(m.caption),
             protect_content=True
-        )
+        ))
 
     elif m.animation:
-        await bot.send_animation(
+        relay_send(peer, lambda: bot.send_animation(
             peer, m.animation.file_id,
             caption=clean_cap(m.caption),
             protect_content=True
-        )
+        ))
 
     elif m.video:
-        await bot.send_video(
+        relay_send(peer, lambda: bot.send_video(
             peer, m.video.file_id,
             caption=clean_cap(m.caption),
             protect_content=True
-        )
+        ))
 
     elif m.audio:
-        await bot.send_audio(
+        relay_send(peer, lambda: bot.send_audio(
             peer, m.audio.file_id,
             caption=clean_cap(m.caption),
             protect_content=True
-        )
+        ))
 
     elif m.voice:
-        await bot.send_voice(
+        relay_send(peer, lambda: bot.send_voice(
             peer, m.voice.file_id,
             caption=clean_cap(m.caption),
             protect_content=True
-        )
+        ))
 
     elif m.video_note:
-        await bot.send_video_note(peer, m.video_note.file_id, protect_content=True)
+        relay_send(peer, lambda: bot.send_video_note(peer, m.video_note.file_id, protect_content=True))
 
     elif m.document:
-        await bot.send_document(
+        relay_send(peer, lambda: bot.send_document(
             peer, m.document.file_id,
             caption=clean_cap(m.caption),
             protect_content=True
-        )
+        ))
 
     elif m.contact or m.location or m.venue or m.poll or m.dice or m.game:
         await m.answer("Этот тип вложений отключён в анонимном чате.")
@@ -2856,6 +3040,8 @@ async def handle_reveal(me_id: int, peer_id: int):
         await bot.send_message(me_id, "Раскрытие невозможно: у одного из вас не заполнена анкета.")
         return
 
+    # под db() только SQL; сообщения шлём после выхода — писатель общий на весь бот
+    refusal = None
     async with db() as conn:
         cur = await conn.execute(
             "SELECT id,a_id,b_id,a_reveal,b_reveal FROM matches WHERE active=1 AND (a_id=? OR b_id=?) ORDER BY id DESC LIMIT 1",
@@ -2863,24 +3049,25 @@ async def handle_reveal(me_id: int, peer_id: int):
         )
         row = await cur.fetchone()
         if not row:
-            await bot.send_message(me_id, "Нет активного чата.")
-            return
-        mid, a, b, ar, br = row
-        is_a = (me_id == a)
-
-        if (is_a and ar == 1) or ((not is_a) and br == 1):
-            await bot.send_message(me_id, "Запрос на раскрытие уже отправлен. Ждём собеседника.")
-            return
-
-        if is_a:
-            await conn.execute("UPDATE matches SET a_reveal=1 WHERE id=?", (mid,))
+            refusal = "Нет активного чата."
         else:
-            await conn.execute("UPDATE matches SET b_reveal=1 WHERE id=?", (mid,))
-        await conn.commit()
+            mid, a, b, ar, br = row
+            is_a = (me_id == a)
+            if (is_a and ar == 1) or ((not is_a) and br == 1):
+                refusal = "Запрос на раскрытие уже отправлен. Ждём собеседника."
+            else:
+                if is_a:
+                    await conn.execute("UPDATE matches SET a_reveal=1 WHERE id=?", (mid,))
+                else:
+                    await conn.execute("UPDATE matches SET b_reveal=1 WHERE id=?", (mid,))
+                await conn.commit()
 
-        cur = await conn.execute("SELECT a_reveal,b_reveal FROM matches WHERE id=?", (mid,))
-        ar, br = await cur.fetchone()
+                cur = await conn.execute("SELECT a_reveal,b_reveal FROM matches WHERE id=?", (mid,))
+                ar, br = await cur.fetchone()
 
+    if refusal:
+        await bot.send_message(me_id, refusal)
+        return
     if ar == 1 and br == 1:
         await send_reveal_card(a, peer_id)
         await send_reveal_card(b, me_id)
@@ -2918,10 +3105,10 @@ async def send_reveal_card(to_id: int, whose_id: int):
             protect_content=True
         )
 
-# Обработка !команд, если RAM нет, но в БД активный матч есть
+# !команды вне чата: в ACTIVE пользователя нет — отвечаем, что чата нет
 @dp.message(F.text.regexp(r"^!(stop|next|reveal)\b"))
-async def bang_commands_when_db_active(m: Message, state: FSMContext):
-    if m.from_user.id in ACTIVE:
+async def bang_commands_when_db_active(m: Message, state: FSMContext, ctx: UpdateContext):
+    if ctx.in_chat:
         return  # разрулит relay_chat
 
     mat = await _materialize_session_if_needed(m.from_user.id)
@@ -2940,7 +3127,7 @@ async def bang_commands_when_db_active(m: Message, state: FSMContext):
         await send_post_chat_feedback(a, b, mid)
         await send_post_chat_feedback(b, a, mid)
         await m.answer("Чат завершён. Нажми «🔎 Найти собеседника», чтобы начать новый.", reply_markup=(await menu_for(m.from_user.id)))
-        await bot.send_message(b, "Собеседник завершил чат.", reply_markup=(await menu_for(b)))
+        send_queued(b, "Собеседник завершил чат.", reply_markup=(await menu_for(b)))
         return
 
     if txt.startswith("!next"):
@@ -2952,7 +3139,7 @@ async def bang_commands_when_db_active(m: Message, state: FSMContext):
             await send_post_chat_feedback(a, b, mid)
             await send_post_chat_feedback(b, a, mid)
             await m.answer("Чтобы продолжить поиск, укажи свой пол и кого ищешь.", reply_markup=gender_self_kb())
-            await bot.send_message(b, "Собеседник завершил чат.", reply_markup=(await menu_for(b)))
+            send_queued(b, "Собеседник завершил чат.", reply_markup=(await menu_for(b)))
             return
         await record_separation(a, b)
         await end_current_chat(a)
@@ -2960,7 +3147,7 @@ async def bang_commands_when_db_active(m: Message, state: FSMContext):
         me = await get_user(a)
         await enqueue(a, me[1], me[2])
         await m.answer("Ищу следующего собеседника…", reply_markup=cancel_kb())
-        await bot.send_message(b, "Собеседник ушёл к следующему. Ты можешь нажать «🔎 Найти собеседника».", reply_markup=(await menu_for(b)))
+        send_queued(b, "Собеседник ушёл к следующему. Ты можешь нажать «🔎 Найти собеседника».", reply_markup=(await menu_for(b)))
         await try_match_now(a)
         return
 
@@ -2970,15 +3157,15 @@ async def bang_commands_when_db_active(m: Message, state: FSMContext):
 
 # === ФИНАЛЬНЫЙ ФОЛБЭК ДЛЯ "НЕИЗВЕСТНЫХ" СООБЩЕНИЙ ===
 @dp.message()
-async def unknown_router(m: Message, state: FSMContext):
+async def unknown_router(m: Message, state: FSMContext, ctx: UpdateContext):
     # 1) Команды не трогаем — их ловят целевые хэндлеры
     if m.text and m.text.startswith("/"):
         return
 
     # 2) Если пользователь в чате/очереди/форме — не мешаем
-    if await active_peer(m.from_user.id):
+    if ctx.in_chat:
         return
-    if await in_queue(m.from_user.id):
+    if ctx.queued:
         await m.answer("Идёт поиск. Доступна только «❌ Отмена».", reply_markup=cancel_kb())
         return
     if await state.get_state():
@@ -2990,11 +3177,24 @@ async def unknown_router(m: Message, state: FSMContext):
 # ================== Entry ==================
 async def main():
     await init_db()
+    await FSM_STORAGE.start()
     await load_settings_cache()
+    await MATCHMAKER.load()  # очередь поиска из журнала queue
+    print("Admins loaded:", await ROLES.load())
+    print("Totals (users, matches, support open, referrals):", await load_totals())
     # деактивируем очень старые активные чаты (например, старше суток)
     async with db() as conn:
         await conn.execute("UPDATE matches SET active=0 WHERE active=1 AND started_at < strftime('%s','now') - 86400")
         await conn.commit()
+    print("Active chats restored:", await load_active_sessions())
+    print("Active chats drift:", len(await refresh_active_consistency()))
+    # первый запуск с rating_stats: переносим уже накопленные оценки
+    async with db_read() as conn:
+        need_backfill = (
+            await (await conn.execute("SELECT NOT EXISTS(SELECT 1 FROM rating_stats) AND EXISTS(SELECT 1 FROM ratings)")).fetchone()
+        )[0]
+    if need_backfill:
+        print("rating_stats backfilled:", await backfill_rating_stats())
     print("DB path:", DB_PATH)
     # снять read-only если вдруг выставлен
     try:
@@ -3013,7 +3213,35 @@ async def main():
     except Exception as e:
         print("Could not resolve channel id:", repr(e))
         RESOLVED_CHANNEL_ID = None  # оставим None – дальше обработаем
-    await dp.start_polling(bot)
+    flusher = asyncio.create_task(MATCHMAKER.run_flusher())
+    sub_refresher = asyncio.create_task(SUBS.run_refresher())
+    activity_flusher = asyncio.create_task(ACTIVITY.run_flusher())
+    fsm_flusher = asyncio.create_task(FSM_STORAGE.run_flusher())
+    consistency_checker = asyncio.create_task(run_consistency_checker())
+    OUTBOX.start()
+    BROADCASTS.bind(bot)
+    resumed = await BROADCASTS.resume()
+    if resumed:
+        print("Broadcasts resumed:", resumed)
+    metrics_runner = await start_metrics_server()  # GET /metrics (metrics.py)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot)  # апдейты приходят POST-ом и обрабатываются параллельно (webhook.py)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        await BROADCASTS.stop()  # останутся 'running' и продолжатся после рестарта
+        await OUTBOX.stop()  # дослать то, что успеем
+        sub_refresher.cancel()
+        for t in (flusher, activity_flusher, fsm_flusher, consistency_checker):
+            t.cancel()
+            try:
+                await t
+            except asyncio.CancelledError:
+                pass
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await close_pool()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -24,7 +24,7 @@ from keyboards import (
 )
 
 # схема БД и коннектор — из отдельного файла
-from db_schema import db, init_db, DB_PATH
+from db_schema import db, db_read, init_db, DB_PATH
 
 # доп. фичи (магазин/саппорт/рефералка) и расширенное меню
 from features_extra import setup_extra_features, extra_main_menu
@@ -222,7 +222,7 @@ async def set_user_fields(tg_id: int, **kwargs):
         await conn.commit()
 
 async def get_user(tg_id: int):
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("""SELECT tg_id,gender,seeking,reveal_ready,first_name,last_name,
                                     faculty,age,about,username,photo1,photo2,photo3
                                     FROM users WHERE tg_id=?""", (tg_id,))
@@ -246,7 +246,7 @@ async def start_reveal_form(m: Message, state: FSMContext, is_refill: bool):
     await state.set_state(RevealForm.name)
 
 async def get_role(tg_id:int)->str:
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("SELECT role FROM users WHERE tg_id=?", (tg_id,))
         row = await cur.fetchone()
         return row[0] if row else "user"
@@ -257,7 +257,7 @@ async def add_points(tg_id:int, delta:int):
         await conn.commit()
 
 async def get_points(tg_id:int)->int:
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("SELECT COALESCE(points,0) FROM users WHERE tg_id=?", (tg_id,))
         row = await cur.fetchone()
         return int(row[0] if row else 0)
@@ -268,7 +268,7 @@ async def set_status(tg_id:int, title:Optional[str]):
         await conn.commit()
 
 async def get_status(tg_id:int)->Optional[str]:
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("SELECT status_title FROM users WHERE tg_id=?", (tg_id,))
         row = await cur.fetchone()
         return row[0] if row and row[0] else None
@@ -331,7 +331,7 @@ async def active_peer(tg_id: int) -> Optional[int]:
     if tg_id in ACTIVE:
         return ACTIVE[tg_id][0]
     # fallback по БД
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute(
             "SELECT a_id,b_id FROM matches WHERE active=1 AND (a_id=? OR b_id=?) ORDER BY id DESC LIMIT 1",
             (tg_id, tg_id)
@@ -387,7 +387,7 @@ async def decay_blocks(u_id: int):
         await conn.commit()
 
 async def is_recent_blocked(u_id: int, candidate_id: int) -> bool:
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute(
             "SELECT 1 FROM recent_partners WHERE u_id=? AND partner_id=? AND block_left>0",
             (u_id, candidate_id)
@@ -395,7 +395,7 @@ async def is_recent_blocked(u_id: int, candidate_id: int) -> bool:
         return (await cur.fetchone()) is not None
 
 async def in_queue(tg_id: int) -> bool:
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("SELECT 1 FROM queue WHERE tg_id=?", (tg_id,))
         return (await cur.fetchone()) is not None
 
@@ -456,7 +456,7 @@ async def mode_anon_chat(m: Message):
 
 # ========== MATCHING ==========
 async def find_partner(for_id: int) -> Optional[int]:
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("SELECT gender,seeking FROM users WHERE tg_id=?", (for_id,))
         me = await cur.fetchone()
         if not me:
@@ -0,0 +1,232 @@
+# broadcast.py
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Any, Dict, List, Optional
+
+from aiogram.exceptions import TelegramForbiddenError
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+from db_pool import db, db_read
+from outbox import OUTBOX, LANE_BROADCAST, LANE_SYSTEM
+from usercache import USERS
+
+PAGE_SIZE = 200          # сколько получателей читаем из БД за раз
+PROGRESS_EVERY = 3.0     # как часто обновлять сообщение с прогрессом, сек
+
+
+def progress_kb(bid: int):
+    kb = InlineKeyboardBuilder()
+    kb.button(text="⛔ Остановить", callback_data=f"bc_cancel:{bid}")
+    return kb.as_markup()
+
+
+class BroadcastEngine:
+    """
+    Рассылки как задания в БД.
+
+    - получатели читаются страницами `WHERE tg_id > cursor ORDER BY tg_id`,
+      весь список в память не грузится;
+    - страница уходит в OUTBOX (полоса broadcast) параллельно, темп задают его лимиты;
+    - cursor сохраняется после каждой страницы, после рестарта resume()
+      продолжает с него (повторно может уйти не больше одной страницы);
+    - кто заблокировал бота, помечается users.bot_blocked=1 и дальше пропускается.
+    """
+
+    def __init__(self, page_size: int = PAGE_SIZE):
+        self.bot = None
+        self.page_size = page_size
+        self.tasks: Dict[int, asyncio.Task] = {}
+
+    def bind(self, bot) -> None:
+        self.bot = bot
+
+    # ------------------ управление ------------------
+    async def create(self, text: str, admin_id: int) -> int:
+        async with db() as conn:
+            cur = await conn.execute("SELECT COUNT(*) FROM users WHERE COALESCE(bot_blocked,0)=0")
+            total = int((await cur.fetchone())[0])
+            cur = await conn.execute(
+                "INSERT INTO broadcasts(admin_id, text, total) VALUES(?,?,?)", (admin_id, text, total)
+            )
+            bid = int(cur.lastrowid)
+            await conn.commit()
+        return bid
+
+    async def set_progress_message(self, bid: int, chat_id: int, message_id: int) -> None:
+        async with db() as conn:
+            await conn.execute(
+                "UPDATE broadcasts SET progress_chat=?, progress_msg=? WHERE id=?", (chat_id, message_id, bid)
+            )
+            await conn.commit()
+
+    def launch(self, bid: int) -> None:
+        t = self.tasks.get(bid)
+        if t is None or t.done():
+            self.tasks[bid] = asyncio.create_task(self._run(bid))
+
+    async def resume(self) -> int:
+        """Поднять незавершённые рассылки после рестарта."""
+        async with db_read() as conn:
+            cur = await conn.execute("SELECT id FROM broadcasts WHERE status='running' ORDER BY id")
+            ids = [int(r[0]) for r in await cur.fetchall()]
+        for bid in ids:
+            self.launch(bid)
+        return len(ids)
+
+    async def cancel(self, bid: int) -> bool:
+        async with db() as conn:
+            cur = await conn.execute(
+                "UPDATE broadcasts SET status='cancelled', finished_at=strftime('%s','now') "
+                "WHERE id=? AND status='running'", (bid,)
+            )
+            await conn.commit()
+            changed = cur.rowcount > 0
+        t = self.tasks.pop(bid, None)
+        if t is not None:
+            t.cancel()
+        if changed:
+            await self._report(bid)
+        return changed
+
+    async def stop(self) -> None:
+        """Остановка процесса: задания остаются 'running' и продолжатся после рестарта."""
+        tasks = list(self.tasks.values())
+        self.tasks.clear()
+        for t in tasks:
+            t.cancel()
+        for t in tasks:
+            try:
+                await t
+            except asyncio.CancelledError:
+                pass
+
+    async def get(self, bid: int) -> Optional[Dict[str, Any]]:
+        async with db_read() as conn:
+            cur = await conn.execute(
+                "SELECT id, text, status, cursor, total, sent, failed, blocked, progress_chat, progress_msg "
+                "FROM broadcasts WHERE id=?", (bid,)
+            )
+            row = await cur.fetchone()
+        if not row:
+            return None
+        keys = ("id", "text", "status", "cursor", "total", "sent", "failed", "blocked", "progress_chat", "progress_msg")
+        return dict(zip(keys, row))
+
+    # ------------------ прогресс ------------------
+    @staticmethod
+    def progress_text(job: Dict[str, Any]) -> str:
+        done = job["sent"] + job["failed"] + job["blocked"]
+        head = {
+            "running": "⏳ идёт",
+            "done": "✅ завершена",
+            "cancelled": "⛔ остановлена",
+        }.get(job["status"], job["status"])
+        return (
+            f"📣 Рассылка #{job['id']} — {head}\n"
+            f"Обработано: {done}/{job['total']}\n"
+            f"Доставлено: {job['sent']} | Ошибок: {job['failed']} | Заблокировали бота: {job['blocked']}"
+        )
+
+    async def _report(self, bid: int) -> None:
+        job = await self.get(bid)
+        if not job or not job["progress_chat"] or not job["progress_msg"] or self.bot is None:
+            return
+        chat_id, msg_id = job["progress_chat"], job["progress_msg"]
+        text = self.progress_text(job)
+        markup = progress_kb(bid) if job["status"] == "running" else None
+        OUTBOX.submit(
+            chat_id,
+            lambda: self.bot.edit_message_text(chat_id=chat_id, message_id=msg_id, text=text, reply_markup=markup),
+            LANE_SYSTEM,
+        )
+
+    # ------------------ отправка ------------------
+    async def _page(self, cursor: int) -> List[int]:
+        async with db_read() as conn:
+            cur = await conn.execute(
+                "SELECT tg_id FROM users WHERE tg_id>? AND COALESCE(bot_blocked,0)=0 ORDER BY tg_id LIMIT ?",
+                (cursor, self.page_size)
+            )
+            return [int(r[0]) for r in await cur.fetchall()]
+
+    def _send(self, uid: int, text: str) -> asyncio.Future:
+        return OUTBOX.submit(uid, lambda: self.bot.send_message(uid, text), LANE_BROADCAST)
+
+    async def _run(self, bid: int) -> None:
+        job = await self.get(bid)
+        if not job or job["status"] != "running":
+            return
+        text, cursor = job["text"], int(job["cursor"] or 0)
+        last_report = 0.0
+        try:
+            while True:
+                uids = await self._page(cursor)
+                if not uids:
+                    break
+                results = await asyncio.gather(*(self._send(uid, text) for uid in uids), return_exceptions=True)
+                sent = failed = 0
+                blocked: List[tuple] = []
+                for uid, r in zip(uids, results):
+                    if isinstance(r, TelegramForbiddenError):
+                        blocked.append((uid,))
+                    elif isinstance(r, BaseException):
+                        failed += 1
+                    else:
+                        sent += 1
+                cursor = uids[-1]
+                async with db() as conn:
+                    if blocked:
+                        await conn.executemany("UPDATE users SET bot_blocked=1 WHERE tg_id=?", blocked)
+                    cur = await conn.execute(
+                        "UPDATE broadcasts SET cursor=?, sent=sent+?, failed=failed+?, blocked=blocked+? "
+                        "WHERE id=? AND status='running'",
+                        (cursor, sent, failed, len(blocked), bid)
+                    )
+                    await conn.commit()
+                    for (uid,) in blocked:
+                        USERS.update(uid, bot_blocked=1)  # mark_unblocked смотрит флаг в USERS
+                    if cur.rowcount == 0:
+                        return  # отменили из админки
+                if time.monotonic() - last_report >= PROGRESS_EVERY:
+                    last_report = time.monotonic()
+                    await self._report(bid)
+            async with db() as conn:
+                await conn.execute(
+                    "UPDATE broadcasts SET status='done', finished_at=strftime('%s','now') "
+                    "WHERE id=? AND status='running'", (bid,)
+                )
+                await conn.commit()
+            await self._report(bid)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[broadcast] #{bid} failed:", repr(e))
+        finally:
+            if self.tasks.get(bid) is asyncio.current_task():
+                self.tasks.pop(bid, None)
+
+
+async def mark_unblocked(tg_id: int) -> None:
+    """Пользователь снова нажал /start — значит, бот ему доступен.
+
+    Флаг берём из USERS (usercache.py): писателя занимаем, только если он правда стоит.
+    """
+    rec = await USERS.get(tg_id)
+    if rec is None or not rec.bot_blocked:
+        return
+    async with db() as conn:
+        await conn.execute("UPDATE users SET bot_blocked=0 WHERE tg_id=? AND bot_blocked=1", (tg_id,))
+        await conn.commit()
+    USERS.update(tg_id, bot_blocked=0)
+
+
+BROADCASTS = BroadcastEngine()
+
+__all__ = [
+    "BroadcastEngine",
+    "BROADCASTS",
+    "progress_kb",
+    "mark_unblocked",
+]
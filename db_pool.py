@@ -0,0 +1,266 @@
+# db_pool.py
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from typing import Any, Callable, List, Optional
+
+import aiosqlite
+
+# --- путь к БД: C:\Users\<user>\AppData\Local\mephi_dating\bot.db ---
+APPDATA_DIR = os.path.join(os.path.expanduser("~"), "AppData", "Local", "mephi_dating")
+os.makedirs(APPDATA_DIR, exist_ok=True)
+DB_PATH = os.path.join(APPDATA_DIR, "bot.db")
+
+# сколько соединений только-на-чтение держим открытыми
+DB_READERS = int(os.getenv("DB_READERS", "4") or 4)
+
+# Прагмы применяются один раз при открытии соединения, а не на каждый запрос
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
+
+# наблюдатели запросов: fn(sql, seconds, ok) — метрики, профилировщик (см. add_query_hook)
+QueryHook = Callable[[str, float, bool], None]
+_QUERY_HOOKS: List[QueryHook] = []
+
+
+def add_query_hook(fn: QueryHook) -> None:
+    if fn not in _QUERY_HOOKS:
+        _QUERY_HOOKS.append(fn)
+
+
+def remove_query_hook(fn: QueryHook) -> None:
+    if fn in _QUERY_HOOKS:
+        _QUERY_HOOKS.remove(fn)
+
+
+# трассировщик (один, см. sqlprof.py): fn(sql, params, seconds, ok, cursor) -> cursor.
+# В отличие от хуков видит параметры и курсор и может подменить курсор (счёт строк).
+QueryTracer = Callable[[str, Any, float, bool, Any], Any]
+_TRACER: Optional[QueryTracer] = None
+
+
+def set_query_tracer(fn: Optional[QueryTracer]) -> None:
+    global _TRACER
+    _TRACER = fn
+
+
+class _Conn:
+    """
+    Тонкая обёртка над aiosqlite.Connection: execute/executemany замеряются
+    и отдаются в _QUERY_HOOKS и _TRACER, всё остальное проксируется как есть.
+    Без хуков и трассировщика — один лишний вызов функции на запрос.
+    """
+
+    __slots__ = ("_conn",)
+
+    def __init__(self, conn: aiosqlite.Connection):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    async def _timed(self, sql: str, params, op):
+        if not _QUERY_HOOKS and _TRACER is None:
+            return await op
+        t0 = time.perf_counter()
+        try:
+            res = await op
+        except BaseException:
+            _report(sql, params, time.perf_counter() - t0, False, None)
+            raise
+        return _report(sql, params, time.perf_counter() - t0, True, res)
+
+    def execute(self, sql: str, parameters=None):
+        return self._timed(sql, parameters, self._conn.execute(sql, parameters))
+
+    def executemany(self, sql: str, parameters):
+        # параметры executemany могут быть генератором — трассировщику их не отдаём
+        return self._timed(sql, None, self._conn.executemany(sql, parameters))
+
+    def commit(self):
+        return self._timed("COMMIT", None, self._conn.commit())
+
+
+def _report(sql: str, params, seconds: float, ok: bool, res):
+    for fn in _QUERY_HOOKS:
+        try:
+            fn(sql, seconds, ok)
+        except Exception:
+            pass
+    if _TRACER is not None:
+        try:
+            return _TRACER(sql, params, seconds, ok, res)
+        except Exception as e:
+            print("[db_pool] tracer failed:", repr(e))
+    return res
+
+
+class _Lease:
+    """
+    Аренда соединения из пула: `async with pool.writer() as conn: ...`.
+    Соединение при выходе НЕ закрывается, а возвращается в пул;
+    незакоммиченная транзакция писателя откатывается (как при close()).
+    """
+
+    __slots__ = ("_pool", "_write", "_conn", "_nested")
+
+    def __init__(self, pool: "Pool", write: bool):
+        self._pool = pool
+        self._write = write
+        self._conn: Optional[_Conn] = None
+        self._nested = False
+
+    async def __aenter__(self) -> _Conn:
+        pool = self._pool
+        await pool.open()
+        task = asyncio.current_task()
+        # внутри уже взятого писателя (та же задача) — переиспользуем его,
+        # чтобы вложенные хелперы не ждали сами себя и видели свои же записи
+        if pool._owner is not None and pool._owner is task:
+            self._nested = True
+            pool._depth += 1
+            self._conn = pool._writer
+            return self._conn
+        if self._write:
+            await pool._wlock.acquire()
+            pool._owner = task
+            pool._depth = 1
+            self._conn = pool._writer
+        else:
+            self._conn = await pool._readers.get()
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        pool = self._pool
+        conn = self._conn
+        self._conn = None
+        if self._nested:
+            pool._depth -= 1
+            return
+        if not self._write:
+            pool._readers.put_nowait(conn)
+            return
+        try:
+            if conn.in_transaction:
+                await conn.rollback()
+        finally:
+            pool._owner = None
+            pool._depth = 0
+            pool._wlock.release()
+
+
+class Pool:
+    """
+    Один долгоживущий писатель (запись сериализуется asyncio.Lock'ом — SQLite
+    всё равно пускает только одного писателя) + несколько читателей с
+    `query_only`, которые в WAL-режиме не блокируются записью.
+    """
+
+    def __init__(self, path: str, readers: int = DB_READERS):
+        self.path = path
+        self.readers_count = max(1, int(readers))
+        self._writer: Optional[_Conn] = None
+        self._readers: Optional[asyncio.Queue] = None
+        self._all_readers: list[_Conn] = []
+        self._wlock: Optional[asyncio.Lock] = None
+        self._open_lock: Optional[asyncio.Lock] = None
+        self._owner: Optional[asyncio.Task] = None
+        self._depth = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self, read_only: bool) -> _Conn:
+        conn = await aiosqlite.connect(self.path)
+        for p in PRAGMAS:
+            await conn.execute(p)
+        if read_only:
+            await conn.execute("PRAGMA query_only=ON")
+        return _Conn(conn)
+
+    async def open(self) -> None:
+        if self._writer is not None:
+            return
+        if self._open_lock is None:
+            self._open_lock = asyncio.Lock()
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            d = os.path.dirname(self.path)
+            if d:
+                os.makedirs(d, exist_ok=True)
+            writer = await self._connect(read_only=False)
+            readers = [await self._connect(read_only=True) for _ in range(self.readers_count)]
+            q: asyncio.Queue = asyncio.Queue()
+            for r in readers:
+                q.put_nowait(r)
+            self._wlock = asyncio.Lock()
+            self._readers = q
+            self._all_readers = readers
+            self._writer = writer
+
+    async def close(self) -> None:
+        writer, readers = self._writer, self._all_readers
+        self._writer = None
+        self._readers = None
+        self._all_readers = []
+        self._wlock = None
+        self._open_lock = None
+        self._owner = None
+        self._depth = 0
+        for r in readers:
+            try:
+                await r.close()
+            except Exception:
+                pass
+        if writer is not None:
+            try:
+                await writer.close()
+            except Exception:
+                pass
+
+    def writer(self) -> _Lease:
+        return _Lease(self, write=True)
+
+    def reader(self) -> _Lease:
+        return _Lease(self, write=False)
+
+
+POOL = Pool(DB_PATH)
+
+
+def db() -> _Lease:
+    """Соединение на запись (и чтение). Использовать как: `async with db() as conn: ...`"""
+    return POOL.writer()
+
+
+def db_read() -> _Lease:
+    """Соединение только на чтение. Использовать как: `async with db_read() as conn: ...`"""
+    return POOL.reader()
+
+
+async def close_pool() -> None:
+    await POOL.close()
+
+
+__all__ = [
+    "APPDATA_DIR",
+    "DB_PATH",
+    "DB_READERS",
+    "Pool",
+    "POOL",
+    "db",
+    "db_read",
+    "close_pool",
+    "add_query_hook",
+    "remove_query_hook",
+    "set_query_tracer",
+]
@@ -1,18 +1,13 @@
 # db_schema.py
 from __future__ import annotations
 
-import os
-import aiosqlite
+# путь к БД и пул соединений — общие для всех модулей (см. db_pool.py)
+from db_pool import APPDATA_DIR, DB_PATH, db, db_read
+from migrations import Migration, add_column, migrate
 
-# --- путь к БД: C:\Users\<user>\AppData\Local\mephi_dating\bot.db ---
-APPDATA_DIR = os.path.join(os.path.expanduser("~"), "AppData", "Local", "mephi_dating")
-os.makedirs(APPDATA_DIR, exist_ok=True)
-DB_PATH = os.path.join(APPDATA_DIR, "bot.db")
-
-# Базовая схема (без «опасных» ALTER'ов — их применим отдельно и бережно)
+# Базовая схема (без «опасных» ALTER'ов — их применим отдельно и бережно).
+# WAL включает db_pool при открытии соединения.
 CREATE_SQL_BASE = """
-PRAGMA journal_mode=WAL;
-
 CREATE TABLE IF NOT EXISTS recent_partners(
   u_id INTEGER NOT NULL,
   partner_id INTEGER NOT NULL,
@@ -89,55 +84,40 @@ CREATE TABLE IF NOT EXISTS matches(
   b_reveal INTEGER DEFAULT 0,
   started_at INTEGER DEFAULT (strftime('%s','now'))
 );
-
-CREATE INDEX IF NOT EXISTS idx_matches_active ON matches(active);
 """
 
 # Аккуратные миграции: добавим недостающие колонки только если их ещё нет
 ALTERS = [
-    ("users", "role",         "ALTER TABLE users ADD COLUMN role TEXT DEFAULT 'user'"),
-    ("users", "points",       "ALTER TABLE users ADD COLUMN points INTEGER DEFAULT 0"),
-    ("users", "status_title", "ALTER TABLE users ADD COLUMN status_title TEXT"),
+    add_column("users", "role", "TEXT DEFAULT 'user'"),
+    add_column("users", "points", "INTEGER DEFAULT 0"),
+    add_column("users", "status_title", "TEXT"),
 ]
 
-
-def db() -> aiosqlite.Connection:
-    """Вернёт соединение с БД. Использовать как: `async with db() as conn: ...`"""
-    return aiosqlite.connect(DB_PATH)
-
-
-async def _column_exists(conn: aiosqlite.Connection, table: str, col: str) -> bool:
-    cur = await conn.execute(f"PRAGMA table_info({table})")
-    rows = await cur.fetchall()
-    # PRAGMA table_info: (cid, name, type, notnull, dflt_value, pk)
-    return any(r[1] == col for r in rows)
-
-
-async def _apply_safe_alters(conn: aiosqlite.Connection) -> None:
-    for table, col, stmt in ALTERS:
-        try:
-            if not await _column_exists(conn, table, col):
-                await conn.execute(stmt)
-        except Exception as e:
-            # Не валим бот: просто логируем и идём дальше
-            print(f"[DB] ALTER failed ({table}.{col}): {repr(e)}")
+# схема "legacy" (bot_main.py); индексы matches — те же, что в bot.py INDEXES
+MIGRATIONS = [
+    Migration(1, "baseline", [CREATE_SQL_BASE, *ALTERS]),
+    Migration(2, "matches indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_matches_a ON matches(a_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_matches_b ON matches(b_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_matches_active_a ON matches(a_id) WHERE active=1",
+        "CREATE INDEX IF NOT EXISTS idx_matches_active_b ON matches(b_id) WHERE active=1",
+        "CREATE INDEX IF NOT EXISTS idx_matches_live ON matches(id) WHERE active=1",
+        "DROP INDEX IF EXISTS idx_matches_active",
+    ]),
+]
 
 
 async def init_db() -> None:
-    """Создать базовые таблицы и применить безболезненные миграции."""
-    # убедимся, что папка существует (если импортировали модуль отдельно)
-    os.makedirs(APPDATA_DIR, exist_ok=True)
-
-    async with db() as conn:
-        await conn.executescript(CREATE_SQL_BASE)
-        await _apply_safe_alters(conn)
-        await conn.commit()
+    """Схема до последней версии; на тёплом старте — один SELECT версии."""
+    await migrate("legacy", MIGRATIONS)
 
 
 __all__ = [
     "APPDATA_DIR",
     "DB_PATH",
     "db",
+    "db_read",
     "init_db",
     "CREATE_SQL_BASE",
+    "MIGRATIONS",
 ]
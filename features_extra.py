@@ -4,7 +4,6 @@ import time
 import asyncio
 from typing import Optional, List, Tuple
 
-import aiosqlite
 from aiogram import Dispatcher, Bot, F
 from aiogram.enums import ParseMode
 from aiogram.filters import Command
@@ -24,10 +23,12 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_IDS = set(int(x) for x in (os.getenv("ADMIN_IDS", "") or "").split(",") if x.strip())
 DAILY_BONUS_POINTS = int(os.getenv("DAILY_BONUS_POINTS", "10") or 10)
 
-# локальная БД как в основном проекте
-APPDATA_DIR = os.path.join(os.path.expanduser("~"), "AppData", "Local", "mephi_dating")
-os.makedirs(APPDATA_DIR, exist_ok=True)
-DB_PATH = os.path.join(APPDATA_DIR, "bot.db")
+# локальная БД как в основном проекте (общий пул соединений)
+from db_pool import APPDATA_DIR, DB_PATH, db, db_read
+from migrations import Migration, add_column, migrate
+from shop import CATALOG, PurchaseEngine, DUPLICATE, NO_ITEM, NO_FUNDS
+from outbox import OUTBOX
+from usercache import KnownUsers
 
 # реферал-бонусы (можно править по вкусу)
 REFERRAL_BONUS_INVITER = 20
@@ -58,11 +59,8 @@ def shop_back_kb() -> ReplyKeyboardMarkup:
 def _now() -> int:
     return int(time.time())
 
-def db():
-    return aiosqlite.connect(DB_PATH)
-
 async def get_role(tg_id:int)->str:
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("SELECT role FROM users WHERE tg_id=?", (tg_id,))
         row = await cur.fetchone()
         return (row[0] if row and row[0] else "user")
@@ -73,7 +71,7 @@ async def add_points(tg_id:int, delta:int):
         await conn.commit()
 
 async def get_points(tg_id:int)->int:
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("SELECT COALESCE(points,0) FROM users WHERE tg_id=?", (tg_id,))
         row = await cur.fetchone()
         return int(row[0] if row else 0)
@@ -83,12 +81,18 @@ async def set_status(tg_id:int, title:Optional[str]):
         await conn.execute("UPDATE users SET status_title=? WHERE tg_id=?", (title, tg_id))
         await conn.commit()
 
+# своё множество: строку users здесь создают без бесплатных статусов bot.py
+_KNOWN = KnownUsers()
+
 async def ensure_user(tg_id:int):
+    if await _KNOWN.contains(tg_id):
+        return
     async with db() as conn:
         await conn.execute("INSERT OR IGNORE INTO users(tg_id) VALUES(?)", (tg_id,))
         if tg_id in ADMIN_IDS:
             await conn.execute("UPDATE users SET role='admin' WHERE tg_id=?", (tg_id,))
         await conn.commit()
+    _KNOWN.add(tg_id)
 
 # ================== ЛОКАЛЬНАЯ СХЕМА ЭКСТРА-ФИЧ ==================
 EXTRA_SQL = """
@@ -111,22 +115,23 @@ CREATE TABLE IF NOT EXISTS daily_bonus(
 );
 """
 
+EXTRA_MIGRATIONS = [
+    Migration(1, "baseline", [EXTRA_SQL]),
+    Migration(2, "purchase idempotency keys", [
+        add_column("purchases", "idem_key", "TEXT"),
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_purchases_idem ON purchases(idem_key) WHERE idem_key IS NOT NULL",
+    ]),
+]
+
 async def init_extra_schema():
-    async with db() as conn:
-        await conn.executescript(EXTRA_SQL)
-        await conn.commit()
+    await migrate("extra", EXTRA_MIGRATIONS)
 
 # ================== МАГАЗИН ==================
 async def list_active_items() -> List[Tuple[int, str, int, str, Optional[str]]]:
     """
-    Возвращает (id, name, price, type, payload)
+    Возвращает (id, name, price, type, payload) по возрастанию id — из снимка CATALOG (shop.py)
     """
-    async with db() as conn:
-        cur = await conn.execute(
-            "SELECT id,name,price,type,payload FROM shop_items WHERE is_active=1 ORDER BY id ASC"
-        )
-        rows = await cur.fetchall()
-        return rows or []
+    return await CATALOG.view("extra:items", lambda items: sorted(items))
 
 def build_shop_markup(items: List[Tuple[int, str, int, str, Optional[str]]]) -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
@@ -139,7 +144,7 @@ def build_shop_markup(items: List[Tuple[int, str, int, str, Optional[str]]]) ->
     return kb.as_markup()
 
 async def apply_item_effect(user_id:int, item_id:int):
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("SELECT type,payload FROM shop_items WHERE id=?", (item_id,))
         row = await cur.fetchone()
     if not row:
@@ -149,27 +154,20 @@ async def apply_item_effect(user_id:int, item_id:int):
         await set_status(user_id, payload or "✨ Без названия")
     # it_type == "privilege": тут можно включать флаги/привилегии в отдельной таблице, если появятся
 
-async def handle_purchase(user_id:int, item_id:int) -> str:
-    # достанем товар и проверим баланс
-    async with db() as conn:
-        cur = await conn.execute("SELECT name,price FROM shop_items WHERE id=? AND is_active=1", (item_id,))
-        row = await cur.fetchone()
-    if not row:
-        return "❌ Товар не найден или отключён."
-    name, price = row
-    bal = await get_points(user_id)
-    if bal < price:
-        return f"Не хватает очков. Нужно {price}, у тебя {bal}."
-
-    # списание + запись покупки
-    async with db() as conn:
-        await conn.execute("UPDATE users SET points=COALESCE(points,0)-? WHERE tg_id=?", (price, user_id))
-        await conn.execute("INSERT INTO purchases(user_id,item_id) VALUES(?,?)", (user_id, item_id))
-        await conn.commit()
-
-    # применяем эффект
-    await apply_item_effect(user_id, item_id)
-    return f"✅ Покупка «{name}» успешна!"
+# списание, эффект (статус) и запись покупки — одной транзакцией (shop.py); инвентаря у этой схемы нет
+PURCHASES = PurchaseEngine(inventory=False, default_title="✨ Без названия")
+
+async def handle_purchase(user_id:int, item_id:int, key:Optional[str]=None) -> Tuple[str, int, bool]:
+    """Возвращает (текст ответа, баланс после, куплено ли)."""
+    res = await PURCHASES.buy(user_id, item_id, key)
+    if res.status == NO_ITEM:
+        return "❌ Товар не найден или отключён.", res.balance, False
+    if res.status == DUPLICATE:
+        return "Эта покупка уже оформлена.", res.balance, False
+    name, price = res.item[1], res.item[2]
+    if res.status == NO_FUNDS:
+        return f"Не хватает очков. Нужно {price}, у тебя {res.balance}.", res.balance, False
+    return f"✅ Покупка «{name}» успешна!", res.balance, True
 
 # ================== САППОРТ ==================
 class Support(StatesGroup):
@@ -228,7 +226,7 @@ async def get_ref_stats(user_id:int) -> Tuple[int, int]:
     """
     count, total_bonus_approx
     """
-    async with db() as conn:
+    async with db_read() as conn:
         cur = await conn.execute("SELECT COUNT(*) FROM referrals WHERE inviter_id=?", (user_id,))
         cnt = (await cur.fetchone() or [0])[0]
     return int(cnt or 0), int((cnt or 0) * REFERRAL_BONUS_INVITER)
@@ -251,14 +249,14 @@ async def setup_extra_features(dp: Dispatcher, bot: Bot):
     @dp.message(F.text == "💰 Магазин")
     async def shop_open(m: Message):
         await ensure_user(m.from_user.id)
-        items = await list_active_items()
+        # текст и клавиатура собраны один раз на снимок каталога — из того снимка, что передал view()
         await m.answer(
-            _build_shop_text(items),
+            await CATALOG.view("extra:text", lambda its: _build_shop_text(sorted(its))),
             reply_markup=shop_back_kb()
         )
         await m.answer(
             "Выбери товар:",
-            reply_markup=build_shop_markup(items)
+            reply_markup=await CATALOG.view("extra:kb", lambda its: build_shop_markup(sorted(its)))
         )
 
     @dp.callback_query(F.data.startswith("shop_buy:"))
@@ -268,8 +266,15 @@ async def setup_extra_features(dp: Dispatcher, bot: Bot):
         except Exception:
             await c.answer("Некорректный товар.", show_alert=True)
             return
-        msg = await handle_purchase(c.from_user.id, item_id)
-        bal = await get_points(c.from_user.id)
+        # ключ — сообщение магазина + товар; после покупки кнопки с этого сообщения
+        # убираем (как bot.py shop_buy), следующая покупка — из нового «💰 Магазин»
+        key = f"{c.from_user.id}:{c.message.message_id}:{item_id}" if c.message else f"cb:{c.id}"
+        msg, bal, ok = await handle_purchase(c.from_user.id, item_id, key)
+        if ok:
+            try:
+                await c.message.edit_reply_markup(reply_markup=None)
+            except Exception:
+                pass
         await c.message.answer(f"{msg}\nТекущий баланс: {bal}", reply_markup=shop_back_kb())
         await c.answer("Готово")
 
@@ -286,15 +291,9 @@ async def setup_extra_features(dp: Dispatcher, bot: Bot):
         mid = await save_support_msg(m.from_user.id, m.text, m.message_id)
         # перешлём админам
         admins = ADMIN_IDS or set()
+        text = f"🆘 <b>Саппорт</b>\nfrom: <code>{m.from_user.id}</code>\nmsg_id: <code>{mid}</code>\n\n{text_escape(m.text)}"
         for aid in admins:
-            try:
-                await bot.send_message(
-                    aid,
-                    f"🆘 <b>Саппорт</b>\nfrom: <code>{m.from_user.id}</code>\nmsg_id: <code>{mid}</code>\n\n{text_escape(m.text)}",
-                    parse_mode=ParseMode.HTML
-                )
-            except Exception:
-                pass
+            OUTBOX.submit(aid, lambda aid=aid: bot.send_message(aid, text, parse_mode=ParseMode.HTML))
         await m.answer("Сообщение отправлено. Админы ответят в ближайшее время.",
                        reply_markup=extra_main_menu())
         await state.clear()
@@ -386,6 +385,7 @@ async def setup_extra_features(dp: Dispatcher, bot: Bot):
                 (name, price, it_type, payload)
             )
             await conn.commit()
+        CATALOG.invalidate()
         await m.answer("Товар добавлен.")
 
     @dp.message(Command("toggle_item"))
@@ -407,6 +407,7 @@ async def setup_extra_features(dp: Dispatcher, bot: Bot):
                 (item_id,)
             )
             await conn.commit()
+        CATALOG.invalidate()
         await m.answer("Готово, переключил активность.")
 
     # Быстрый вывод баланса и статуса
@@ -414,7 +415,7 @@ async def setup_extra_features(dp: Dispatcher, bot: Bot):
     async def cmd_balance(m: Message):
         await ensure_user(m.from_user.id)
         bal = await get_points(m.from_user.id)
-        async with db() as conn:
+        async with db_read() as conn:
             cur = await conn.execute("SELECT status_title FROM users WHERE tg_id=?", (m.from_user.id,))
             row = await cur.fetchone()
             status = row[0] if row and row[0] else "—"
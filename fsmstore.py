@@ -0,0 +1,241 @@
+# fsmstore.py
+"""
+FSM-хранилище aiogram в SQLite вместо MemoryStorage: RevealForm, SupportState
+и админские мастера переживают рестарт, Redis не нужен.
+
+    dp = Dispatcher(storage=FSM_STORAGE)
+    asyncio.create_task(FSM_STORAGE.run_flusher())
+
+- Чтение — из словаря в памяти; строку fsm_states читаем только при первом
+  обращении к ключу (отсутствие строки тоже запоминается).
+- Запись (set_state/set_data/update_data) правит запись в памяти и помечает
+  ключ «грязным»; run_flusher() раз в FLUSH_INTERVAL секунд пишет все грязные
+  ключи одной транзакцией. Серия update_data (rf_photos и т. п.) = одна запись.
+  При падении процесса теряется не больше FLUSH_INTERVAL секунд; close()
+  (aiogram зовёт его на shutdown) дописывает всё.
+- Брошенные анкеты живут FSM_TTL секунд с последнего изменения, потом
+  cleanup() удаляет их из таблицы и из памяти. Записи, к которым давно
+  не обращались (CACHE_IDLE), выгружаются из памяти — строка остаётся в БД.
+
+Данные должны сериализоваться в JSON (как и у RedisStorage): кортежи вернутся
+списками, а несериализуемое останется только в памяти (с предупреждением в лог).
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import time
+from copy import copy
+from typing import Any, Dict, Mapping, Optional, Set
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from db_pool import db, db_read
+from migrations import Migration, migrate
+
+FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1") or 1)
+FSM_TTL = int(os.getenv("FSM_TTL", str(3 * 86400)) or 3 * 86400)   # брошенная анкета живёт 3 дня
+CACHE_IDLE = 3600                                                   # выгрузка из памяти через час без обращений
+CLEANUP_INTERVAL = 600
+
+FSM_SQL = """
+CREATE TABLE IF NOT EXISTS fsm_states(
+  key TEXT PRIMARY KEY,
+  state TEXT,
+  data TEXT,
+  updated_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm_states(updated_at);
+"""
+
+FSM_MIGRATIONS = [
+    Migration(1, "fsm states", [FSM_SQL]),
+]
+
+_UPSERT_SQL = (
+    "INSERT INTO fsm_states(key, state, data, updated_at) VALUES(?,?,?,?) "
+    "ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data, updated_at=excluded.updated_at"
+)
+
+
+class _Record:
+    __slots__ = ("state", "data", "written", "used")
+
+    def __init__(self, state: Optional[str], data: Dict[str, Any], written: float):
+        self.state = state
+        self.data = data
+        self.written = written   # последнее изменение (для TTL)
+        self.used = time.time()  # последнее обращение (для выгрузки из памяти)
+
+    @property
+    def empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+def _key(key: StorageKey) -> str:
+    return (f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:"
+            f"{key.business_connection_id or ''}:{key.destiny}")
+
+
+class SqliteStorage(BaseStorage):
+    def __init__(self, ttl: int = FSM_TTL, cache_idle: int = CACHE_IDLE):
+        self.ttl = ttl
+        self.cache_idle = cache_idle
+        self._cache: Dict[str, _Record] = {}
+        self._dirty: Set[str] = set()
+        self._ready = False
+        self._lock = asyncio.Lock()
+        self.loads = 0     # чтений строки из БД
+        self.writes = 0    # записанных строк (upsert + delete)
+        self.marks = 0     # изменений в памяти
+
+    async def start(self) -> None:
+        """Создать/обновить таблицу (схема «fsm» в schema_version). Вызывается и лениво."""
+        if self._ready:
+            return
+        async with self._lock:
+            if not self._ready:
+                await migrate("fsm", FSM_MIGRATIONS)
+                self._ready = True
+
+    async def _get(self, key: StorageKey) -> _Record:
+        k = _key(key)
+        rec = self._cache.get(k)
+        if rec is None:
+            await self.start()
+            async with db_read() as conn:
+                cur = await conn.execute("SELECT state, data, updated_at FROM fsm_states WHERE key=?", (k,))
+                row = await cur.fetchone()
+            self.loads += 1
+            loaded = _Record(row[0], json.loads(row[1]) if row[1] else {}, row[2]) if row else _Record(None, {}, 0)
+            # пока читали, ключ могли записать — запись из памяти новее
+            rec = self._cache.setdefault(k, loaded)
+        rec.used = time.time()
+        return rec
+
+    def _mark(self, key: StorageKey, rec: _Record) -> None:
+        rec.written = rec.used
+        self._dirty.add(_key(key))
+        self.marks += 1
+
+    # ------------------ BaseStorage ------------------
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        rec = await self._get(key)
+        rec.state = state.state if isinstance(state, State) else state
+        self._mark(key, rec)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        rec = await self._get(key)
+        rec.data = data.copy()
+        self._mark(key, rec)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._get(key)).data.copy()
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default: Any = None) -> Any:
+        return copy((await self._get(storage_key)).data.get(dict_key, default))
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> Dict[str, Any]:
+        rec = await self._get(key)
+        rec.data.update(data)
+        self._mark(key, rec)
+        return rec.data.copy()
+
+    async def close(self) -> None:
+        await self.flush()
+
+    # ------------------ запись и уборка ------------------
+    async def flush(self) -> int:
+        """Записать грязные ключи одной транзакцией. Вернёт число записанных строк."""
+        if not self._dirty:
+            return 0
+        dirty, self._dirty = self._dirty, set()
+        now = int(time.time())
+        upserts, deletes = [], []
+        for k in dirty:
+            rec = self._cache.get(k)
+            if rec is None:
+                continue
+            if rec.empty:
+                deletes.append((k,))
+                continue
+            try:
+                payload = json.dumps(rec.data, ensure_ascii=False) if rec.data else None
+            except (TypeError, ValueError) as e:
+                print("[fsm] data is not JSON-serializable, kept in memory only:", k, repr(e))
+                continue
+            upserts.append((k, rec.state, payload, now))
+        try:
+            await self.start()
+            async with db() as conn:
+                if upserts:
+                    await conn.executemany(_UPSERT_SQL, upserts)
+                if deletes:
+                    await conn.executemany("DELETE FROM fsm_states WHERE key=?", deletes)
+                await conn.commit()
+        except Exception as e:
+            self._dirty |= dirty
+            print("[fsm] flush failed:", repr(e))
+            return 0
+        self.writes += len(upserts) + len(deletes)
+        return len(upserts) + len(deletes)
+
+    async def cleanup(self, now: Optional[float] = None) -> int:
+        """Удалить анкеты старше ttl и выгрузить давно не нужные записи. Вернёт число удалённых строк."""
+        now = time.time() if now is None else now
+        expired = now - self.ttl
+        idle = now - self.cache_idle
+        for k, rec in list(self._cache.items()):
+            if k in self._dirty:
+                continue
+            if rec.used < idle or (not rec.empty and rec.written < expired):
+                del self._cache[k]
+        await self.start()
+        async with db() as conn:
+            cur = await conn.execute("DELETE FROM fsm_states WHERE updated_at < ?", (int(expired),))
+            await conn.commit()
+        return cur.rowcount
+
+    async def run_flusher(self, interval: float = FLUSH_INTERVAL) -> None:
+        last_cleanup = 0.0
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                await self.flush()
+                if time.monotonic() - last_cleanup >= CLEANUP_INTERVAL:
+                    last_cleanup = time.monotonic()
+                    try:
+                        removed = await self.cleanup()
+                        if removed:
+                            print("[fsm] expired forms removed:", removed)
+                    except Exception as e:
+                        print("[fsm] cleanup failed:", repr(e))
+        except asyncio.CancelledError:
+            await self.flush()
+            raise
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "cached": len(self._cache),
+            "dirty": len(self._dirty),
+            "loads": self.loads,
+            "writes": self.writes,
+            "marks": self.marks,
+        }
+
+
+FSM_STORAGE = SqliteStorage()
+
+__all__ = [
+    "SqliteStorage",
+    "FSM_STORAGE",
+    "FSM_MIGRATIONS",
+]
@@ -1,4 +1,7 @@
 # keyboards.py
+# клавиатуры неизменяемы: собираем один раз и отдаём тот же объект (lru_cache)
+from functools import lru_cache
+
 from aiogram.types import (
     ReplyKeyboardMarkup, InlineKeyboardMarkup,
     KeyboardButton, InlineKeyboardButton
@@ -13,6 +16,7 @@ FACULTIES = [
 ]
 
 # ====== ГЛАВНОЕ МЕНЮ ======
+@lru_cache(maxsize=None)
 def main_menu() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="🧭 Режимы"))
@@ -20,6 +24,7 @@ def main_menu() -> ReplyKeyboardMarkup:
     return kb.as_markup(resize_keyboard=True)
 
 # ====== РАСШИРЕННОЕ МЕНЮ (если активен магазин/саппорт) ======
+@lru_cache(maxsize=None)
 def extra_main_menu() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="🧭 Режимы"))
@@ -30,6 +35,7 @@ def extra_main_menu() -> ReplyKeyboardMarkup:
     return kb.as_markup(resize_keyboard=True)
 
 # ====== МЕНЮ РЕЖИМОВ ======
+@lru_cache(maxsize=None)
 def modes_kb() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="📇 Просмотр анкет"))
@@ -38,6 +44,7 @@ def modes_kb() -> ReplyKeyboardMarkup:
     return kb.as_markup(resize_keyboard=True)
 
 # ====== МЕНЮ ДЛЯ АНКЕТЫ ======
+@lru_cache(maxsize=None)
 def reveal_entry_menu() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="⬅️ В главное меню"))
@@ -45,12 +52,14 @@ def reveal_entry_menu() -> ReplyKeyboardMarkup:
     return kb.as_markup(resize_keyboard=True)
 
 # ====== ПОЛ / КОГО ИЩЕШЬ ======
+@lru_cache(maxsize=None)
 def gender_self_kb() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="Я девушка"))
     kb.add(KeyboardButton(text="Я парень"))
     return kb.as_markup(resize_keyboard=True)
 
+@lru_cache(maxsize=None)
 def seeking_kb() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="Девушки"))
@@ -59,6 +68,7 @@ def seeking_kb() -> ReplyKeyboardMarkup:
     return kb.as_markup(resize_keyboard=True)
 
 # ====== ФАКУЛЬТЕТЫ (Inline) ======
+@lru_cache(maxsize=None)
 def faculties_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
     for i, f in enumerate(FACULTIES):
@@ -67,6 +77,7 @@ def faculties_kb() -> InlineKeyboardMarkup:
     return b.as_markup()
 
 # ====== МЕНЮ АНКЕТЫ — О СЕБЕ ======
+@lru_cache(maxsize=64)
 def about_kb(refill: bool = False, has_prev: bool = False) -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="Пропустить"))
@@ -76,6 +87,7 @@ def about_kb(refill: bool = False, has_prev: bool = False) -> ReplyKeyboardMarku
     return kb.as_markup(resize_keyboard=True)
 
 # ====== МЕНЮ АНКЕТЫ — ФОТО ======
+@lru_cache(maxsize=64)
 def photos_empty_kb(refill: bool = False, has_prev: bool = False) -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     if refill and has_prev:
@@ -83,6 +95,7 @@ def photos_empty_kb(refill: bool = False, has_prev: bool = False) -> ReplyKeyboa
     kb.add(KeyboardButton(text="❌ Отмена"))
     return kb.as_markup(resize_keyboard=True)
 
+@lru_cache(maxsize=None)
 def photos_progress_kb() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="Готово"))
@@ -91,17 +104,20 @@ def photos_progress_kb() -> ReplyKeyboardMarkup:
     return kb.as_markup(resize_keyboard=True)
 
 # ====== ПРОСТЫЕ МЕНЮ ======
+@lru_cache(maxsize=None)
 def cancel_kb() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="❌ Отмена"))
     return kb.as_markup(resize_keyboard=True)
 
+@lru_cache(maxsize=None)
 def anon_chat_menu_kb() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="🔎 Найти собеседника"))
     kb.add(KeyboardButton(text="⬅️ В главное меню"))
     return kb.as_markup(resize_keyboard=True)
 
+@lru_cache(maxsize=None)
 def shop_back_kb() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="⬅️ В главное меню"))
@@ -109,6 +125,7 @@ def shop_back_kb() -> ReplyKeyboardMarkup:
     return kb.as_markup(resize_keyboard=True)
 
 # ====== КЛАВИАТУРА ДЛЯ ПРОВЕРКИ ПОДПИСКИ ======
+@lru_cache(maxsize=64)
 def subscription_kb(channel_link: str) -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     kb.button(text="➡️ Подписаться", url=channel_link)
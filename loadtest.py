@@ -0,0 +1,427 @@
+# loadtest.py
+"""
+Нагрузочный прогон бота без настоящего Telegram.
+
+FakeBotAPI — локальный сервер с методами Bot API, которые нужны боту
+(getUpdates, sendMessage, sendPhoto, editMessageText, deleteMessage,
+getChatMember, getChat, getMe; остальное отвечает ok/true), с задержкой
+ответа и случайными 429. Бот (bot.main() целиком, с БД во временной
+папке) ходит в него вместо api.telegram.org.
+
+Симулятор гоняет виртуальных пользователей по сценарию: /start → пол →
+кого ищем → «🔎 Найти собеседника» → переписка → !reveal → !next / !stop.
+
+Запуск:
+    python loadtest.py --users 2000 --rounds 2 --latency 0.02 --p429 0.01
+    python loadtest.py --mode webhook --users 500
+
+В конце печатается: апдейтов/сек, перцентили времени обработки апдейта,
+запросов к SQLite на апдейт, вызовы Bot API по методам.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import random
+import secrets
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+FAKE_HOST = "127.0.0.1"
+CHANNEL_ID = -1001000000001
+END_MARKERS = ("Собеседник завершил чат", "Собеседник ушёл к следующему", "Чат завершён")
+
+
+class FakeBotAPI:
+    """Минимальный Bot API: запоминает, что бот отправил, и раздаёт апдейты через getUpdates."""
+
+    def __init__(self, latency: float = 0.0, p429: float = 0.0, retry_after: int = 1, seed: int = 1):
+        self.latency = latency
+        self.p429 = p429
+        self.retry_after = retry_after
+        self.rnd = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.injected_429 = 0
+        self.inbox: Dict[int, asyncio.Queue] = {}
+        self._updates: List[Dict[str, Any]] = []
+        self._new = asyncio.Event()
+        self._update_id = 0
+        self._message_id = 0
+        self._runner: Optional[web.AppRunner] = None
+        self.port = 0
+
+    # ------------------ сервер ------------------
+    async def start(self, port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, FAKE_HOST, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f"http://{FAKE_HOST}:{self.port}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+        if method != "getUpdates":
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if self.p429 and method.startswith(("send", "edit")) and self.rnd.random() < self.p429:
+                self.injected_429 += 1
+                return web.json_response({
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                })
+        fn = getattr(self, "m_" + method, None)
+        result = await fn(params) if fn else True
+        return web.json_response({"ok": True, "result": result})
+
+    # ------------------ методы ------------------
+    def _message(self, chat_id: int, **extra) -> Dict[str, Any]:
+        self._message_id += 1
+        return {"message_id": self._message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, **extra}
+
+    def _deliver(self, chat_id: int, kind: str, text: str) -> None:
+        q = self.inbox.get(chat_id)
+        if q is not None:
+            q.put_nowait((kind, text))
+
+    async def m_getMe(self, p):
+        return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+    async def m_getChat(self, p):
+        return {"id": CHANNEL_ID, "type": "channel", "title": "fake channel", "accent_color_id": 0,
+                "max_reaction_count": 11, "accepted_gift_types": {
+                    "unlimited_gifts": False, "limited_gifts": False, "unique_gifts": False, "premium_subscription": False,
+                    "gifts_from_channels": False}}
+
+    async def m_getChatMember(self, p):
+        uid = int(p.get("user_id", 0))
+        return {"status": "member", "user": {"id": uid, "is_bot": False, "first_name": "u"}}
+
+    async def m_sendMessage(self, p):
+        chat_id, text = int(p["chat_id"]), p.get("text", "")
+        self._deliver(chat_id, "text", text)
+        return self._message(chat_id, text=text)
+
+    async def m_sendPhoto(self, p):
+        chat_id = int(p["chat_id"])
+        self._deliver(chat_id, "photo", p.get("caption", ""))
+        return self._message(chat_id, photo=[{"file_id": "f", "file_unique_id": "u", "width": 1, "height": 1}])
+
+    async def m_editMessageText(self, p):
+        return self._message(int(p["chat_id"]), text=p.get("text", ""))
+
+    async def m_deleteMessage(self, p):
+        return True
+
+    async def m_getUpdates(self, p):
+        offset = int(p.get("offset") or 0)
+        limit = int(p.get("limit") or 100)
+        timeout = float(p.get("timeout") or 0)
+        if offset:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._new.clear()
+            try:
+                await asyncio.wait_for(self._new.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    # ------------------ апдейты от «пользователей» ------------------
+    def make_update(self, uid: int, text: str) -> Dict[str, Any]:
+        self._update_id += 1
+        msg = self._message(uid, text=text)
+        msg["from"] = {"id": uid, "is_bot": False, "first_name": f"u{uid}"}
+        return {"update_id": self._update_id, "message": msg}
+
+    def push(self, update: Dict[str, Any]) -> None:
+        self._updates.append(update)
+        self._new.set()
+
+
+class UpdateTimer:
+    """Outer-middleware на dp.update: сколько длилась обработка каждого апдейта."""
+
+    def __init__(self) -> None:
+        self.samples: List[float] = []
+        self.active = False
+
+    async def __call__(self, handler, event, data):
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            if self.active:
+                self.samples.append(time.perf_counter() - t0)
+
+
+class SqlCounter:
+    """Считает SQL-операторы на всех соединениях пула (включая BEGIN/COMMIT)."""
+
+    def __init__(self) -> None:
+        self.count = 0
+
+    def __call__(self, _sql: str) -> None:
+        self.count += 1
+
+    async def attach(self, pool) -> None:
+        await pool.open()
+        for conn in [pool._writer, *pool._all_readers]:
+            await conn.set_trace_callback(self)
+
+
+# ------------------ виртуальный пользователь ------------------
+class VirtualUser:
+    def __init__(self, uid: int, sim: "Simulator"):
+        self.uid = uid
+        self.sim = sim
+        self.rnd = random.Random(uid)
+        self.inbox: asyncio.Queue = asyncio.Queue()
+        self.in_chat = False
+        self.chats = 0
+
+    async def say(self, text: str) -> None:
+        await self.sim.send(self.uid, text)
+        if self.sim.think:
+            await asyncio.sleep(self.rnd.uniform(0, self.sim.think))
+
+    async def wait_for(self, *needles: str, timeout: float) -> Optional[str]:
+        deadline = time.monotonic() + timeout
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return None
+            try:
+                _kind, text = await asyncio.wait_for(self.inbox.get(), left)
+            except asyncio.TimeoutError:
+                return None
+            if any(n in text for n in END_MARKERS):
+                self.in_chat = False
+            if "Ваш собеседник" in text:
+                self.in_chat = True
+            if not needles or any(n in text for n in needles):
+                return text
+
+    def drain(self) -> None:
+        while not self.inbox.empty():
+            _kind, text = self.inbox.get_nowait()
+            if any(n in text for n in END_MARKERS):
+                self.in_chat = False
+            if "Ваш собеседник" in text:
+                self.in_chat = True
+
+    async def run(self, rounds: int, messages: int) -> None:
+        girl = self.uid % 2 == 0
+        await self.say("/start")
+        await self.wait_for("Сначала выберем", "Главное меню", timeout=self.sim.timeout)
+        await self.say("Я девушка" if girl else "Я парень")
+        await self.wait_for("Кто тебе интересен", timeout=self.sim.timeout)
+        await self.say(self.rnd.choice(["Парни" if girl else "Девушки", "Не важно"]))
+        await self.wait_for("Параметры сохранены", timeout=self.sim.timeout)
+        for _ in range(rounds):
+            self.drain()
+            if not self.in_chat:
+                await self.say("🔎 Найти собеседника")
+                if await self.wait_for("Ваш собеседник", timeout=self.sim.match_timeout) is None:
+                    await self.say("❌ Отмена")
+                    continue
+            self.chats += 1
+            for k in range(messages):
+                self.drain()
+                if not self.in_chat:
+                    break
+                await self.say(f"сообщение {k} от {self.uid}")
+            self.drain()
+            if not self.in_chat:
+                continue
+            if self.rnd.random() < 0.3:
+                await self.say("!reveal")
+            await self.say("!next" if self.rnd.random() < 0.5 else "!stop")
+            self.in_chat = False
+        self.drain()
+        if self.in_chat:
+            await self.say("!stop")
+
+
+class Simulator:
+    def __init__(self, api: FakeBotAPI, mode: str, think: float, timeout: float, match_timeout: float,
+                 webhook_url: str = ""):
+        self.api = api
+        self.mode = mode
+        self.think = think
+        self.timeout = timeout
+        self.match_timeout = match_timeout
+        self.webhook_url = webhook_url
+        self.sent = 0
+        self._http = None
+
+    async def send(self, uid: int, text: str) -> None:
+        self.sent += 1
+        update = self.api.make_update(uid, text)
+        if self.mode == "webhook":
+            from webhook import SECRET_HEADER, WEBHOOK_SECRET
+            async with self._http.post(self.webhook_url, json=update, headers={SECRET_HEADER: WEBHOOK_SECRET}) as r:
+                await r.read()
+        else:
+            self.api.push(update)
+
+    async def run(self, users: int, rounds: int, messages: int, base_uid: int = 10_000_000) -> List[VirtualUser]:
+        import aiohttp
+
+        self._http = aiohttp.ClientSession()
+        people = [VirtualUser(base_uid + i, self) for i in range(users)]
+        for p in people:
+            self.api.inbox[p.uid] = p.inbox
+        try:
+            await asyncio.gather(*(p.run(rounds, messages) for p in people))
+        finally:
+            await self._http.close()
+        return people
+
+
+# ------------------ прогон ------------------
+def _percentiles(samples: List[float]) -> str:
+    if not samples:
+        return "нет данных"
+    s = sorted(samples)
+
+    def pct(q: float) -> float:
+        return s[min(len(s) - 1, int(len(s) * q))] * 1000
+
+    return f"p50 {pct(0.50):.2f} ms | p95 {pct(0.95):.2f} ms | p99 {pct(0.99):.2f} ms | max {s[-1] * 1000:.2f} ms"
+
+
+async def _world(args, ready: Future, finished: Future, stop: threading.Event) -> None:
+    """Фейковый Telegram и пользователи живут в своём потоке со своим event loop,
+    чтобы их работа не попадала во время обработки апдейтов ботом."""
+    loop = asyncio.get_running_loop()
+    api = FakeBotAPI(latency=args.latency, p429=args.p429, seed=args.seed)
+    go = threading.Event()
+    ready.set_result((api, await api.start(), go))
+    await loop.run_in_executor(None, go.wait)
+    sim = Simulator(api, args.mode, think=args.think, timeout=args.timeout, match_timeout=args.match_timeout,
+                    webhook_url=args.webhook_url)
+    t0 = time.perf_counter()
+    people = await sim.run(args.users, args.rounds, args.messages)
+    finished.set_result({"sent": sim.sent, "elapsed": time.perf_counter() - t0,
+                         "chats": sum(p.chats for p in people)})
+    await loop.run_in_executor(None, stop.wait)
+    await api.stop()
+
+
+async def run(args) -> None:
+    ready: Future = Future()
+    finished: Future = Future()
+    stop = threading.Event()
+    world = threading.Thread(target=lambda: asyncio.run(_world(args, ready, finished, stop)), daemon=True)
+    world.start()
+    api, base, go = await asyncio.wrap_future(ready)
+
+    # окружение бота — до его импорта
+    os.environ.setdefault("BOT_TOKEN", "123456:FAKE")
+    os.environ["BOT_MODE"] = args.mode
+    os.environ.setdefault("WEBHOOK_HOST", FAKE_HOST)
+    os.environ.setdefault("WEBHOOK_SECRET", secrets.token_urlsafe(24))  # без секрета webhook не стартует
+    if not args.real_limits:
+        os.environ.setdefault("OUTBOX_GLOBAL_RATE", "100000")
+        os.environ.setdefault("OUTBOX_CHAT_RATE", "100000")
+        os.environ.setdefault("OUTBOX_CHAT_BURST", "100000")
+    import db_pool
+
+    db_pool.POOL.path = os.path.join(tempfile.mkdtemp(prefix="loadtest_"), "bot.db")
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    import bot as app
+    import webhook
+    from metrics import ApiMetrics
+
+    args.webhook_url = f"http://{FAKE_HOST}:{webhook.WEBHOOK_PORT}{webhook.WEBHOOK_PATH}"
+    app.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(base))
+    app.bot.session.middleware(ApiMetrics())  # новая сессия — заново вешаем метрики Bot API
+    timer = UpdateTimer()
+    app.dp.update.outer_middleware(timer)
+    sql = SqlCounter()
+    await sql.attach(db_pool.POOL)
+
+    bot_task = asyncio.create_task(app.main())
+    # бот готов, когда начал опрашивать getUpdates / поднял webhook (он стартует после getChat)
+    for _ in range(200):
+        await asyncio.sleep(0.05)
+        if api.calls["getUpdates"] or (args.mode == "webhook" and api.calls["getChat"]):
+            break
+    await asyncio.sleep(0.2)
+
+    timer.active = True
+    sql0, calls0 = sql.count, Counter(api.calls)
+    go.set()
+    out = await asyncio.wrap_future(finished)
+    for _ in range(100):  # хвост: апдейты, которые бот ещё обрабатывает
+        if len(timer.samples) >= out["sent"]:
+            break
+        await asyncio.sleep(0.05)
+    timer.active = False
+    queries = sql.count - sql0
+
+    if args.mode == "polling":
+        await app.dp.stop_polling()
+    else:
+        bot_task.cancel()
+    try:
+        await bot_task
+    except asyncio.CancelledError:
+        pass
+    stop.set()
+    world.join()
+
+    processed = len(timer.samples)
+    elapsed = out["elapsed"]
+    calls = api.calls - calls0
+    calls.pop("getUpdates", None)
+    print()
+    print(f"=== loadtest: mode={args.mode} users={args.users} rounds={args.rounds} messages={args.messages} "
+          f"latency={args.latency * 1000:.0f} ms p429={args.p429} ===")
+    print(f"апдейтов отправлено/обработано: {out['sent']}/{processed} за {elapsed:.2f} s "
+          f"→ {processed / elapsed if elapsed else 0:.0f} upd/s")
+    print(f"обработка апдейта: {_percentiles(timer.samples)}")
+    print(f"SQL-операторов: {queries} → {queries / processed if processed else 0:.1f} на апдейт")
+    print(f"диалогов начато: {out['chats']}; 429 выдано: {api.injected_429}")
+    print("Bot API: " + ", ".join(f"{k} {v}" for k, v in calls.most_common()))
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Нагрузочный прогон бота на фейковом Bot API")
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--rounds", type=int, default=2, help="сколько раз каждый ищет собеседника")
+    ap.add_argument("--messages", type=int, default=5, help="сообщений в одном диалоге")
+    ap.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+    ap.add_argument("--latency", type=float, default=0.0, help="задержка ответа Bot API, сек")
+    ap.add_argument("--p429", type=float, default=0.0, help="доля send*/edit*, получающих 429")
+    ap.add_argument("--think", type=float, default=0.05, help="пауза пользователя между сообщениями, сек (макс.)")
+    ap.add_argument("--timeout", type=float, default=15.0, help="ожидание ответа бота, сек")
+    ap.add_argument("--match-timeout", type=float, default=5.0, help="ожидание собеседника, сек")
+    ap.add_argument("--real-limits", action="store_true", help="не снимать лимиты OUTBOX (28 msg/s)")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+# matchmaker.py
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from db_pool import db, db_read
+
+ANY = "Не важно"
+
+# кого ищем -> какой пол подходит; пол -> как его «ищут»
+WANT_GENDER = {"Парни": "Парень", "Девушки": "Девушка"}
+SEEK_OF_GENDER = {"Парень": "Парни", "Девушка": "Девушки"}
+
+Key = Tuple[str, str]  # (gender, seeking)
+
+
+def compatible(g1: str, s1: str, g2: str, s2: str) -> bool:
+    """Подходят ли друг другу (g1, s1) и (g2, s2) — та же логика, что была в SQL find_partner."""
+    if s1 != ANY and g2 != WANT_GENDER.get(s1):
+        return False
+    if s2 != ANY and s2 != SEEK_OF_GENDER.get(g1):
+        return False
+    return True
+
+
+class Matchmaker:
+    """
+    Очередь поиска в памяти: FIFO-корзины по (gender, seeking).
+    Поиск смотрит только головы совместимых корзин (их не больше шести),
+    а таблица `queue` — лишь журнал для восстановления после рестарта
+    (пишется пачками через flush()).
+    """
+
+    def __init__(self) -> None:
+        self.buckets: Dict[Key, "OrderedDict[int, int]"] = {}  # key -> {tg_id: seq}
+        self.where: Dict[int, Tuple[Key, int]] = {}            # tg_id -> (key, seq)
+        self.ts: Dict[int, int] = {}                           # tg_id -> unix ts постановки
+        self._seq = 0
+        self._compat: Dict[Key, List[Key]] = {}
+        # write-behind: tg_id -> (gender, seeking, ts) для вставки или None для удаления
+        self._pending: Dict[int, Optional[Tuple[str, str, int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.where)
+
+    def __contains__(self, tg_id: int) -> bool:
+        return tg_id in self.where
+
+    def _compatible_keys(self, key: Key) -> List[Key]:
+        keys = self._compat.get(key)
+        if keys is None:
+            g, s = key
+            keys = [k for k in self.buckets if compatible(g, s, k[0], k[1])]
+            self._compat[key] = keys
+        return keys
+
+    def _put(self, tg_id: int, gender: str, seeking: str, ts: int) -> None:
+        key = (gender, seeking)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = OrderedDict()
+            self._compat.clear()  # появилась новая корзина — пересчитаем совместимость
+        self._seq += 1
+        bucket[tg_id] = self._seq
+        self.where[tg_id] = (key, self._seq)
+        self.ts[tg_id] = ts
+
+    def add(self, tg_id: int, gender: str, seeking: str, ts: Optional[int] = None) -> None:
+        """INSERT OR REPLACE: повторная постановка переносит в хвост."""
+        self.remove(tg_id, log=False)
+        ts = int(ts if ts is not None else time.time())
+        self._put(tg_id, gender, seeking, ts)
+        self._pending[tg_id] = (gender, seeking, ts)
+
+    def remove(self, tg_id: int, log: bool = True) -> bool:
+        item = self.where.pop(tg_id, None)
+        if log:
+            self._pending[tg_id] = None
+        if item is None:
+            return False
+        key, _seq = item
+        self.buckets[key].pop(tg_id, None)
+        self.ts.pop(tg_id, None)
+        return True
+
+    def find(self, tg_id: int, gender: str, seeking: str, blocked: Iterable[int] = ()) -> Optional[int]:
+        """Самый давний совместимый кандидат (не сам и не из blocked)."""
+        blocked = blocked if isinstance(blocked, (set, frozenset)) else set(blocked)
+        best_id, best_seq = None, None
+        for key in self._compatible_keys((gender, seeking)):
+            for cand, seq in self.buckets[key].items():
+                if cand == tg_id or cand in blocked:
+                    continue
+                if best_seq is None or seq < best_seq:
+                    best_id, best_seq = cand, seq
+                break  # дальше в корзине только более новые
+        return best_id
+
+    def claim(self, tg_id: int, gender: str, seeking: str, blocked: Iterable[int] = ()) -> Optional[int]:
+        """find() + сразу снимает обоих с очереди, чтобы кандидата не забрал параллельный поиск."""
+        mate = self.find(tg_id, gender, seeking, blocked)
+        if mate is not None:
+            self.remove(mate)
+            self.remove(tg_id)
+        return mate
+
+    def entry(self, tg_id: int) -> Optional[Key]:
+        item = self.where.get(tg_id)
+        return item[0] if item else None
+
+    def clear(self) -> None:
+        self.buckets.clear()
+        self.where.clear()
+        self.ts.clear()
+        self._compat.clear()
+        self._pending.clear()
+        self._seq = 0
+
+    # ------------------ журнал в SQLite ------------------
+    async def load(self) -> int:
+        """Поднять очередь из таблицы `queue` (после рестарта)."""
+        self.clear()
+        async with db_read() as conn:
+            cur = await conn.execute(
+                "SELECT tg_id, gender, seeking, COALESCE(ts,0) FROM queue ORDER BY ts ASC"
+            )
+            rows = await cur.fetchall()
+        for tg_id, gender, seeking, ts in rows:
+            if gender and seeking:
+                self._put(int(tg_id), gender, seeking, int(ts))
+        return len(self.where)
+
+    async def flush(self) -> int:
+        """Записать накопленные изменения очереди одной транзакцией."""
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        ins = [(uid, v[0], v[1], v[2]) for uid, v in pending.items() if v is not None]
+        dels = [(uid,) for uid, v in pending.items() if v is None]
+        try:
+            async with db() as conn:
+                if dels:
+                    await conn.executemany("DELETE FROM queue WHERE tg_id=?", dels)
+                if ins:
+                    await conn.executemany(
+                        "INSERT OR REPLACE INTO queue(tg_id, gender, seeking, ts) VALUES(?,?,?,?)", ins
+                    )
+                await conn.commit()
+        except Exception as e:
+            # вернём несохранённое назад (более свежие изменения не затираем)
+            for uid, v in pending.items():
+                self._pending.setdefault(uid, v)
+            print("[matchmaker] flush failed:", repr(e))
+            return 0
+        return len(pending)
+
+    async def run_flusher(self, interval: float = 1.0) -> None:
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                await self.flush()
+        except asyncio.CancelledError:
+            await self.flush()
+            raise
+
+
+MATCHMAKER = Matchmaker()
+
+__all__ = [
+    "ANY",
+    "compatible",
+    "Matchmaker",
+    "MATCHMAKER",
+]
@@ -0,0 +1,302 @@
+# metrics.py
+"""
+Метрики в формате Prometheus (text exposition 0.0.4) без внешних зависимостей.
+
+    METRICS.counter(...).inc("label")       — счётчики
+    METRICS.histogram(...).observe(dt, ...) — гистограммы задержек
+    METRICS.gauge(...).set(v) / gauge_fn()  — текущие значения
+
+Отдаются по GET /metrics (METRICS_HOST:METRICS_PORT, по умолчанию 127.0.0.1:9108;
+METRICS_PORT=0 — не поднимать сервер).
+"""
+from __future__ import annotations
+
+import os
+import time
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.event.bases import SkipHandler
+from aiohttp import web
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1") or "127.0.0.1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108") or 0)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt_value(v: float) -> str:
+    if v != v:
+        return "NaN"
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) and not v.is_integer() else str(int(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def total(self) -> float:
+        return sum(self._values.values())
+
+    def render(self) -> List[str]:
+        return self.header() + [
+            f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_value(v)}" for k, v in sorted(self._values.items())
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *labels: str) -> None:
+        self._values[labels] = float(value)
+
+    def dec(self, *labels: str, amount: float = 1.0) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class GaugeFn(_Metric):
+    """Gauge, значение которого читается в момент отдачи (len(ACTIVE) и т. п.)."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float]):
+        super().__init__(name, help)
+        self.fn = fn
+
+    def value(self) -> float:
+        try:
+            return float(self.fn())
+        except Exception:
+            return float("nan")
+
+    def render(self) -> List[str]:
+        return self.header() + [f"{self.name} {_fmt_value(self.value())}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._data: Dict[Labels, list] = {}   # labels -> [счётчики по корзинам..., sum, count]
+
+    def observe(self, value: float, *labels: str) -> None:
+        d = self._data.get(labels)
+        if d is None:
+            d = self._data[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                d[i] += 1
+                break
+        d[-2] += value
+        d[-1] += 1
+
+    def count(self, *labels: str) -> int:
+        d = self._data.get(labels)
+        return d[-1] if d else 0
+
+    def mean(self, *labels: str) -> float:
+        d = self._data.get(labels)
+        return (d[-2] / d[-1]) if d and d[-1] else 0.0
+
+    def items(self) -> List[Tuple[Labels, int, float]]:
+        """(labels, count, sum) по всем сериям."""
+        return [(k, d[-1], d[-2]) for k, d in self._data.items()]
+
+    def render(self) -> List[str]:
+        out = self.header()
+        for k, d in sorted(self._data.items()):
+            acc = 0
+            for i, b in enumerate(self.buckets):
+                acc += d[i]
+                le = 'le="%s"' % b
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, k, le)} {acc}")
+            le = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_fmt_labels(self.labels, k, le)} {d[-1]}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, k)} {d[-2]!r}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, k)} {d[-1]}")
+        return out
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _add(self, m: _Metric) -> _Metric:
+        old = self._metrics.get(m.name)
+        if old is not None:
+            return old
+        self._metrics[m.name] = m
+        return m
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, help, labels))
+
+    def gauge_fn(self, name: str, help: str, fn: Callable[[], float]) -> GaugeFn:
+        m = self._metrics.get(name)
+        if isinstance(m, GaugeFn):
+            m.fn = fn
+            return m
+        return self._add(GaugeFn(name, help, fn))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def get(self, name: str) -> Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for m in self._metrics.values():
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Registry()
+
+# ------------------ стандартные метрики бота ------------------
+HANDLER_LATENCY = METRICS.histogram(
+    "bot_handler_seconds", "Время работы хэндлера aiogram", ("handler",))
+HANDLER_ERRORS = METRICS.counter(
+    "bot_handler_errors_total", "Исключения в хэндлерах", ("handler", "error"))
+HANDLER_SKIPS = METRICS.counter(
+    "bot_handler_skips_total", "SkipHandler (апдейт отдан следующему хэндлеру)", ("handler",))
+SQL_LATENCY = METRICS.histogram(
+    "bot_sql_seconds", "Время выполнения SQL-оператора", ("statement",))
+SQL_ERRORS = METRICS.counter(
+    "bot_sql_errors_total", "SQL-операторы, завершившиеся ошибкой", ("statement",))
+API_LATENCY = METRICS.histogram(
+    "bot_api_seconds", "Время вызова Bot API", ("method",))
+API_ERRORS = METRICS.counter(
+    "bot_api_errors_total", "Ошибки вызовов Bot API", ("method", "error"))
+
+
+@lru_cache(maxsize=4096)
+def sql_label(sql: str) -> str:
+    """Текст оператора без лишних пробелов и не длиннее 80 символов — как метка."""
+    s = " ".join(sql.split())
+    return s if len(s) <= 80 else s[:77] + "..."
+
+
+def observe_sql(sql: str, seconds: float, ok: bool) -> None:
+    """Хук для db_pool.add_query_hook()."""
+    label = sql_label(sql)
+    SQL_LATENCY.observe(seconds, label)
+    if not ok:
+        SQL_ERRORS.inc(label)
+
+
+class HandlerMetrics(BaseMiddleware):
+    """Inner-middleware aiogram: задержка и ошибки по имени функции-хэндлера."""
+
+    async def __call__(self, handler, event, data):
+        h = data.get("handler")
+        name = getattr(getattr(h, "callback", None), "__name__", "unknown")
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except SkipHandler:
+            HANDLER_SKIPS.inc(name)
+            raise
+        except Exception as e:
+            HANDLER_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - t0, name)
+
+
+class ApiMetrics(BaseRequestMiddleware):
+    """Request-middleware сессии aiogram: задержка и ошибки по методу Bot API."""
+
+    async def __call__(self, make_request, bot, method):
+        name = getattr(method, "__api_method__", type(method).__name__)
+        t0 = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - t0, name)
+
+
+# ------------------ HTTP ------------------
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=METRICS.render().encode("utf-8"),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> Optional[web.AppRunner]:
+    """Поднять GET /metrics. Вернёт runner (для cleanup()) или None, если сервер выключен/не поднялся."""
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        print("[metrics] cannot listen:", repr(e))
+        await runner.cleanup()
+        return None
+    return runner
+
+
+__all__ = [
+    "METRICS",
+    "Registry",
+    "Counter",
+    "Gauge",
+    "GaugeFn",
+    "Histogram",
+    "HANDLER_LATENCY",
+    "SQL_LATENCY",
+    "API_LATENCY",
+    "observe_sql",
+    "HandlerMetrics",
+    "ApiMetrics",
+    "start_metrics_server",
+]
@@ -0,0 +1,128 @@
+# migrations.py
+"""
+Версионные миграции схемы вместо «CREATE IF NOT EXISTS + PRAGMA table_info на каждом старте».
+
+Каждая схема (bot — bot.py, legacy — db_schema.py, extra — features_extra.py)
+хранит свою версию в schema_version. На тёплом старте migrate() делает один
+SELECT версии и выходит; новые миграции применяются по порядку, каждая в своей
+транзакции (DDL в SQLite транзакционный): либо миграция целиком, либо ничего.
+
+    MIGRATIONS = [
+        Migration(1, "baseline", [CREATE_SQL, add_column("users", "points", "INTEGER DEFAULT 0")]),
+        Migration(2, "indexes", ["CREATE INDEX ..."]),
+    ]
+    await migrate("bot", MIGRATIONS)
+
+Уже применённые миграции не меняют — изменение схемы = новая миграция с номером побольше.
+"""
+from __future__ import annotations
+
+import sqlite3
+import time
+from typing import Awaitable, Callable, List, Sequence, Tuple, Union
+
+from db_pool import db
+
+Step = Union[str, Callable[..., Awaitable[None]]]
+
+VERSION_SQL = "SELECT version FROM schema_version WHERE name=?"
+VERSION_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS schema_version(
+  name TEXT PRIMARY KEY,
+  version INTEGER NOT NULL,
+  applied_at INTEGER DEFAULT (strftime('%s','now'))
+)
+"""
+
+
+class Migration:
+    __slots__ = ("version", "name", "steps")
+
+    def __init__(self, version: int, name: str, steps: Sequence[Step]):
+        self.version = version
+        self.name = name
+        self.steps = list(steps)
+
+
+def split_sql(script: str) -> List[str]:
+    """Скрипт -> отдельные операторы (executescript сам делает COMMIT, в транзакции им нельзя)."""
+    out: List[str] = []
+    buf = ""
+    for line in script.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            out.append(buf)
+            buf = ""
+    if buf.strip():
+        if not sqlite3.complete_statement(buf + ";"):
+            raise ValueError(f"незавершённый SQL в миграции: {buf.strip()[:80]!r}")
+        out.append(buf)  # одиночный оператор без «;»
+    stmts = []
+    for chunk in out:
+        stmt = "\n".join(ln for ln in chunk.strip().splitlines() if not ln.strip().startswith("--")).strip()
+        if stmt.rstrip(";").strip():
+            stmts.append(stmt)
+    return stmts
+
+
+def add_column(table: str, column: str, decl: str) -> Callable[..., Awaitable[None]]:
+    """Шаг миграции: ALTER TABLE ... ADD COLUMN, если колонки ещё нет
+    (базы, созданные до миграций, могли уже получить её старыми ALTERS)."""
+    async def step(conn) -> None:
+        cur = await conn.execute(f"PRAGMA table_info({table})")
+        if column not in {r[1] for r in await cur.fetchall()}:
+            await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    step.__name__ = f"add_column_{table}_{column}"
+    return step
+
+
+async def current_version(conn, schema: str) -> int:
+    try:
+        cur = await conn.execute(VERSION_SQL, (schema,))
+    except sqlite3.OperationalError:
+        return 0  # schema_version ещё нет — новая или «домиграционная» база
+    row = await cur.fetchone()
+    return int(row[0]) if row else 0
+
+
+async def migrate(schema: str, migrations: Sequence[Migration]) -> Tuple[int, int]:
+    """Довести схему до последней версии. Вернёт (было, стало)."""
+    target = max((m.version for m in migrations), default=0)
+    async with db() as conn:
+        start = await current_version(conn, schema)
+        if start >= target:
+            return start, start
+        version = start
+        for m in sorted(migrations, key=lambda m: m.version):
+            if m.version <= version:
+                continue
+            t0 = time.perf_counter()
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                await conn.execute(VERSION_TABLE_SQL)
+                for step in m.steps:
+                    if isinstance(step, str):
+                        for stmt in split_sql(step):
+                            await conn.execute(stmt)
+                    else:
+                        await step(conn)
+                await conn.execute(
+                    "INSERT OR REPLACE INTO schema_version(name, version) VALUES(?,?)", (schema, m.version)
+                )
+                await conn.commit()
+            except Exception as e:
+                await conn.rollback()
+                print(f"[migrations] {schema} #{m.version} {m.name} failed:", repr(e))
+                raise
+            version = m.version
+            print(f"[migrations] {schema} #{m.version} {m.name}: {(time.perf_counter() - t0) * 1000:.1f} ms")
+    return start, version
+
+
+__all__ = [
+    "Migration",
+    "migrate",
+    "add_column",
+    "split_sql",
+    "current_version",
+]
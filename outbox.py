@@ -0,0 +1,313 @@
+# outbox.py
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+# Полосы приоритета: чем меньше — тем раньше уходит
+LANE_RELAY = 0       # сообщения собеседнику в анонимном чате
+LANE_SYSTEM = 1      # системные уведомления (приветствие, таймеры, саппорт, жалобы)
+LANE_BROADCAST = 2   # рассылки
+LANES = (LANE_RELAY, LANE_SYSTEM, LANE_BROADCAST)
+LANE_NAMES = {LANE_RELAY: "relay", LANE_SYSTEM: "system", LANE_BROADCAST: "broadcast"}
+
+# Лимиты Telegram: ~30 сообщений/сек на бота, ~1/сек в один чат (короткие всплески допустимы)
+GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "28") or 28)
+CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1") or 1)
+CHAT_BURST = float(os.getenv("OUTBOX_CHAT_BURST", "5") or 5)
+WORKERS = int(os.getenv("OUTBOX_WORKERS", "8") or 8)
+MAX_RETRIES = 3
+
+Factory = Callable[[], Awaitable[Any]]
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float, now: Optional[float] = None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.stamp = time.monotonic() if now is None else now
+
+    def _refill(self, now: float) -> None:
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def delay(self, now: float) -> float:
+        """0 — токен есть; иначе сколько секунд ждать до следующего."""
+        self._refill(now)
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+    def take(self, now: float) -> float:
+        """Взять токен, если он есть (вернёт 0), иначе вернёт время ожидания."""
+        wait = self.delay(now)
+        if wait == 0.0:
+            self.tokens -= 1.0
+        return wait
+
+    def refund(self) -> None:
+        self.tokens = min(self.burst, self.tokens + 1.0)
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _Job:
+    __slots__ = ("lane", "seq", "chat_id", "factory", "future", "attempts", "t_enq")
+
+    def __init__(self, lane: int, seq: int, chat_id: int, factory: Factory, future: asyncio.Future):
+        self.lane = lane
+        self.seq = seq
+        self.chat_id = chat_id
+        self.factory = factory
+        self.future = future
+        self.attempts = 0
+        self.t_enq = time.monotonic()
+
+
+class Outbox:
+    """
+    Центральная очередь исходящих вызовов Bot API.
+
+    - порядок внутри одного чата строго FIFO, между чатами — по полосе приоритета
+      (чат наследует лучший приоритет из своих ожидающих сообщений);
+    - общий и поштучный (на чат) token bucket под лимиты Telegram;
+    - на 429 (retry_after) очередь встаёт на паузу и сообщение повторяется;
+    - хэндлеру не нужно ждать ответа Telegram: submit() сразу отдаёт Future.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+                 chat_burst: float = CHAT_BURST, workers: int = WORKERS, max_retries: int = MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers_count = workers
+        self.max_retries = max_retries
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._chats: Dict[int, Deque[_Job]] = {}
+        self._ready: List[Tuple[int, int, int]] = []   # (lane, seq, chat_id)
+        self._busy: Set[int] = set()
+        self._seq = itertools.count(1)
+        self._wake: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self._paused_until = 0.0
+        # метрики
+        self.depth = {lane: 0 for lane in LANES}
+        self.submitted = {lane: 0 for lane in LANES}
+        self.sent = {lane: 0 for lane in LANES}
+        self.failed = {lane: 0 for lane in LANES}
+        self.wait_avg = {lane: 0.0 for lane in LANES}   # EWMA ожидания в очереди, сек
+        self.wait_max = {lane: 0.0 for lane in LANES}
+        self.retries = 0
+        self.errors: Dict[str, int] = {}   # тип исключения -> сколько отправок им закончилось
+
+    # ------------------ жизненный цикл ------------------
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    def start(self) -> None:
+        if self._workers:
+            return
+        self._wake = asyncio.Event()
+        if self._ready:
+            self._wake.set()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers_count)]
+
+    async def stop(self, drain_timeout: float = 5.0) -> None:
+        """Дождаться (ограниченно) пустой очереди и остановить воркеров."""
+        deadline = time.monotonic() + drain_timeout
+        while self.pending() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for t in self._workers:
+            t.cancel()
+        for t in self._workers:
+            try:
+                await t
+            except asyncio.CancelledError:
+                pass
+        self._workers = []
+
+    # ------------------ постановка ------------------
+    def submit(self, chat_id: int, factory: Factory, lane: int = LANE_SYSTEM) -> asyncio.Future:
+        """
+        factory — функция без аргументов, возвращающая корутину вызова
+        (чтобы при повторе после 429 создать вызов заново).
+        """
+        loop = asyncio.get_running_loop()
+        if not self._workers:
+            self.start()
+        fut = loop.create_future()
+        fut.add_done_callback(_retrieve)
+        job = _Job(lane, next(self._seq), chat_id, factory, fut)
+        self._chats.setdefault(chat_id, deque()).append(job)
+        self.depth[lane] += 1
+        self.submitted[lane] += 1
+        self._push(lane, job.seq, chat_id)
+        return fut
+
+    async def call(self, chat_id: int, factory: Factory, lane: int = LANE_SYSTEM) -> Any:
+        return await self.submit(chat_id, factory, lane)
+
+    async def wait_below(self, lane: int, limit: int) -> None:
+        """Обратное давление для массовых отправителей: ждём, пока полоса не разгрузится."""
+        while self.depth[lane] >= limit:
+            await asyncio.sleep(0.05)
+
+    def pending(self) -> int:
+        return sum(self.depth.values())
+
+    def _push(self, lane: int, seq: int, chat_id: int) -> None:
+        heapq.heappush(self._ready, (lane, seq, chat_id))
+        if self._wake is not None:
+            self._wake.set()
+
+    def _reschedule(self, chat_id: int) -> None:
+        dq = self._chats.get(chat_id)
+        if dq:
+            self._push(min(j.lane for j in dq), dq[0].seq, chat_id)
+
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        b = self._chat_buckets.get(chat_id)
+        if b is None:
+            if len(self._chat_buckets) > 50_000:
+                for cid in [c for c, bb in self._chat_buckets.items() if bb.full(now) and c not in self._chats]:
+                    del self._chat_buckets[cid]
+            b = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return b
+
+    # ------------------ воркер ------------------
+    async def _global_token(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            wait = self.global_bucket.take(now)
+            if wait == 0.0:
+                return
+            await asyncio.sleep(wait)
+
+    def _pop_chat(self) -> Optional[int]:
+        while self._ready:
+            _lane, _seq, chat_id = heapq.heappop(self._ready)
+            if chat_id in self._busy or not self._chats.get(chat_id):
+                continue
+            return chat_id
+        return None
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self._ready:
+                self._wake.clear()
+                await self._wake.wait()
+            await self._global_token()
+            chat_id = self._pop_chat()
+            if chat_id is None:
+                self.global_bucket.refund()
+                continue
+            now = time.monotonic()
+            wait = self._chat_bucket(chat_id, now).take(now)
+            if wait > 0:
+                # чат упёрся в свой лимит — не держим воркера, вернём чат в очередь позже
+                self.global_bucket.refund()
+                loop.call_later(wait, self._reschedule, chat_id)
+                continue
+
+            self._busy.add(chat_id)
+            dq = self._chats[chat_id]
+            job = dq.popleft()
+            try:
+                await self._run(job, dq)
+            finally:
+                self._busy.discard(chat_id)
+                if not dq:
+                    self._chats.pop(chat_id, None)
+                else:
+                    self._reschedule(chat_id)
+
+    async def _run(self, job: _Job, dq: Deque[_Job]) -> None:
+        lane = job.lane
+        waited = time.monotonic() - job.t_enq
+        self.wait_avg[lane] = waited if self.sent[lane] == 0 else self.wait_avg[lane] * 0.9 + waited * 0.1
+        if waited > self.wait_max[lane]:
+            self.wait_max[lane] = waited
+        try:
+            result = await job.factory()
+        except asyncio.CancelledError:
+            dq.appendleft(job)
+            raise
+        except Exception as e:
+            retry_after = getattr(e, "retry_after", None)
+            if retry_after is not None and job.attempts < self.max_retries:
+                job.attempts += 1
+                self.retries += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + float(retry_after))
+                dq.appendleft(job)   # остаётся первым в своём чате
+                return
+            self.depth[lane] -= 1
+            self.failed[lane] += 1
+            name = type(e).__name__
+            self.errors[name] = self.errors.get(name, 0) + 1
+            # relay/system почти всегда «выстрелил и забыл» — без лога ошибку никто не увидит;
+            # рассылка считает заблокировавших и ошибки сама (broadcast.py)
+            if lane != LANE_BROADCAST:
+                print(f"[outbox] {LANE_NAMES[lane]} -> {job.chat_id} failed:", repr(e))
+            if not job.future.done():
+                job.future.set_exception(e)
+            return
+        self.depth[lane] -= 1
+        self.sent[lane] += 1
+        if not job.future.done():
+            job.future.set_result(result)
+
+    # ------------------ метрики ------------------
+    def stats(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            "pending": self.pending(),
+            "retries": self.retries,
+            "paused_for": max(0.0, self._paused_until - time.monotonic()),
+            "chats_waiting": len(self._chats),
+            "errors": dict(self.errors),
+        }
+        for lane in LANES:
+            name = LANE_NAMES[lane]
+            out[name] = {
+                "depth": self.depth[lane],
+                "submitted": self.submitted[lane],
+                "sent": self.sent[lane],
+                "failed": self.failed[lane],
+                "wait_avg": round(self.wait_avg[lane], 4),
+                "wait_max": round(self.wait_max[lane], 4),
+            }
+        return out
+
+
+def _retrieve(fut: asyncio.Future) -> None:
+    # для «выстрелил и забыл»: не даём asyncio ругаться на непрочитанное исключение
+    # (оно уже залогировано и посчитано в Outbox._run — stats()["errors"])
+    if not fut.cancelled():
+        fut.exception()
+
+
+OUTBOX = Outbox()
+
+__all__ = [
+    "LANE_RELAY",
+    "LANE_SYSTEM",
+    "LANE_BROADCAST",
+    "TokenBucket",
+    "Outbox",
+    "OUTBOX",
+]
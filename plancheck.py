@@ -0,0 +1,215 @@
+# plancheck.py
+"""
+Регрессия планов запросов: не дать правкам SQL/индексов тихо вернуть перебор таблиц.
+
+Берёт SQL прямо из исходников (строки, переданные в conn.execute/executemany,
+в том числе через константы модуля), строит пустую БД через bot.init_db()
+и для каждого оператора смотрит EXPLAIN QUERY PLAN:
+    - полный перебор таблицы (SCAN t без индекса) — ошибка, если оператор
+      не в ALLOWED_SCANS с объяснением, почему так и должно быть;
+    - для горячих запросов (EXPECT) план обязан использовать указанные индексы.
+Операторы, собранные f-строкой, не проверяются.
+
+    python plancheck.py           # проверка; код выхода 1 при нарушениях
+    python plancheck.py --show    # планы всех найденных операторов
+
+Проверяется схема bot.py и модулей, которые он использует; у bot_main.py и
+features_extra.py своя (старая) схема — их запросы сюда не входят.
+"""
+from __future__ import annotations
+
+import argparse
+import ast
+import asyncio
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from typing import Dict, List, Optional, Tuple
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCES = ("bot.py", "matchmaker.py", "broadcast.py", "usercache.py", "roles.py", "shop.py", "fsmstore.py")
+
+# функция (или "файл:функция") -> индексы, которые её запросы обязаны использовать
+EXPECT: Dict[str, Tuple[str, ...]] = {
+    "last_match_info": ("idx_matches_a", "idx_matches_b"),
+    "end_current_chat": ("idx_matches_active_a", "idx_matches_active_b"),
+    "handle_reveal": ("idx_matches_active_a", "idx_matches_active_b"),
+    "load_active_sessions": ("idx_matches_live",),
+    "check_active_consistency": ("idx_matches_live",),
+    "admin_support_menu": ("idx_support_open",),
+    "adm_support": ("idx_support_open",),
+    "sup_open": ("idx_support_open",),
+    "support_done": ("idx_support_open",),
+    "sup_close": ("idx_support_open",),
+    "purchases_summary": ("idx_purchases_user_ts",),
+    "count_referrals": ("idx_referrals_inviter",),
+    "get_or_create_ref_code": ("idx_ref_codes_inviter",),
+    "matchmaker.py:load": ("idx_queue_ts",),
+}
+
+# (функция, начало оператора) -> почему перебор допустим.
+# Перебор — любая строка плана «SCAN t …», в том числе по (покрывающему) индексу:
+# читаются все записи индекса. Частичные индексы (idx_matches_live, idx_support_open)
+# перебирать можно — в них только живые строки; что используется именно индекс,
+# проверяет EXPECT.
+ALLOWED_SCANS: Dict[Tuple[str, str], str] = {
+    ("load_settings_cache", "SELECT key, value FROM settings"): "старт, читается вся таблица",
+    ("load_totals", "SELECT (SELECT COUNT(*) FROM users)"): "старт, один раз; дальше счётчики в памяти",
+    ("main", "SELECT NOT EXISTS(SELECT 1 FROM rating_stats)"): "старт, до первой строки",
+    ("items", "SELECT id,name,price,type,payload FROM shop_items"): "каталог — десятки строк, перечитывается только после invalidate()",
+    ("create", "SELECT COUNT(*) FROM users WHERE COALESCE(bot_blocked,0)=0"): "рассылка идёт по всем пользователям",
+    ("resume", "SELECT id FROM broadcasts WHERE status='running'"): "старт, рассылок единицы",
+    ("load", "SELECT tg_id FROM users WHERE role='admin'"): "старт, ROLES.load (roles.py)",
+    ("load", "SELECT tg_id FROM users"): "один раз за процесс, KNOWN_USERS (usercache.py)",
+    ("load", "SELECT tg_id, gender, seeking, COALESCE(ts,0) FROM queue"): "старт, вся очередь по idx_queue_ts",
+    ("backfill_rating_stats", "INSERT INTO rating_stats"): "разовый пересчёт по всем оценкам",
+    ("load_active_sessions", "SELECT id, a_id, b_id, COALESCE(last_activity"): "частичный idx_matches_live",
+    ("check_active_consistency", "SELECT id, a_id, b_id FROM matches WHERE active=1"): "частичный idx_matches_live",
+    ("main", "UPDATE matches SET active=0 WHERE active=1"): "старт, частичный idx_matches_live",
+    ("admin_support_menu", "SELECT from_user, MAX(ts) AS last_ts FROM support_msgs"): "частичный idx_support_open",
+    ("adm_support", "SELECT from_user, MAX(ts) AS last_ts FROM support_msgs"): "частичный idx_support_open",
+}
+
+_SCAN_RE = re.compile(r"^SCAN (\w+)\b")   # и «SCAN t USING [COVERING] INDEX …» — это тоже все строки
+_DML = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+
+class Statement:
+    __slots__ = ("file", "line", "func", "sql", "plan", "error")
+
+    def __init__(self, file: str, line: int, func: str, sql: str):
+        self.file = file
+        self.line = line
+        self.func = func
+        self.sql = sql
+        self.plan: List[str] = []
+        self.error: Optional[str] = None
+
+    @property
+    def where(self) -> str:
+        return f"{self.file}:{self.line} {self.func}"
+
+    @property
+    def head(self) -> str:
+        return " ".join(self.sql.split())[:60]
+
+
+def collect(path: str) -> List[Statement]:
+    """Все SQL-строки из conn.execute(...)/executemany(...) файла с именем функции вокруг."""
+    tree = ast.parse(open(path, encoding="utf-8").read(), path)
+    consts = {
+        t.id: n.value.value
+        for n in tree.body if isinstance(n, ast.Assign) and isinstance(n.value, ast.Constant)
+        and isinstance(n.value.value, str)
+        for t in n.targets if isinstance(t, ast.Name)
+    }
+    out: List[Statement] = []
+    name = os.path.basename(path)
+
+    def visit(node: ast.AST, func: str) -> None:
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                visit(child, child.name)
+                continue
+            if (isinstance(child, ast.Call) and isinstance(child.func, ast.Attribute)
+                    and child.func.attr in ("execute", "executemany") and child.args):
+                arg = child.args[0]
+                sql = None
+                if isinstance(arg, ast.Constant) and isinstance(arg.value, str):
+                    sql = arg.value
+                elif isinstance(arg, ast.Name):
+                    sql = consts.get(arg.id)
+                if sql and sql.lstrip().upper().startswith(_DML):
+                    out.append(Statement(name, child.lineno, func, sql))
+            visit(child, func)
+
+    visit(tree, "<module>")
+    return out
+
+
+async def _build_schema(path: str) -> None:
+    import db_pool
+
+    db_pool.POOL.path = path
+    import bot as app
+
+    await app.init_db()
+    await app.FSM_STORAGE.start()
+    await db_pool.close_pool()
+
+
+def explain(conn: sqlite3.Connection, st: Statement) -> None:
+    params = (None,) * st.sql.count("?")
+    try:
+        st.plan = [r[-1] for r in conn.execute("EXPLAIN QUERY PLAN " + st.sql, params).fetchall()]
+    except sqlite3.Error as e:
+        st.error = str(e)
+
+
+def problems(st: Statement) -> List[str]:
+    if st.error:
+        return [f"не разбирается на текущей схеме: {st.error}"]
+    out = []
+    allowed = any(st.func == f and st.head.startswith(h) for f, h in ALLOWED_SCANS)
+    for line in st.plan:
+        m = _SCAN_RE.match(line.strip())
+        if m and m.group(1) != "CONSTANT" and not allowed:
+            out.append(f"полный перебор таблицы {m.group(1)}")
+    return out
+
+
+def check(show: bool = False) -> int:
+    statements: List[Statement] = []
+    for src in SOURCES:
+        statements.extend(collect(os.path.join(HERE, src)))
+    db_path = os.path.join(tempfile.mkdtemp(prefix="plancheck_"), "plan.db")
+    asyncio.run(_build_schema(db_path))
+    conn = sqlite3.connect(db_path)
+    for st in statements:
+        explain(conn, st)
+    conn.close()
+
+    failures: List[str] = []
+    for st in statements:
+        for p in problems(st):
+            failures.append(f"{st.where}: {p}\n    {st.head}")
+        if show:
+            print(f"{st.where}: {st.head}")
+            for line in ([f"ОШИБКА: {st.error}"] if st.error else st.plan):
+                print(f"    {line}")
+    # ожидаемые индексы: среди запросов функции есть использующие каждый из них
+    by_func: Dict[str, List[Statement]] = {}
+    for st in statements:
+        by_func.setdefault(st.func, []).append(st)
+        by_func.setdefault(f"{st.file}:{st.func}", []).append(st)
+    for func, need in EXPECT.items():
+        sts = by_func.get(func)
+        if not sts:
+            failures.append(f"{func}: SQL не найден (функция переименована? обновите EXPECT)")
+            continue
+        used = "\n".join(line for st in sts for line in st.plan)
+        for ix in need:
+            if ix not in used:
+                failures.append(f"{sts[0].where}: план не использует {ix}")
+
+    print(f"Операторов проверено: {len(statements)}, нарушений: {len(failures)}")
+    for f in failures:
+        print("  ✗", f)
+    return 1 if failures else 0
+
+
+__all__ = [
+    "EXPECT",
+    "ALLOWED_SCANS",
+    "collect",
+    "check",
+]
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Проверка планов SQL-запросов")
+    ap.add_argument("--show", action="store_true", help="показать планы всех операторов")
+    args = ap.parse_args()
+    sys.exit(check(args.show))
@@ -0,0 +1,59 @@
+# roles.py
+from __future__ import annotations
+
+from typing import Iterable, List, Set
+
+from db_pool import db_read
+
+
+class RoleRegistry:
+    """
+    Кто админ — целиком в памяти.
+
+    Множество = users.role='admin' (грузится при старте) ∪ ADMIN_IDS из .env.
+    Меняется только через grant()/revoke() после commit в admin_admins_apply,
+    поэтому is_admin() — обычная проверка по set, без SQLite.
+    Админов из .env разжаловать нельзя: они остаются админами, как и раньше.
+    """
+
+    def __init__(self, static_ids: Iterable[int] = ()):
+        self.static: Set[int] = set(static_ids)
+        self._db_admins: Set[int] = set()
+        self._admins: Set[int] = set(self.static)
+
+    def set_static(self, ids: Iterable[int]) -> None:
+        self.static = set(ids)
+        self._admins = self.static | self._db_admins
+
+    async def load(self) -> int:
+        async with db_read() as conn:
+            cur = await conn.execute("SELECT tg_id FROM users WHERE role='admin'")
+            self._db_admins = {int(r[0]) for r in await cur.fetchall()}
+        self._admins = self.static | self._db_admins
+        return len(self._admins)
+
+    def is_admin(self, tg_id: int) -> bool:
+        return tg_id in self._admins
+
+    def grant(self, tg_id: int) -> None:
+        self._db_admins.add(tg_id)
+        self._admins.add(tg_id)
+
+    def revoke(self, tg_id: int) -> None:
+        self._db_admins.discard(tg_id)
+        if tg_id not in self.static:
+            self._admins.discard(tg_id)
+
+    def admins(self) -> List[int]:
+        return sorted(self._admins)
+
+    def __len__(self) -> int:
+        return len(self._admins)
+
+
+ROLES = RoleRegistry()
+
+__all__ = [
+    "RoleRegistry",
+    "ROLES",
+]
@@ -0,0 +1,153 @@
+# shop.py
+from __future__ import annotations
+
+import sqlite3
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from db_pool import db, db_read
+
+# результаты PurchaseEngine.buy()
+OK = "ok"
+DUPLICATE = "duplicate"      # покупка с этим ключом уже проведена (повторный тап)
+NO_ITEM = "no_item"          # товара нет или он выключен
+NO_FUNDS = "no_funds"        # не хватает очков
+
+Item = Tuple[int, str, int, str, Optional[str]]   # (id, name, price, type, payload)
+
+
+class Purchase:
+    __slots__ = ("status", "item", "balance", "title")
+
+    def __init__(self, status: str, item: Optional[Item] = None, balance: int = 0, title: Optional[str] = None):
+        self.status = status
+        self.item = item
+        self.balance = balance   # баланс после покупки (или текущий, если не купили)
+        self.title = title       # надетый статус, если товар — статус
+
+    @property
+    def ok(self) -> bool:
+        return self.status == OK
+
+
+class PurchaseEngine:
+    """
+    Покупка одной транзакцией писателя:
+        ключ идемпотентности -> товар -> UPDATE users SET points=points-price
+        WHERE points>=price RETURNING points (+ экипировка статуса) ->
+        инвентарь -> запись в purchases.
+    Проверка баланса и списание — один условный UPDATE, поэтому двойной тап
+    и параллельные покупки не уводят баланс в минус. Повтор с тем же ключом
+    (purchases.idem_key, уникальный) возвращает DUPLICATE без списания.
+    """
+
+    def __init__(self, inventory: bool = True, default_title: Optional[str] = None):
+        self.inventory = inventory            # класть статус в user_statuses (у bot_main.py таблицы нет)
+        self.default_title = default_title    # статус без payload
+
+    async def buy(self, user_id: int, item_id: int, key: Optional[str] = None) -> Purchase:
+        async with db() as conn:
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                if key is not None:
+                    cur = await conn.execute("SELECT 1 FROM purchases WHERE idem_key=?", (key,))
+                    if await cur.fetchone():
+                        await conn.rollback()
+                        return Purchase(DUPLICATE, balance=await _balance(conn, user_id))
+                cur = await conn.execute(
+                    "SELECT id,name,price,type,payload FROM shop_items WHERE id=? AND is_active=1", (item_id,)
+                )
+                item = await cur.fetchone()
+                if not item:
+                    await conn.rollback()
+                    return Purchase(NO_ITEM)
+                _id, _name, price, type_, payload = item
+                title = (payload or self.default_title) if type_ == "status" else None
+                cur = await conn.execute(
+                    "UPDATE users SET points = COALESCE(points,0) - ?, status_title = COALESCE(?, status_title) "
+                    "WHERE tg_id=? AND COALESCE(points,0) >= ? RETURNING points",
+                    (price, title, user_id, price)
+                )
+                rows = await cur.fetchall()
+                if not rows:
+                    await conn.rollback()
+                    return Purchase(NO_FUNDS, item, await _balance(conn, user_id))
+                if title and self.inventory:
+                    await conn.execute(
+                        "INSERT OR IGNORE INTO user_statuses(user_id, title) VALUES(?,?)", (user_id, title)
+                    )
+                await conn.execute(
+                    "INSERT INTO purchases(user_id, item_id, idem_key) VALUES(?,?,?)", (user_id, _id, key)
+                )
+                await conn.commit()
+                return Purchase(OK, item, int(rows[0][0]), title)
+            except sqlite3.IntegrityError:
+                # тот же ключ успел записаться (или у старой схемы unique(user_id,item_id))
+                await conn.rollback()
+                return Purchase(DUPLICATE, balance=await _balance(conn, user_id))
+            except BaseException:
+                await conn.rollback()
+                raise
+
+
+class Catalog:
+    """
+    Снимок активных товаров (ORDER BY price, id) и готовые к нему тексты/клавиатуры.
+
+    Открытие магазина — только память: items() отдаёт кортеж из снимка,
+    view(name, build) — результат build(items), посчитанный один раз на снимок.
+    Любая правка shop_items (добавить/удалить/включить/выключить) обязана
+    позвать invalidate() после commit — следующий items() перечитает таблицу.
+    """
+
+    def __init__(self) -> None:
+        self._items: Optional[Tuple[Item, ...]] = None
+        self._views: Dict[str, Tuple[Tuple[Item, ...], Any]] = {}
+        self.version = 0
+        self.loads = 0
+
+    async def items(self) -> Tuple[Item, ...]:
+        while self._items is None:
+            version = self.version
+            async with db_read() as conn:
+                cur = await conn.execute(
+                    "SELECT id,name,price,type,payload FROM shop_items WHERE is_active=1 ORDER BY price ASC, id ASC"
+                )
+                rows = await cur.fetchall()
+            if version == self.version:  # пока читали, каталог не меняли — снимок свежий
+                self._items = tuple(tuple(r) for r in rows)
+                self.loads += 1
+        return self._items
+
+    async def view(self, name: str, build: Callable[[Tuple[Item, ...]], Any]) -> Any:
+        items = await self.items()
+        cached = self._views.get(name)
+        if cached is None or cached[0] is not items:
+            cached = self._views[name] = (items, build(items))
+        return cached[1]
+
+    def invalidate(self) -> None:
+        self.version += 1
+        self._items = None
+        self._views.clear()
+
+
+async def _balance(conn, user_id: int) -> int:
+    cur = await conn.execute("SELECT COALESCE(points,0) FROM users WHERE tg_id=?", (user_id,))
+    row = await cur.fetchone()
+    return int(row[0]) if row else 0
+
+
+PURCHASES = PurchaseEngine()
+CATALOG = Catalog()
+
+__all__ = [
+    "OK",
+    "DUPLICATE",
+    "NO_ITEM",
+    "NO_FUNDS",
+    "Purchase",
+    "PurchaseEngine",
+    "PURCHASES",
+    "Catalog",
+    "CATALOG",
+]
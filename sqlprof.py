@@ -0,0 +1,350 @@
+# sqlprof.py
+"""
+Профилировщик SQL (включается явно, в обычной работе не стоит ничего).
+
+Все модули (bot.py, bot_main.py, features_extra.py) ходят в БД через db_pool,
+поэтому профилировщик ставится туда трассировщиком (db_pool.set_query_tracer)
+и видит каждый execute/executemany/commit. Для каждого нормализованного
+оператора (литералы -> ?, списки (?,?,?) -> (?+)) копится:
+    число вызовов и ошибок, суммарное/максимальное время,
+    строки (прочитанные fetch*() для SELECT, rowcount для записи),
+    места вызова (файл:строка функция),
+    EXPLAIN QUERY PLAN — один раз, при первом появлении оператора.
+Операторы дольше SQL_SLOW_MS пишутся в slow-лог.
+
+Запуск бота под профилировщиком (любой точки входа):
+    python sqlprof.py run bot.py
+    python sqlprof.py run bot_main.py
+Топ по накопленному профилю (пишется при выходе и раз в SQL_PROFILE_DUMP_EVERY c):
+    python sqlprof.py report --top 20 --by total --plans
+"""
+from __future__ import annotations
+
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+import db_pool
+from db_pool import APPDATA_DIR
+
+SLOW_MS = float(os.getenv("SQL_SLOW_MS", "50") or 50)
+SLOW_LOG = os.getenv("SQL_SLOW_LOG", "") or os.path.join(APPDATA_DIR, "sql_slow.log")
+PROFILE_OUT = os.getenv("SQL_PROFILE_OUT", "") or os.path.join(APPDATA_DIR, "sql_profile.json")
+DUMP_EVERY = float(os.getenv("SQL_PROFILE_DUMP_EVERY", "60") or 60)
+
+# для каких операторов имеет смысл EXPLAIN QUERY PLAN
+_EXPLAIN_PREFIXES = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+_SKIP_FILES = (os.path.abspath(__file__), os.path.abspath(db_pool.__file__))
+
+_STR_RE = re.compile(r"'(?:[^']|'')*'")
+_NUM_RE = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+_IN_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WS_RE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=4096)
+def normalize(sql: str) -> str:
+    """Текст оператора без литералов и лишних пробелов — ключ статистики."""
+    s = _STR_RE.sub("?", sql)
+    s = _NUM_RE.sub("?", s)
+    s = _WS_RE.sub(" ", s).strip().rstrip(";")
+    return _IN_RE.sub("(?+)", s)
+
+
+def _call_site() -> str:
+    """Первый кадр вне db_pool/sqlprof — тот, кто написал `await conn.execute(...)`."""
+    f = sys._getframe(2)
+    while f is not None:
+        path = f.f_code.co_filename
+        if path not in _SKIP_FILES and not path.startswith("<"):
+            return f"{os.path.basename(path)}:{f.f_lineno} {f.f_code.co_name}"
+        f = f.f_back
+    return "?"
+
+
+class _Stat:
+    __slots__ = ("sql", "calls", "errors", "total", "max", "rows", "sites", "plan")
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.sites: Dict[str, int] = {}
+        self.plan: Optional[List[str]] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "sql": self.sql,
+            "calls": self.calls,
+            "errors": self.errors,
+            "total": self.total,
+            "max": self.max,
+            "rows": self.rows,
+            "sites": self.sites,
+            "plan": self.plan,
+        }
+
+
+class _CountingCursor:
+    """Курсор, который досчитывает в статистику строки, отданные fetch*()."""
+
+    __slots__ = ("_cur", "_stat")
+
+    def __init__(self, cur, stat: _Stat):
+        self._cur = cur
+        self._stat = stat
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    async def fetchone(self):
+        row = await self._cur.fetchone()
+        if row is not None:
+            self._stat.rows += 1
+        return row
+
+    async def fetchall(self):
+        rows = await self._cur.fetchall()
+        self._stat.rows += len(rows)
+        return rows
+
+    async def fetchmany(self, size: Optional[int] = None):
+        rows = await (self._cur.fetchmany() if size is None else self._cur.fetchmany(size))
+        self._stat.rows += len(rows)
+        return rows
+
+    def __aiter__(self):
+        return self._iter()
+
+    async def _iter(self):
+        async for row in self._cur:
+            self._stat.rows += 1
+            yield row
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._cur.close()
+
+
+class SqlProfiler:
+    def __init__(self, slow_ms: float = SLOW_MS, slow_log: str = SLOW_LOG):
+        self.slow_ms = slow_ms
+        self.slow_log = slow_log
+        self.stats: Dict[str, _Stat] = {}
+        self.started_at = 0.0
+        self._log = None
+        self._explain_conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def enabled(self) -> bool:
+        return db_pool._TRACER == self.trace
+
+    def enable(self) -> None:
+        if self.enabled:
+            return
+        self.started_at = time.time()
+        if self.slow_log:
+            d = os.path.dirname(self.slow_log)
+            if d:
+                os.makedirs(d, exist_ok=True)
+            self._log = open(self.slow_log, "a", encoding="utf-8", buffering=1)
+        db_pool.set_query_tracer(self.trace)
+
+    def disable(self) -> None:
+        if self.enabled:
+            db_pool.set_query_tracer(None)
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        if self._explain_conn is not None:
+            self._explain_conn.close()
+            self._explain_conn = None
+
+    def reset(self) -> None:
+        self.stats.clear()
+        self.started_at = time.time()
+
+    # ------------------ трассировщик для db_pool ------------------
+    def trace(self, sql: str, params, seconds: float, ok: bool, cur):
+        key = normalize(sql)
+        st = self.stats.get(key)
+        if st is None:
+            st = self.stats[key] = _Stat(key)
+            st.plan = self._explain(sql, params)
+        site = _call_site()
+        st.calls += 1
+        st.total += seconds
+        if seconds > st.max:
+            st.max = seconds
+        st.sites[site] = st.sites.get(site, 0) + 1
+        if not ok:
+            st.errors += 1
+            return cur
+        if self._log is not None and seconds * 1000 >= self.slow_ms:
+            self._log.write(
+                f"{time.strftime('%Y-%m-%d %H:%M:%S')} {seconds * 1000:9.1f} ms  {site}  {key}"
+                f"  params={_short(params)}\n"
+            )
+        if cur is None or not hasattr(cur, "fetchone"):
+            return cur  # commit
+        if key.upper().startswith(("SELECT", "WITH", "PRAGMA")):
+            return _CountingCursor(cur, st)
+        if cur.rowcount > 0:
+            st.rows += cur.rowcount
+        return cur
+
+    def _explain(self, sql: str, params) -> Optional[List[str]]:
+        if not sql.lstrip().upper().startswith(_EXPLAIN_PREFIXES):
+            return None
+        try:
+            if self._explain_conn is None:
+                # отдельное соединение только на чтение: план не зависит от данных транзакции
+                self._explain_conn = sqlite3.connect(f"file:{db_pool.POOL.path}?mode=ro", uri=True,
+                                                     check_same_thread=False)
+            if params is None:
+                params = (None,) * sql.count("?")
+            rows = self._explain_conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+            return [r[-1] for r in rows]
+        except Exception as e:
+            return [f"(нет плана: {e})"]
+
+    # ------------------ отчёты ------------------
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "started_at": self.started_at,
+            "dumped_at": time.time(),
+            "statements": [s.to_dict() for s in self.stats.values()],
+        }
+
+    def dump(self, path: str = PROFILE_OUT) -> str:
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False)
+        os.replace(tmp, path)
+        return path
+
+    def report(self, top: int = 20, by: str = "total", plans: bool = False) -> str:
+        return render_report(self.snapshot()["statements"], top, by, plans)
+
+    async def run_dumper(self, path: str = PROFILE_OUT, every: float = DUMP_EVERY) -> None:
+        import asyncio
+
+        while True:
+            await asyncio.sleep(every)
+            try:
+                self.dump(path)
+            except Exception as e:
+                print("[sqlprof] dump failed:", repr(e))
+
+
+PROFILER = SqlProfiler()
+
+SORT_KEYS = {
+    "total": lambda s: s["total"],
+    "calls": lambda s: s["calls"],
+    "max": lambda s: s["max"],
+    "mean": lambda s: s["total"] / s["calls"] if s["calls"] else 0.0,
+    "rows": lambda s: s["rows"],
+}
+
+
+def _short(params, limit: int = 120) -> str:
+    s = repr(params)
+    return s if len(s) <= limit else s[:limit - 3] + "..."
+
+
+def render_report(statements: List[Dict[str, Any]], top: int = 20, by: str = "total", plans: bool = False) -> str:
+    items = sorted(statements, key=SORT_KEYS[by], reverse=True)[:top]
+    grand = sum(s["total"] for s in statements) or 1.0
+    lines = [
+        f"{'total ms':>10} {'%':>5} {'calls':>8} {'mean ms':>9} {'max ms':>9} {'rows/call':>9}  statement",
+    ]
+    for s in items:
+        calls = s["calls"] or 1
+        lines.append(
+            f"{s['total'] * 1000:10.1f} {s['total'] / grand:5.0%} {s['calls']:8d} {s['total'] / calls * 1000:9.3f} "
+            f"{s['max'] * 1000:9.3f} {s['rows'] / calls:9.1f}  {s['sql'][:110]}"
+            + (f"  [ошибок: {s['errors']}]" if s["errors"] else "")
+        )
+        for site, n in sorted(s["sites"].items(), key=lambda kv: kv[1], reverse=True)[:3]:
+            lines.append(f"{'':>56}  ← {site} ×{n}")
+        if plans and s["plan"]:
+            for p in s["plan"]:
+                lines.append(f"{'':>56}  ▸ {p}")
+    lines.append(f"Операторов: {len(statements)}, вызовов: {sum(s['calls'] for s in statements)}, "
+                 f"время в SQL: {sum(s['total'] for s in statements):.3f} c")
+    return "\n".join(lines)
+
+
+def run_script(path: str, argv: List[str]) -> None:
+    """Запустить точку входа (bot.py, bot_main.py, ...) под профилировщиком."""
+    import asyncio
+    import runpy
+
+    PROFILER.enable()
+    print(f"[sqlprof] profiling {path}: slow >= {PROFILER.slow_ms:g} ms -> {PROFILER.slow_log}, "
+          f"profile -> {PROFILE_OUT}")
+    # периодический дамп: первый asyncio.run точки входа подхватит задачу
+    orig_run = asyncio.run
+
+    def run(main, **kw):
+        async def wrapped():
+            dumper = asyncio.create_task(PROFILER.run_dumper())
+            try:
+                return await main
+            finally:
+                dumper.cancel()
+        return orig_run(wrapped(), **kw)
+
+    asyncio.run = run
+    sys.argv = [path] + argv
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+    try:
+        runpy.run_path(path, run_name="__main__")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        asyncio.run = orig_run
+        print("[sqlprof] profile saved:", PROFILER.dump())
+        PROFILER.disable()
+
+
+__all__ = [
+    "SqlProfiler",
+    "PROFILER",
+    "normalize",
+    "render_report",
+    "run_script",
+]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Профилировщик SQL")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("run", help="запустить бота под профилировщиком")
+    p.add_argument("script", help="точка входа: bot.py, bot_main.py, ...")
+    p.add_argument("args", nargs=argparse.REMAINDER)
+    p = sub.add_parser("report", help="топ операторов по сохранённому профилю")
+    p.add_argument("--file", default=PROFILE_OUT)
+    p.add_argument("--top", type=int, default=20)
+    p.add_argument("--by", choices=sorted(SORT_KEYS), default="total")
+    p.add_argument("--plans", action="store_true", help="показать EXPLAIN QUERY PLAN")
+    args = ap.parse_args()
+    if args.cmd == "run":
+        run_script(args.script, args.args)
+    else:
+        with open(args.file, encoding="utf-8") as f:
+            data = json.load(f)
+        print(render_report(data["statements"], args.top, args.by, args.plans))
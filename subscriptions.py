@@ -0,0 +1,144 @@
+# subscriptions.py
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+# подписчик проверяется редко, неподписанный — часто (он как раз сейчас подписывается)
+POS_TTL = float(os.getenv("SUB_TTL_POS", "600") or 600)
+NEG_TTL = float(os.getenv("SUB_TTL_NEG", "30") or 30)
+MAX_SIZE = 100_000
+
+Checker = Callable[[int], Awaitable[bool]]
+
+
+class SubscriptionCache:
+    """
+    Кэш проверки подписки на канал: user_id -> (подписан?, истекает, последнее обращение).
+
+    - разные TTL для «да» и «нет»; ошибки API кэшируются как «нет» на NEG_TTL
+      (кнопка «Проверить» всё равно сбрасывает запись);
+    - одновременные запросы одного пользователя делят один вызов get_chat_member;
+    - run_refresher() заранее перепроверяет горячих подписчиков, чтобы они
+      не ловили промах на истечении TTL.
+    """
+
+    def __init__(self, pos_ttl: float = POS_TTL, neg_ttl: float = NEG_TTL, max_size: int = MAX_SIZE,
+                 clock: Callable[[], float] = time.monotonic):
+        self.checker: Optional[Checker] = None
+        self.pos_ttl = pos_ttl
+        self.neg_ttl = neg_ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._data: Dict[int, Tuple[bool, float, float]] = {}
+        self._inflight: Dict[int, asyncio.Future] = {}
+        # метрики
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+        self.errors = 0
+        self.coalesced = 0   # запросы, присоединившиеся к уже идущей проверке
+        self.refreshed = 0
+
+    def bind(self, checker: Checker) -> None:
+        self.checker = checker
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _store(self, user_id: int, value: bool, now: float, used: float) -> None:
+        ttl = self.pos_ttl if value else self.neg_ttl
+        self._data.pop(user_id, None)
+        self._data[user_id] = (value, now + ttl, used)
+        if len(self._data) > self.max_size:
+            # сначала выбрасываем протухшие, потом самые давние по вставке
+            for uid in [u for u, e in self._data.items() if e[1] <= now]:
+                del self._data[uid]
+            while len(self._data) > self.max_size:
+                del self._data[next(iter(self._data))]
+
+    async def _check(self, user_id: int) -> bool:
+        fut = self._inflight.get(user_id)
+        if fut is not None:
+            self.coalesced += 1
+            return await fut
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[user_id] = fut
+        try:
+            self.api_calls += 1
+            try:
+                value = bool(await self.checker(user_id))
+            except Exception as e:
+                self.errors += 1
+                print("is_subscribed error:", repr(e))
+                value = False
+            fut.set_result(value)
+            return value
+        finally:
+            self._inflight.pop(user_id, None)
+            if not fut.done():
+                fut.cancel()
+
+    async def get(self, user_id: int) -> bool:
+        now = self.clock()
+        e = self._data.get(user_id)
+        if e is not None and e[1] > now:
+            self.hits += 1
+            self._data[user_id] = (e[0], e[1], now)
+            return e[0]
+        self.misses += 1
+        value = await self._check(user_id)
+        self._store(user_id, value, self.clock(), now)
+        return value
+
+    def invalidate(self, user_id: int) -> None:
+        self._data.pop(user_id, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    # ------------------ фоновое обновление ------------------
+    async def refresh_hot(self, ahead: float, hot_window: float, limit: int = 50) -> int:
+        """Перепроверить подписчиков, которые скоро протухнут и недавно пользовались ботом."""
+        now = self.clock()
+        due: List[int] = [
+            uid for uid, (value, expires, used) in self._data.items()
+            if value and expires - now <= ahead and now - used <= hot_window
+        ][:limit]
+        for uid in due:
+            used = self._data.get(uid, (None, 0.0, now))[2]
+            value = await self._check(uid)
+            self._store(uid, value, self.clock(), used)
+            self.refreshed += 1
+        return len(due)
+
+    async def run_refresher(self, interval: float = 30.0, hot_window: float = 300.0) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh_hot(ahead=interval * 2, hot_window=hot_window)
+            except Exception as e:
+                print("[subscriptions] refresh failed:", repr(e))
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+            "api_calls": self.api_calls,
+            "saved": self.hits + self.coalesced,
+            "errors": self.errors,
+            "refreshed": self.refreshed,
+        }
+
+
+SUBS = SubscriptionCache()
+
+__all__ = [
+    "SubscriptionCache",
+    "SUBS",
+]
@@ -0,0 +1,127 @@
+# timers.py
+from __future__ import annotations
+
+import asyncio
+import heapq
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+Callback = Callable[..., Awaitable[Any]]
+
+
+class TimerScheduler:
+    """
+    Один планировщик на все таймеры бота (куча + один asyncio TimerHandle).
+
+    - schedule(key, when, cb, *args): на ключ не больше одного таймера;
+      сдвиг на БОЛЕЕ ПОЗДНЕЕ время — O(1) (просто обновляем словарь,
+      старая запись в куче при всплытии перекладывается на новое время);
+    - просыпаемся только когда что-то действительно должно сработать;
+    - колбэки async, запускаются отдельными задачами.
+    Время — time.monotonic(), как и у asyncio-цикла по умолчанию.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._entries: Dict[Hashable, list] = {}   # key -> [when, cb, args]
+        self._queued: Dict[Hashable, float] = {}   # key -> самое раннее время этого ключа в куче
+        self._seq = 0
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._armed_at: Optional[float] = None
+        self._running: Set[asyncio.Task] = set()
+        self.fired = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def when(self, key: Hashable) -> Optional[float]:
+        e = self._entries.get(key)
+        return e[0] if e else None
+
+    def _push(self, key: Hashable, when: float) -> None:
+        self._seq += 1
+        heapq.heappush(self._heap, (when, self._seq, key))
+        self._queued[key] = when
+        self._arm()
+
+    def schedule(self, key: Hashable, when: float, callback: Callback, *args: Any) -> None:
+        self._entries[key] = [when, callback, args]
+        queued = self._queued.get(key)
+        if queued is None or when < queued:
+            self._push(key, when)
+
+    def move(self, key: Hashable, when: float) -> bool:
+        """Сдвинуть уже заведённый таймер, сохранив колбэк."""
+        e = self._entries.get(key)
+        if e is None:
+            return False
+        self.schedule(key, when, e[1], *e[2])
+        return True
+
+    def cancel(self, key: Hashable) -> bool:
+        # запись в куче остаётся и будет выброшена при всплытии
+        return self._entries.pop(key, None) is not None
+
+    def _arm(self) -> None:
+        if not self._heap:
+            return
+        first = self._heap[0][0]
+        if self._handle is not None and self._armed_at is not None and self._armed_at <= first:
+            return
+        if self._handle is not None:
+            self._handle.cancel()
+        loop = asyncio.get_running_loop()
+        self._handle = loop.call_later(max(0.0, first - self.clock()), self._on_timer)
+        self._armed_at = first
+
+    def _on_timer(self) -> None:
+        self._handle = None
+        self._armed_at = None
+        now = self.clock()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            when, _seq, key = heapq.heappop(heap)
+            if self._queued.get(key) == when:
+                del self._queued[key]
+            e = self._entries.get(key)
+            if e is None:
+                continue                      # отменён
+            if e[0] > now:
+                if key not in self._queued:   # дедлайн отодвинули — переложим
+                    self._push(key, e[0])
+                continue
+            del self._entries[key]
+            self.fired += 1
+            t = asyncio.ensure_future(self._fire(key, e[1], e[2]))
+            self._running.add(t)
+            t.add_done_callback(self._running.discard)
+        self._arm()
+
+    async def _fire(self, key: Hashable, callback: Callback, args: tuple) -> None:
+        try:
+            await callback(*args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[timers] callback for {key!r} failed:", repr(e))
+
+    def clear(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle = None
+        self._armed_at = None
+        self._heap.clear()
+        self._entries.clear()
+        self._queued.clear()
+
+
+TIMERS = TimerScheduler()
+
+__all__ = [
+    "TimerScheduler",
+    "TIMERS",
+]
@@ -0,0 +1,144 @@
+# updatectx.py
+from __future__ import annotations
+
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+
+
+class UpdateContext:
+    """
+    Состояние пользователя в рамках одного апдейта.
+
+    - чат/очередь снимаются один раз при первом вопросе (это охранные хэндлеры
+      в начале цепочки: block_*_in_chat, relay_chat, unknown_router, deny_*);
+      тела хэндлеров, меняющие ACTIVE, смотрят в ACTIVE напрямую;
+    - запись users и подписка запоминаются при первом запросе:
+      повторные get_role/gate_subscription того же апдейта
+      берут готовое и в кэши/БД/API не ходят (ensure_user и так проверка
+      по KNOWN_USERS в памяти).
+
+    calls — сколько раз хелперы спросили (столько поисков было бы без контекста),
+    lookups — сколько реально сходили.
+    """
+    __slots__ = ("user_id", "closed", "calls", "lookups", "_active", "_queue", "_memo")
+
+    def __init__(self, user_id: int, active: Dict[int, tuple], queue):
+        self.user_id = user_id
+        self.closed = False
+        self.calls = 0
+        self.lookups = 0
+        self._active = active
+        self._queue = queue
+        self._memo: Dict[str, Any] = {}
+
+    def _snapshot(self, key: str, look: Callable[[], Any]) -> Any:
+        self.calls += 1
+        if key not in self._memo:
+            self.lookups += 1
+            self._memo[key] = look()
+        return self._memo[key]
+
+    @property
+    def chat(self) -> Optional[tuple]:
+        """(peer_id, match_id) на момент первого вопроса или None."""
+        return self._snapshot("chat", lambda: self._active.get(self.user_id))
+
+    @property
+    def in_chat(self) -> bool:
+        return self.chat is not None
+
+    @property
+    def queued(self) -> bool:
+        return self._snapshot("queued", lambda: self.user_id in self._queue)
+
+    async def memo(self, key: str, load: Callable[[], Awaitable[Any]],
+                   valid: Callable[[Any], bool] = lambda v: True) -> Any:
+        """Значение key для этого апдейта: load() вызывается, только если ещё не было
+        (или valid() сказал, что запомненное устарело). None не запоминаем."""
+        self.calls += 1
+        if key in self._memo:
+            value = self._memo[key]
+            if valid(value):
+                return value
+        self.lookups += 1
+        value = await load()
+        if value is not None:
+            self._memo[key] = value
+        return value
+
+    def forget(self, key: str) -> None:
+        self._memo.pop(key, None)
+
+
+_CURRENT: ContextVar[Optional[UpdateContext]] = ContextVar("update_ctx", default=None)
+
+
+def ctx_for(user_id: int) -> Optional[UpdateContext]:
+    """Контекст текущего апдейта, если он про этого пользователя и ещё не закрыт
+    (задачи, созданные из хэндлера, наследуют contextvar и могут пережить апдейт)."""
+    ctx = _CURRENT.get()
+    if ctx is None or ctx.closed or ctx.user_id != user_id:
+        return None
+    return ctx
+
+
+class ContextStats:
+    def __init__(self) -> None:
+        self.updates = 0
+        self.calls = 0
+        self.lookups = 0
+        self.max_lookups = 0
+
+    def record(self, ctx: UpdateContext) -> None:
+        self.updates += 1
+        self.calls += ctx.calls
+        self.lookups += ctx.lookups
+        if ctx.lookups > self.max_lookups:
+            self.max_lookups = ctx.lookups
+
+    def stats(self) -> Dict[str, float]:
+        n = self.updates
+        return {
+            "updates": n,
+            "calls": self.calls,
+            "lookups": self.lookups,
+            "calls_avg": (self.calls / n) if n else 0.0,
+            "lookups_avg": (self.lookups / n) if n else 0.0,
+            "lookups_max": self.max_lookups,
+        }
+
+
+CTX_STATS = ContextStats()
+
+
+class ContextMiddleware(BaseMiddleware):
+    """Outer-middleware: заводит UpdateContext и кладёт его в data["ctx"]."""
+
+    def __init__(self, active: Dict[int, tuple], queue) -> None:
+        self.active = active
+        self.queue = queue
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        ctx = UpdateContext(user.id, self.active, self.queue)
+        data["ctx"] = ctx
+        token = _CURRENT.set(ctx)
+        try:
+            return await handler(event, data)
+        finally:
+            ctx.closed = True
+            _CURRENT.reset(token)
+            CTX_STATS.record(ctx)
+
+
+__all__ = [
+    "UpdateContext",
+    "ContextMiddleware",
+    "ContextStats",
+    "CTX_STATS",
+    "ctx_for",
+]
@@ -0,0 +1,202 @@
+# usercache.py
+from __future__ import annotations
+
+import asyncio
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set
+
+from db_pool import db_read
+
+MAX_SIZE = 50_000
+
+
+class UserRecord:
+    """Компактная запись строки users (только то, что читают хэндлеры)."""
+    __slots__ = (
+        "tg_id", "gender", "seeking", "reveal_ready", "first_name", "last_name",
+        "faculty", "age", "about", "username", "photo1", "photo2", "photo3",
+        "role", "points", "status_title", "last_daily", "bot_blocked",
+        "rating_sum", "rating_count",   # из rating_stats
+    )
+
+    def __init__(self, row) -> None:
+        for name, value in zip(self.__slots__, row):
+            setattr(self, name, value)
+
+    def profile_row(self) -> tuple:
+        """Тот же кортеж, что раньше возвращал SELECT в get_user()."""
+        return (
+            self.tg_id, self.gender, self.seeking, self.reveal_ready, self.first_name, self.last_name,
+            self.faculty, self.age, self.about, self.username, self.photo1, self.photo2, self.photo3,
+        )
+
+
+COLUMNS = UserRecord.__slots__[:-2]   # колонки таблицы users
+_SELECT_SQL = (
+    f"SELECT {', '.join('u.' + c for c in COLUMNS)}, COALESCE(rs.sum,0), COALESCE(rs.count,0) "
+    "FROM users u LEFT JOIN rating_stats rs ON rs.user_id=u.tg_id WHERE u.tg_id=?"
+)
+
+
+class UserCache:
+    """
+    Write-through кэш профилей с LRU-вытеснением.
+
+    Читаем строку целиком один раз, дальше get_user/get_role/get_points/...
+    отдают поля из памяти. Все записи в users идут через хелперы бота,
+    которые после commit вызывают update()/add_points()/invalidate().
+    Если запись пришла, пока строка грузилась из БД, загруженное не кэшируем
+    (иначе можно сохранить устаревший снимок).
+    """
+
+    def __init__(self, max_size: int = MAX_SIZE):
+        self.max_size = max_size
+        self._data: "OrderedDict[int, UserRecord]" = OrderedDict()
+        self._loading: Dict[int, list] = {}   # tg_id -> [сколько загрузок идёт, была ли запись]
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, tg_id: int) -> bool:
+        return tg_id in self._data
+
+    def peek(self, tg_id: int) -> Optional[UserRecord]:
+        """Запись без учёта в LRU и метриках (проверка, что она ещё в кэше)."""
+        return self._data.get(tg_id)
+
+    async def get(self, tg_id: int) -> Optional[UserRecord]:
+        rec = self._data.get(tg_id)
+        if rec is not None:
+            self.hits += 1
+            self._data.move_to_end(tg_id)
+            return rec
+        self.misses += 1
+        state = self._loading.setdefault(tg_id, [0, False])
+        state[0] += 1
+        try:
+            async with db_read() as conn:
+                cur = await conn.execute(_SELECT_SQL, (tg_id,))
+                row = await cur.fetchone()
+            if row is None:
+                return None
+            rec = UserRecord(row)
+            if not state[1]:
+                self._put(tg_id, rec)
+            return rec
+        finally:
+            state[0] -= 1
+            if state[0] == 0:
+                self._loading.pop(tg_id, None)
+
+    def _put(self, tg_id: int, rec: UserRecord) -> None:
+        self._data[tg_id] = rec
+        self._data.move_to_end(tg_id)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def _touched(self, tg_id: int) -> None:
+        state = self._loading.get(tg_id)
+        if state is not None:
+            state[1] = True
+
+    # ------------------ write-through ------------------
+    def update(self, tg_id: int, **fields: Any) -> None:
+        self._touched(tg_id)
+        rec = self._data.get(tg_id)
+        if rec is None:
+            return
+        for k, v in fields.items():
+            if k not in COLUMNS:
+                # поле не кэшируется — проще перечитать строку при следующем обращении
+                self._data.pop(tg_id, None)
+                return
+            setattr(rec, k, v)
+
+    def add_points(self, tg_id: int, delta: int) -> None:
+        self._touched(tg_id)
+        rec = self._data.get(tg_id)
+        if rec is not None:
+            rec.points = (rec.points or 0) + delta
+
+    def add_rating(self, tg_id: int, stars: int) -> None:
+        self._touched(tg_id)
+        rec = self._data.get(tg_id)
+        if rec is not None:
+            rec.rating_sum += stars
+            rec.rating_count += 1
+
+    def invalidate(self, tg_id: int) -> None:
+        self._touched(tg_id)
+        self._data.pop(tg_id, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
+
+
+class KnownUsers:
+    """
+    Множество tg_id, у которых уже есть строка в users.
+
+    Грузится лениво одним SELECT при первой проверке, дальше пополняется
+    через add() после commit создания пользователя — ensure_user() для
+    знакомого пользователя становится проверкой по set, без SQLite.
+    Строки users не удаляются, поэтому множество только растёт
+    (int в set — порядка 60–70 байт, 100k пользователей ≈ 7 МБ).
+    """
+
+    def __init__(self) -> None:
+        self._ids: Set[int] = set()
+        self._loaded = False
+        self._lock = asyncio.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    async def load(self) -> int:
+        async with db_read() as conn:
+            cur = await conn.execute("SELECT tg_id FROM users")
+            ids = {int(r[0]) for r in await cur.fetchall()}
+        self._ids |= ids   # add(), пришедшие во время загрузки, не теряем
+        self._loaded = True
+        return len(self._ids)
+
+    async def contains(self, tg_id: int) -> bool:
+        if not self._loaded:
+            async with self._lock:
+                if not self._loaded:
+                    await self.load()
+        return tg_id in self._ids
+
+    def add(self, tg_id: int) -> None:
+        self._ids.add(tg_id)
+
+    def clear(self) -> None:
+        self._ids.clear()
+        self._loaded = False
+
+
+USERS = UserCache()
+KNOWN_USERS = KnownUsers()
+
+__all__ = [
+    "UserRecord",
+    "UserCache",
+    "USERS",
+    "KnownUsers",
+    "KNOWN_USERS",
+]
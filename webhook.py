@@ -0,0 +1,216 @@
+# webhook.py
+"""
+Режим webhook (BOT_MODE=webhook) вместо long polling.
+
+Telegram сам присылает апдейты POST-запросом на WEBHOOK_PATH; ответ 200 уходит
+сразу, а обработка идёт в WEBHOOK_WORKERS воркерах. Апдейты одного
+пользователя всегда попадают в один и тот же воркер — порядок сообщений
+внутри чата сохраняется, разные пользователи обрабатываются параллельно.
+
+WEBHOOK_SECRET обязателен: без него любой, кто достучится до порта, может
+прислать апдейт от имени любого пользователя (в том числе админа), поэтому
+run_webhook() без секрета не стартует.
+
+Локальная проверка без Telegram: запустить бота с BOT_MODE=webhook без
+WEBHOOK_URL (тогда setWebhook не вызывается) и отправить записанные апдейты:
+    python webhook.py post updates.jsonl --url http://127.0.0.1:8080/webhook
+(секрет берётся из того же WEBHOOK_SECRET)
+"""
+from __future__ import annotations
+
+import asyncio
+import hmac
+import json
+import os
+import signal
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+BOT_MODE = (os.getenv("BOT_MODE", "polling") or "polling").strip().lower()
+WEBHOOK_URL = (os.getenv("WEBHOOK_URL", "") or "").strip()          # публичный адрес, напр. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook") or "/webhook"
+WEBHOOK_SECRET = (os.getenv("WEBHOOK_SECRET", "") or "").strip()    # X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0") or "0.0.0.0"
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080") or 8080)
+WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16") or 16)
+QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE", "1000") or 1000)         # на воркер; дальше POST ждёт (backpressure)
+DRAIN_TIMEOUT = 10.0
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def shard_key(data: Dict[str, Any]) -> int:
+    """id пользователя (или чата) из сырого апдейта — по нему выбирается воркер."""
+    for k, v in data.items():
+        if k == "update_id" or not isinstance(v, dict):
+            continue
+        who = v.get("from") or v.get("user") or v.get("chat") or (v.get("message") or {}).get("chat") or {}
+        if "id" in who:
+            return int(who["id"])
+    return int(data.get("update_id") or 0)
+
+
+class WebhookServer:
+    def __init__(self, dp, bot, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET,
+                 workers: int = WORKERS, queue_size: int = QUEUE_SIZE):
+        if not secret:
+            raise RuntimeError("WEBHOOK_SECRET is required in webhook mode")
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=queue_size) for _ in range(max(1, workers))]
+        self._workers: List[asyncio.Task] = []
+        self._runner: Optional[web.AppRunner] = None
+        # метрики
+        self.received = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+
+    # ------------------ HTTP ------------------
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.router.add_get("/healthz", self.health)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            self.rejected += 1
+            return web.Response(status=401)
+        try:
+            data = await request.json()
+        except Exception:
+            self.rejected += 1
+            return web.Response(status=400)
+        if not isinstance(data, dict):
+            self.rejected += 1
+            return web.Response(status=400)
+        self.received += 1
+        await self.queues[shard_key(data) % len(self.queues)].put(data)
+        return web.Response(text="ok")
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    # ------------------ обработка ------------------
+    async def _worker(self, q: asyncio.Queue) -> None:
+        from aiogram.types import Update
+        while True:
+            data = await q.get()
+            try:
+                update = Update.model_validate(data, context={"bot": self.bot})
+                await self.dp.feed_update(self.bot, update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                print("[webhook] update failed:", repr(e))
+            finally:
+                q.task_done()
+
+    async def start(self, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT) -> None:
+        self._workers = [asyncio.create_task(self._worker(q)) for q in self.queues]
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self, drain_timeout: float = DRAIN_TIMEOUT) -> None:
+        """Перестать принимать запросы, доработать очередь (не дольше drain_timeout), погасить воркеры."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues)), drain_timeout)
+        except asyncio.TimeoutError:
+            print("[webhook] drain timeout, dropped:", sum(q.qsize() for q in self.queues))
+        for t in self._workers:
+            t.cancel()
+        for t in self._workers:
+            try:
+                await t
+            except asyncio.CancelledError:
+                pass
+        self._workers = []
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "received": self.received,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed,
+            "depth": sum(q.qsize() for q in self.queues),
+            "workers": len(self.queues),
+        }
+
+
+async def run_webhook(dp, bot) -> None:
+    """Аналог dp.start_polling(bot): работает до SIGINT/SIGTERM (или отмены задачи)."""
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET is not set: refusing to accept unauthenticated webhook updates")
+    server = WebhookServer(dp, bot)
+    await server.start()
+    print(f"Webhook listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH} ({len(server.queues)} workers)")
+    await dp.emit_startup(bot=bot)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    installed = []
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+            installed.append(sig)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: остановка через KeyboardInterrupt/отмену задачи
+    try:
+        await stop.wait()
+    finally:
+        for sig in installed:
+            loop.remove_signal_handler(sig)
+        # вебхук у Telegram не снимаем: апдейты подождут у него до рестарта
+        await server.stop()
+        await dp.emit_shutdown(bot=bot)
+
+
+# ------------------ локальная проверка ------------------
+async def post_updates(path: str, url: str, secret: str = WEBHOOK_SECRET) -> None:
+    """Отправить записанные апдейты (по одному JSON в строке) на webhook."""
+    import aiohttp
+
+    headers = {SECRET_HEADER: secret} if secret else {}
+    async with aiohttp.ClientSession() as session:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                async with session.post(url, data=line, headers={**headers, "Content-Type": "application/json"}) as r:
+                    print(r.status, json.loads(line).get("update_id"))
+
+
+__all__ = [
+    "BOT_MODE",
+    "WebhookServer",
+    "run_webhook",
+    "post_updates",
+]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Проверка webhook-режима")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("post", help="отправить записанные апдейты на webhook")
+    p.add_argument("file", help="файл с апдейтами, один JSON на строку")
+    p.add_argument("--url", default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    p.add_argument("--secret", default=WEBHOOK_SECRET)
+    args = ap.parse_args()
+    asyncio.run(post_updates(args.file, args.url, args.secret))
+